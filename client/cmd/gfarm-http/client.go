@@ -136,13 +136,19 @@ func (c *Client) cmdLs(gfarmPath string, all, effective, longf, timef, recursive
 	if recursive {
 		params.Set("recursive", "on")
 	}
-	if json {
+	var headers map[string]string
+	if json && longf {
+		// compact columnar format, decoded to the same NDJSON
+		headers = map[string]string{
+			"Accept": ColumnarMediaType + ", application/x-ndjson;q=0.9",
+		}
+	} else if json {
 		params.Set("output_format", "json")
 	} else {
 		params.Set("output_format", "plain")
 	}
 	u := c.generateURL("dir", gfarmPath, params)
-	return c.makeHTTPRequest("GET", u, nil, nil, "", "")
+	return c.makeHTTPRequest("GET", u, nil, headers, "", "")
 }
 
 func (c *Client) cmdDownload(gfarmPath, localPath string) error {
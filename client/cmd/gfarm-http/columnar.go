@@ -0,0 +1,135 @@
+package main
+
+import (
+	"bufio"
+	"encoding/json"
+	"fmt"
+	"io"
+	"strconv"
+	"strings"
+)
+
+// Columnar NDJSON of GET /dir (see server/api/dir_columnar.py)
+const ColumnarMediaType = "application/x-gfarm-columnar-ndjson"
+
+var columnarColumns = []string{"name", "dir", "path", "mode_str", "linkname",
+	"nlink", "uname", "gname", "size", "mtime", "perms"}
+
+// keys of output_format=json
+var entryKeys = []string{"mode_str", "is_file", "is_dir", "is_sym", "linkname",
+	"nlink", "uname", "gname", "size", "mtime", "name", "path", "perms"}
+
+type columnarLine struct {
+	Columns    []string                     `json:"columns"`
+	Dictionary []string                     `json:"dictionary"`
+	N          *int                         `json:"n"`
+	Dict       map[string][]json.RawMessage `json:"dict"`
+	Data       [][]json.RawMessage          `json:"data"`
+	Line       *string                      `json:"line"`
+	Error      *string                      `json:"error"`
+	ErrCode    json.RawMessage              `json:"err_code"`
+}
+
+var jsonNull = json.RawMessage("null")
+
+func joinPath(dir, name string) string {
+	if name == "." {
+		return dir
+	}
+	if strings.HasSuffix(dir, "/") {
+		return dir + name
+	}
+	return dir + "/" + name
+}
+
+// writeColumnar decodes the columnar stream and writes the entries in
+// the same NDJSON as output_format=json.
+func writeColumnar(r io.Reader, w io.Writer) error {
+	dec := json.NewDecoder(r)
+	bw := bufio.NewWriter(w)
+	defer bw.Flush()
+
+	columns := columnarColumns
+	dicts := map[string][]json.RawMessage{}
+	for {
+		var l columnarLine
+		if err := dec.Decode(&l); err == io.EOF {
+			return nil
+		} else if err != nil {
+			return fmt.Errorf("decode columnar: %w", err)
+		}
+		switch {
+		case l.Columns != nil:
+			columns = l.Columns
+			dicts = map[string][]json.RawMessage{}
+			for _, key := range l.Dictionary {
+				dicts[key] = nil
+			}
+		case l.N != nil:
+			for key, values := range l.Dict {
+				dicts[key] = append(dicts[key], values...)
+			}
+			for i := 0; i < *l.N; i++ {
+				if err := writeRow(bw, columns, dicts, l.Data, i); err != nil {
+					return err
+				}
+			}
+		case l.Line != nil:
+			fmt.Fprintln(bw, *l.Line)
+		case l.Error != nil:
+			msg, _ := json.Marshal(*l.Error)
+			code := l.ErrCode
+			if code == nil {
+				code = jsonNull
+			}
+			fmt.Fprintf(bw, "{\"error\": %s, \"err_code\": %s}\n", msg, code)
+		}
+	}
+}
+
+func writeRow(w *bufio.Writer, columns []string, dicts map[string][]json.RawMessage, data [][]json.RawMessage, i int) error {
+	row := make(map[string]json.RawMessage, len(entryKeys))
+	for c, key := range columns {
+		if c >= len(data) || i >= len(data[c]) {
+			return fmt.Errorf("decode columnar: short column %s", key)
+		}
+		value := data[c][i]
+		if values, ok := dicts[key]; ok && string(value) != "null" {
+			idx, err := strconv.Atoi(string(value))
+			if err != nil || idx < 0 || idx >= len(values) {
+				return fmt.Errorf("decode columnar: invalid index of %s: %s", key, value)
+			}
+			value = values[idx]
+		}
+		row[key] = value
+	}
+
+	var modeStr, name, dir string
+	_ = json.Unmarshal(row["mode_str"], &modeStr)
+	_ = json.Unmarshal(row["name"], &name)
+	isDir := strings.HasPrefix(modeStr, "d")
+	isSym := strings.HasPrefix(modeStr, "l")
+	row["is_file"] = json.RawMessage(strconv.FormatBool(!isDir && !isSym))
+	row["is_dir"] = json.RawMessage(strconv.FormatBool(isDir))
+	row["is_sym"] = json.RawMessage(strconv.FormatBool(isSym))
+	if p := row["path"]; p == nil || string(p) == "null" {
+		row["path"] = jsonNull
+		if d := row["dir"]; d != nil && string(d) != "null" && json.Unmarshal(d, &dir) == nil {
+			row["path"], _ = json.Marshal(joinPath(dir, name))
+		}
+	}
+
+	w.WriteByte('{')
+	for k, key := range entryKeys {
+		if k > 0 {
+			w.WriteString(", ")
+		}
+		value := row[key]
+		if value == nil {
+			value = jsonNull
+		}
+		fmt.Fprintf(w, "%q: %s", key, value)
+	}
+	w.WriteString("}\n")
+	return nil
+}
@@ -62,6 +62,10 @@ func handleResponse(resp *http.Response, outputFile string) error {
 		}
 	}
 
+	if outputFile == "" && strings.HasPrefix(resp.Header.Get("Content-Type"), ColumnarMediaType) {
+		return writeColumnar(resp.Body, os.Stdout)
+	}
+
 	if outputFile == "" {
 		data, err := io.ReadAll(resp.Body)
 		if err != nil {
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Benchmark of the listing formats of GET /dir
+#   json:     one object per entry (output_format=json)
+#   columnar: dir_columnar.ColumnarEncoder (output_format=columnar)
+# Sizes are compared without and with Content-Encoding (gzip).
+# The decoded entries of columnar must be identical to json.
+#
+# usage: cd server/api && python3 bench/bench_dir_columnar.py [N]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import content_encoding  # noqa: E402
+import dir_columnar  # noqa: E402
+import ndjson_stream  # noqa: E402
+from gfls_entry import Gfls_Entry  # noqa: E402
+
+
+def synthetic_entries(n):
+    entries = []
+    for i in range(n):
+        mode = "drwxr-xr-x" if i % 10 == 0 else "-rw-r--r--"
+        entries.append(Gfls_Entry(f"file{i}.dat", 1, f"user{i % 3}",
+                                  "gfarmadm", i * 4096,
+                                  f"/home/user1/dir{i // 1000}",
+                                  "Jun 01 09:00:00 2024", mode, "rw-"))
+    return entries
+
+
+def encode_json(dumps):
+    return "".join(ndjson_stream.dumps(d) + "\n" for d in dumps)
+
+
+def encode_columnar(dumps):
+    encoder = dir_columnar.ColumnarEncoder()
+    out = [encoder.header()]
+    for d in dumps:
+        out.append(encoder.add(d))
+    out.append(encoder.flush())
+    return "".join(out)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dumps = [entry.json_dump() for entry in synthetic_entries(n)]
+    print(f"{n} entries, orjson: {ndjson_stream.fast_json_available()}")
+    print(f"{'format':9} {'encode(s)':>9} {'bytes':>11} {'gzip':>10}")
+    results = {}
+    for name, encode in (("json", encode_json),
+                         ("columnar", encode_columnar)):
+        t0 = time.perf_counter()
+        text = encode(dumps)
+        t = time.perf_counter() - t0
+        data = text.encode("utf-8")
+        gz = len(content_encoding.compress_bytes(data, "gzip", 6))
+        results[name] = (len(data), gz)
+        print(f"{name:9} {t:9.2f} {len(data):11} {gz:10}")
+        if name == "columnar":
+            assert list(dir_columnar.decode(text.splitlines())) == dumps
+    ratio = results["json"][0] / results["columnar"][0]
+    ratio_gz = results["json"][1] / results["columnar"][1]
+    print(f"size ratio: {ratio:.1f}x (gzip: {ratio_gz:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
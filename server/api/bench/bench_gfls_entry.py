@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# Benchmark of the gfls line parser (Gfls_Entry.parse)
+#   legacy: Gfls_Entry of old versions
+#           (strptime + mktime and from_rwx for every line)
+#   current: gfls_entry.Gfls_Entry
+# over synthetic "gfls -lRT -e" output.  The NDJSON output of both
+# must be identical.  (Only for the repeated hour at the end of DST,
+# mktime() may return either time depending on earlier calls, so
+# such entries are compared by the local time.)
+#
+# usage: cd server/api && python3 bench/bench_gfls_entry.py [N]
+import json
+import os
+import random
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from gfls_entry import Gfls_Entry, from_rwx  # noqa: E402
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+MODES = ("-rw-r--r--", "-rw-------", "-rwxr-xr-x", "drwxr-xr-x",
+         "drwxrwxrwt", "lrwxrwxrwx", "-rwsr-xr-x")
+
+
+def synthetic_output(n, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+    dirno = 0
+    while len(lines) < n:
+        if len(lines) % 1000 == 0:
+            if lines:
+                lines.append("")
+            lines.append(f"/home/user1/dir{dirno}:")
+            dirno += 1
+            continue
+        mode = rnd.choice(MODES)
+        t = time.localtime(rnd.randint(1500000000, 1800000000))
+        mtime = (f"{MONTHS[t.tm_mon - 1]} {t.tm_mday:02d} "
+                 f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d} "
+                 f"{t.tm_year}")
+        name = f"file {len(lines)}.dat"
+        if mode.startswith("l"):
+            name += f" -> ../target{len(lines)}"
+        lines.append(f"rw- {mode} 1 user1 gfarmadm "
+                     f"{rnd.randint(0, 1 << 40)} {mtime} {name}")
+    return lines
+
+
+# Gfls_Entry of old versions
+class LegacyGfls_Entry:
+    name: str | None = None
+    path: str | None = None
+    mode_str: str | None = None
+    is_file: bool | None = None
+    is_dir: bool | None = None
+    is_sym: bool | None = None
+    linkname: str | None = None
+    nlink: int | None = None
+    uname: str | None = None
+    gname: str | None = None
+    size: int | None = None
+    mtime: float | None = None
+    perms: str | None = None
+
+    def __init__(
+            self,
+            name: Optional[str] = None,
+            nlink: Optional[int] = None,
+            uname: Optional[str] = None,
+            gname: Optional[str] = None,
+            size: Optional[int] = None,
+            dirname: Optional[str] = None,
+            mtime_str: Optional[str] = None,
+            mode_str: Optional[str] = None,
+            perms: Optional[str] = None):
+        self.name = name
+        self.nlink = nlink
+        self.uname = uname
+        self.gname = gname
+        self.size = size
+        self.perms = perms
+        self.set_dirname(dirname)
+        self.set_mtime(mtime_str)
+        self.set_mode(mode_str)
+        self.set_linkname(name, self.is_sym)
+
+    def set_dirname(self, dirname):
+        self.dirname = dirname
+        if dirname is not None:
+            if self.name == "." or self.name is None:
+                self.path = dirname
+            else:
+                self.path = os.path.join(self.dirname, self.name)
+
+    def set_mode(self, mode_str):
+        self.mode_str = mode_str
+        if mode_str is None:
+            self.mode = None
+            self.is_dir = None
+            self.is_sym = None
+            return
+        mode = 0
+        perm, highbit = from_rwx(mode_str[1:4], 's')
+        mode |= (perm << 6)
+        mode |= (highbit << 11)
+        perm, highbit = from_rwx(mode_str[4:7], 's')
+        mode |= (perm << 3)
+        mode |= (highbit << 10)
+        perm, highbit = from_rwx(mode_str[7:10], 't')
+        mode |= perm
+        mode |= (highbit << 9)
+        self.mode = mode
+        self.is_dir = mode_str.startswith('d')
+        self.is_sym = mode_str.startswith('l')
+
+    def set_mtime(self, mtime_str):
+        self.mtime_str = mtime_str
+        if mtime_str is None:
+            self.mtime = None
+            return
+        mtime = time.mktime(
+            time.strptime(mtime_str, '%b %d %H:%M:%S %Y'))
+        self.mtime = mtime
+
+    def set_linkname(self, name, is_sym):
+        self.linkname = ''
+        if is_sym is None:
+            return
+        if is_sym:
+            pair = name.split(' -> ')
+            self.name = pair[0]
+            self.linkname = pair[1]
+
+    def set_line(self, line):
+        self.line = line
+
+    def json_dump(self):
+        return {
+            "mode_str": self.mode_str,
+            "is_file": not self.is_dir and not self.is_sym,
+            "is_dir": self.is_dir,
+            "is_sym": self.is_sym,
+            "linkname": self.linkname,
+            "nlink": self.nlink,
+            "uname": self.uname,
+            "gname": self.gname,
+            "size": self.size,
+            "mtime": self.mtime,
+            "name": self.name,
+            "path": self.path,
+            "perms": self.perms
+        }
+
+    def line_dump(self):
+        return self.line
+
+    def parse(line,
+              is_file, long_format, full_format_time, effperm, dirname=None):
+        if not long_format:
+            return line
+
+        split_count = 8
+        if effperm:
+            split_count += 1
+        if full_format_time:
+            split_count += 1
+
+        parts = line.strip().split(None, split_count)
+        if len(parts) < 10:
+            return line
+
+        perms = parts.pop(0) if effperm else None
+        mode_str = parts.pop(0)
+        nlink = int(parts.pop(0))
+        uname = parts.pop(0)
+        gname = parts.pop(0)
+        size = int(parts.pop(0))
+        month = parts.pop(0)
+        day = parts.pop(0)
+        time = parts.pop(0)
+        if full_format_time:
+            year = parts.pop(0)
+            mtime_str = f"{month} {day} {time} {year}"
+        else:
+            mtime_str = f"{month} {day} {time}"
+
+        name = parts.pop(0)
+        new_entry = LegacyGfls_Entry(name, nlink, uname, gname,
+                                     size, dirname, mtime_str, mode_str, perms)
+
+        if is_file:
+            new_entry.name = os.path.basename(new_entry.name)
+
+        new_entry.set_line(line)
+
+        return new_entry
+
+
+def run(lines, cls):
+    entries = []
+    dirname = "/home/user1"
+    t0 = time.perf_counter()
+    for line in lines:
+        if not line:
+            continue
+        entry = cls.parse(line, False, True, True, True)
+        if not isinstance(entry, cls):
+            dirname = os.path.normpath(line[:-1])
+            continue
+        entry.set_dirname(dirname)
+        entries.append(entry)
+    t1 = time.perf_counter()
+    out = [json.dumps(entry.json_dump()) + "\n" for entry in entries]
+    t2 = time.perf_counter()
+    return t1 - t0, t2 - t0, out
+
+
+def same_output(a, b):
+    if a == b:
+        return True
+    a = json.loads(a)
+    b = json.loads(b)
+    mtime_a = a.pop("mtime")
+    mtime_b = b.pop("mtime")
+    return (a == b and abs(mtime_a - mtime_b) == 3600
+            and time.localtime(mtime_a)[:6] == time.localtime(mtime_b)[:6])
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lines = synthetic_output(n)
+    results = {}
+    for name, cls in (("legacy", LegacyGfls_Entry), ("current", Gfls_Entry)):
+        results[name] = run(lines, cls)
+    out_legacy = results["legacy"][2]
+    out_current = results["current"][2]
+    assert len(out_legacy) == len(out_current)
+    for a, b in zip(out_legacy, out_current):
+        assert same_output(a, b), f"output differs:\n{a}{b}"
+    print(f"{len(lines)} lines, {len(out_current)} entries (identical)")
+    print(f"{'parser':8} {'parse(s)':>9} {'lines/s':>10}"
+          f" {'+ndjson(s)':>11} {'lines/s':>10}")
+    for name, (t_parse, t_total, _) in results.items():
+        print(f"{name:8} {t_parse:9.2f} {len(lines) / t_parse:10.0f}"
+              f" {t_total:11.2f} {len(lines) / t_total:10.0f}")
+    legacy = results["legacy"]
+    current = results["current"]
+    print(f"speedup: parse {legacy[0] / current[0]:.1f}x,"
+          f" parse + ndjson {legacy[1] / current[1]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Benchmark of the NDJSON stream of GET /dir (output_format=json)
+#   legacy: one json.dumps() line per http.response.body message
+#   current: ndjson_stream.dumps() (orjson if installed) and
+#            ndjson_stream.frames() (64 KiB or 20 ms per message)
+# The lines are sent by StreamingResponse to a dummy ASGI send().
+# The parsed records of both must be identical.
+#
+# usage: cd server/api && python3 bench/bench_ndjson_stream.py [N]
+import asyncio
+import json
+import os
+import sys
+import time
+
+from starlette.responses import StreamingResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from gfls_entry import Gfls_Entry  # noqa: E402
+import ndjson_stream  # noqa: E402
+
+
+def synthetic_entries(n):
+    entries = []
+    for i in range(n):
+        mode = "drwxr-xr-x" if i % 10 == 0 else "-rw-r--r--"
+        entries.append(Gfls_Entry(f"file{i}.dat", 1, "user1", "gfarmadm",
+                                  i * 4096, "/home/user1/dir",
+                                  "Jun 01 09:00:00 2024", mode, "rw-"))
+    return entries
+
+
+async def legacy(entries):
+    for entry in entries:
+        yield json.dumps(entry.json_dump()) + "\n"
+
+
+async def current(entries):
+    async def lines():
+        for entry in entries:
+            yield ndjson_stream.dumps(entry.json_dump()) + "\n"
+    async for frame in ndjson_stream.frames(lines()):
+        yield frame
+
+
+async def run(content):
+    body = []
+    messages = 0
+
+    async def receive():
+        await asyncio.Event().wait()  # never disconnected
+
+    async def send(message):
+        nonlocal messages
+        if message["type"] == "http.response.body":
+            messages += 1
+            body.append(message.get("body", b""))
+
+    response = StreamingResponse(content=content,
+                                 media_type="application/x-ndjson")
+    t0 = time.perf_counter()
+    await response({"type": "http", "asgi": {"spec_version": "2.4"}},
+                   receive, send)
+    t = time.perf_counter() - t0
+    return t, messages, b"".join(body)
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    entries = synthetic_entries(n)
+    print(f"{n} entries, orjson: {ndjson_stream.fast_json_available()}")
+    results = {}
+    for name, gen in (("legacy", legacy), ("current", current)):
+        results[name] = await run(gen(entries))
+    expect = [json.loads(line)
+              for line in results["legacy"][2].splitlines()]
+    records = [json.loads(line)
+               for line in results["current"][2].splitlines()]
+    assert records == expect
+    print(f"{'stream':8} {'time(s)':>8} {'entries/s':>10} {'messages':>9}"
+          f" {'bytes':>11}")
+    for name, (t, messages, body) in results.items():
+        print(f"{name:8} {t:8.2f} {n / t:10.0f} {messages:9}"
+              f" {len(body):11}")
+    print(f"speedup: {results['legacy'][0] / results['current'][0]:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
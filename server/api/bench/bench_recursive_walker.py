@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Benchmark of the recursive listing (gfls_walker.RecursiveWalker)
+# over a synthetic tree.  Each listing of a directory takes
+# LATENCY seconds (the round trip to gfmd) and PER_ENTRY seconds
+# per entry, as "gfls -R" lists the directories one by one.
+#   serial: workers=1 (same as "gfls -R")
+#   workers=N: N listings at the same time
+# The output of ordered=True must be the same as serial.
+#
+# usage: cd server/api && python3 bench/bench_recursive_walker.py
+#            [FANOUT] [DEPTH] [FILES]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from gfls_entry import Gfls_Entry  # noqa: E402
+from gfls_walker import RecursiveWalker  # noqa: E402
+
+LATENCY = 0.005
+PER_ENTRY = 0.00001
+
+
+def make_list_dir(fanout, depth, files):
+    async def list_dir(path, is_file):
+        level = path.count("/") - 1
+        names = []
+        if level < depth:
+            names += [(f"d{i}", "drwxr-xr-x") for i in range(fanout)]
+        names += [(f"f{i}", "-rw-r--r--") for i in range(files)]
+        await asyncio.sleep(LATENCY + PER_ENTRY * len(names))
+        for name, mode in names:
+            yield Gfls_Entry(name, 1, "user1", "gfarmadm", 0, path,
+                             "Jun 01 09:00:00 2024", mode)
+    return list_dir
+
+
+async def run(list_dir, workers, ordered):
+    walker = RecursiveWalker(list_dir, workers=workers, max_depth=100,
+                             ordered=ordered)
+    t0 = time.perf_counter()
+    paths = [entry.path async for entry in walker.walk("/top", False)]
+    return time.perf_counter() - t0, paths
+
+
+async def main():
+    fanout = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    files = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    list_dir = make_list_dir(fanout, depth, files)
+    t_serial, expect = await run(list_dir, 1, True)
+    print(f"{len(expect)} entries")
+    print(f"{'workers':>7} {'ordered(s)':>10} {'speedup':>7}"
+          f" {'unordered(s)':>12} {'speedup':>7}")
+    print(f"{1:7} {t_serial:10.2f} {1:7.1f}")
+    for workers in (2, 4, 8, 16):
+        t_ordered, paths = await run(list_dir, workers, True)
+        assert paths == expect
+        t_unordered, paths = await run(list_dir, workers, False)
+        assert sorted(paths) == sorted(expect)
+        print(f"{workers:7} {t_ordered:10.2f} {t_serial / t_ordered:7.1f}"
+              f" {t_unordered:12.2f} {t_serial / t_unordered:7.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Micro-benchmark of session cookie codecs
+#   v1: JSON + gzip + Fernet + base85 (encrypt_json() of old versions)
+#   v2: session_codec + Fernet
+#
+# usage: cd server/api && python3 bench/bench_session_codec.py [N]
+import base64
+import gzip
+import json
+import os
+import secrets
+import sys
+import time
+import timeit
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import session_codec  # noqa: E402
+
+
+def b64url(b):
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode()
+
+
+def fake_jwt(typ, lifetime):
+    now = int(time.time())
+    header = {"alg": "RS256", "typ": "JWT", "kid": secrets.token_urlsafe(32)}
+    payload = {
+        "exp": now + lifetime, "iat": now, "auth_time": now,
+        "jti": secrets.token_hex(16),
+        "iss": "https://keycloak.example.org/auth/realms/HPCI",
+        "aud": ["hpci", "account"], "sub": secrets.token_hex(16),
+        "typ": typ, "azp": "hpci-jwt-server",
+        "session_state": secrets.token_hex(16),
+        "scope": "openid email profile hpci",
+        "sid": secrets.token_hex(16), "email_verified": False,
+        "hpci.id": "hpci000001", "preferred_username": "user1",
+    }
+    return ".".join([b64url(json.dumps(header).encode()),
+                     b64url(json.dumps(payload).encode()),
+                     b64url(secrets.token_bytes(256))])
+
+
+def v1_encode(fer, data):
+    return base64.b85encode(
+        fer.encrypt(gzip.compress(json.dumps(data).encode()))).decode()
+
+
+def v1_decode(fer, s):
+    return json.loads(gzip.decompress(fer.decrypt(base64.b85decode(s))))
+
+
+def v2_encode(fer, data):
+    return "v2." + fer.encrypt(session_codec.pack(data)).decode()
+
+
+def v2_decode(fer, s):
+    return session_codec.unpack(fer.decrypt(s[3:].encode()))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    fer = Fernet(Fernet.generate_key())
+    samples = {
+        "session": {"access_token": fake_jwt("Bearer", 300),
+                    "refresh_token": fake_jwt("Refresh", 1800)},
+        "database": {"token_id": secrets.token_hex(16),
+                     "key": Fernet.generate_key().decode(),
+                     "access_token": fake_jwt("Bearer", 300)},
+    }
+    print(f"{'data':10} {'codec':5} {'bytes':>6} "
+          f"{'encode(us)':>11} {'decode(us)':>11}")
+    for name, data in samples.items():
+        for codec, enc, dec in (("v1", v1_encode, v1_decode),
+                                ("v2", v2_encode, v2_decode)):
+            s = enc(fer, data)
+            assert dec(fer, s) == data
+            t_enc = timeit.timeit(lambda: enc(fer, data), number=n)
+            t_dec = timeit.timeit(lambda: dec(fer, s), number=n)
+            print(f"{name:10} {codec:5} {len(s):6d} "
+                  f"{t_enc / n * 1e6:11.1f} {t_dec / n * 1e6:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
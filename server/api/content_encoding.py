@@ -0,0 +1,210 @@
+# content_encoding.py
+# Content-Encoding (zstd, br, gzip) of responses chosen by Accept-Encoding
+#
+# gzip: zlib (always available)
+# br:   brotli package (optional)
+# zstd: zstandard package or compression.zstd of Python 3.14 (optional)
+from __future__ import annotations
+from typing import AsyncIterator, Dict, List, Optional, Union
+import asyncio
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+std_zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+    try:
+        from compression import zstd as std_zstd
+    except ImportError:
+        pass
+
+# compressed in a thread (zlib, brotli and zstd release the GIL)
+THREAD_MIN_SIZE = 256 * 1024
+
+# media types of text (others, ex. image/png and application/zip,
+# are already compressed or unknown)
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "application/x-gfarm-columnar-ndjson",
+    "application/xml",
+    "application/javascript",
+    "application/x-javascript",
+    "application/x-sh",
+    "application/x-csh",
+    "application/x-tex",
+    "application/x-latex",
+    "application/postscript",
+    "application/x-python-code",
+    "image/svg+xml",
+}
+
+
+def available_encodings() -> List[str]:
+    encodings = []
+    if zstandard is not None or std_zstd is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def is_compressible(media_type: Optional[str]) -> bool:
+    if not media_type:
+        return False
+    media_type = media_type.split(";", 1)[0].strip().lower()
+    return (media_type.startswith("text/")
+            or media_type in COMPRESSIBLE_TYPES
+            or media_type.endswith("+json")
+            or media_type.endswith("+xml"))
+
+
+def parse_accept_encoding(value: Optional[str]) -> Dict[str, float]:
+    """
+    "gzip, br;q=0.5, *;q=0" -> {"gzip": 1.0, "br": 0.5, "*": 0.0}
+    """
+    accepted = {}
+    if not value:
+        return accepted
+    for item in value.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, v = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(v.strip())
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(accept_encoding: Optional[str],
+                    encodings: List[str]) -> Optional[str]:
+    """
+    The first of encodings (in order of preference of the server)
+    accepted by the client with the highest q-value.
+    None: identity.
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    wildcard = accepted.get("*")
+    best = None
+    best_q = 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, wildcard)
+        if q is not None and q > best_q:
+            best = encoding
+            best_q = q
+    return best
+
+
+def encoded_etag(etag: Optional[str], encoding: Optional[str]):
+    """
+    ETag of the encoded representation: "tag" -> "tag-gzip"
+    """
+    if etag is None or encoding is None or not etag.endswith('"'):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        self._c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.compress(data)
+
+    def flush(self) -> bytes:
+        return self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._c.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor:
+    def __init__(self, level: int):
+        self._c = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.process(data)
+
+    def flush(self) -> bytes:
+        return self._c.flush()
+
+    def finish(self) -> bytes:
+        return self._c.finish()
+
+
+class _ZstdCompressor:
+    def __init__(self, level: int):
+        if zstandard is not None:
+            self._c = zstandard.ZstdCompressor(level=level).compressobj()
+            self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._c = std_zstd.ZstdCompressor(level=level)
+            self._flush_block = std_zstd.ZstdCompressor.FLUSH_BLOCK
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.compress(data)
+
+    def flush(self) -> bytes:
+        return self._c.flush(self._flush_block)
+
+    def finish(self) -> bytes:
+        return self._c.flush()
+
+
+def compressor(encoding: str, level: int):
+    if encoding == "gzip":
+        return _GzipCompressor(level)
+    if encoding == "br" and brotli is not None:
+        return _BrotliCompressor(level)
+    if encoding == "zstd" and (zstandard is not None or std_zstd is not None):
+        return _ZstdCompressor(level)
+    raise ValueError(f"unsupported encoding: {encoding}")
+
+
+def compress_bytes(data: bytes, encoding: str, level: int) -> bytes:
+    c = compressor(encoding, level)
+    return c.compress(data) + c.finish()
+
+
+async def compress_stream(chunks: AsyncIterator[Union[bytes, str]],
+                          encoding: str, level: int,
+                          flush_each: bool = False):
+    """
+    Compressed chunks of the stream (without buffering the whole body).
+    flush_each=True: each chunk (ex. a frame of NDJSON) can be
+    decompressed as soon as it is received.
+    """
+    c = compressor(encoding, level)
+    try:
+        async for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if len(chunk) >= THREAD_MIN_SIZE:
+                out = await asyncio.to_thread(c.compress, chunk)
+            else:
+                out = c.compress(chunk)
+            if flush_each:
+                out += c.flush()
+            if out:
+                yield out
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    out = c.finish()
+    if out:
+        yield out
@@ -0,0 +1,294 @@
+# dir_columnar.py
+# Columnar NDJSON of GET /dir (output_format=columnar or
+# Accept: application/x-gfarm-columnar-ndjson)
+#
+# line 1:  {"columns": [...], "dictionary": [...]}
+# blocks:  {"n": <number of entries>,
+#           "dict": {<column>: [<new values>, ...], ...},
+#           "data": [[<values of columns[0]>], [<columns[1]>], ...]}
+# others:  {"line": "<line of gfls>"}
+#          {"error": "<message>", "err_code": <HTTP status>}
+#
+# Values of "dictionary" columns are indexes to the list of values
+# of the column (the values added by "dict" of this and all earlier
+# blocks).  "dir" is the directory of the entry:
+#   path = dir                 if name is "."
+#          dir + name          if dir ends with "/"
+#          dir + "/" + name    otherwise
+# unless "path" is not null.  is_file, is_dir and is_sym are
+# from the first character of mode_str ("d": directory, "l": symlink).
+# Decoded entries are same as output_format=json.
+#
+# A block is sent when block_size entries are added, or flush_delay
+# seconds after the first entry of the block (ex. slow listing).
+from __future__ import annotations
+from typing import AsyncIterator, Iterable, Iterator, Optional
+import asyncio
+import contextlib
+import json
+
+import ndjson_stream
+
+MEDIA_TYPE = "application/x-gfarm-columnar-ndjson"
+
+COLUMNS = ("name", "dir", "path", "mode_str", "linkname", "nlink",
+           "uname", "gname", "size", "mtime", "perms")
+DICTIONARY = ("dir", "mode_str", "uname", "gname", "perms")
+
+# keys of Gfls_Entry.json_dump()
+ENTRY_KEYS = ("mode_str", "is_file", "is_dir", "is_sym", "linkname",
+              "nlink", "uname", "gname", "size", "mtime", "name", "path",
+              "perms")
+
+
+def accepted(accept: Optional[str]) -> bool:
+    """
+    True if Accept prefers MEDIA_TYPE (q-value is not less than others)
+    """
+    if not accept:
+        return False
+    qvalues = {}
+    for item in accept.split(","):
+        media_type, _, params = item.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[media_type.strip().lower()] = q
+    q = qvalues.pop(MEDIA_TYPE, 0.0)
+    return q > 0 and all(q >= other for other in qvalues.values())
+
+
+def join_path(dirname: str, name: str) -> str:
+    if name == ".":
+        return dirname
+    if dirname.endswith("/"):
+        return dirname + name
+    return dirname + "/" + name
+
+
+def split_path(path: Optional[str], name: Optional[str]):
+    """
+    (dir, None) or (None, path) if path is not join_path(dir, name)
+    """
+    if path is None or name is None:
+        return None, path
+    if name == ".":
+        dirname = path
+    elif path.endswith("/" + name):
+        dirname = path[:-len(name) - 1] or "/"
+    else:
+        return None, path
+    if join_path(dirname, name) != path:
+        return None, path
+    return dirname, None
+
+
+class ColumnarEncoder:
+    def __init__(self, block_size: int = 1000):
+        self.block_size = block_size
+        self._index = {key: {} for key in DICTIONARY}
+        self._new = {key: [] for key in DICTIONARY}
+        self._data = [[] for _ in COLUMNS]
+        self._n = 0
+
+    @property
+    def pending(self) -> int:
+        # entries not flushed yet
+        return self._n
+
+    def header(self) -> str:
+        return ndjson_stream.dumps({"columns": list(COLUMNS),
+                                    "dictionary": list(DICTIONARY)}) + "\n"
+
+    def _code(self, key, value) -> int:
+        index = self._index[key]
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(index)
+            self._new[key].append(value)
+        return code
+
+    def add(self, entry: dict) -> str:
+        """
+        entry: Gfls_Entry.json_dump()
+        Returns a block line if block_size entries are added,
+        otherwise "".
+        """
+        name = entry["name"]
+        dirname, path = split_path(entry["path"], name)
+        code = self._code
+        values = (name,
+                  None if dirname is None else code("dir", dirname),
+                  path,
+                  code("mode_str", entry["mode_str"]),
+                  entry["linkname"],
+                  entry["nlink"],
+                  code("uname", entry["uname"]),
+                  code("gname", entry["gname"]),
+                  entry["size"],
+                  entry["mtime"],
+                  code("perms", entry["perms"]))
+        for column, value in zip(self._data, values):
+            column.append(value)
+        self._n += 1
+        if self._n >= self.block_size:
+            return self.flush()
+        return ""
+
+    def add_line(self, obj: dict) -> str:
+        """
+        obj: {"line": ...} or {"error": ...} after the entries so far
+        """
+        return self.flush() + ndjson_stream.dumps(obj) + "\n"
+
+    def flush(self) -> str:
+        if self._n == 0:
+            return ""
+        new = {key: values for key, values in self._new.items() if values}
+        block = {"n": self._n, "dict": new, "data": self._data}
+        line = ndjson_stream.dumps(block) + "\n"
+        self._new = {key: [] for key in DICTIONARY}
+        self._data = [[] for _ in COLUMNS]
+        self._n = 0
+        return line
+
+
+class _Blocks:
+    def __init__(self, items: AsyncIterator[dict],
+                 encoder: ColumnarEncoder, flush_delay: float):
+        self.items = items
+        self.encoder = encoder
+        self.flush_delay = flush_delay
+        self.out: list = []
+        self.since: Optional[float] = None  # the first pending entry
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.ready = asyncio.Event()  # out, finished or since was set
+        self.space = asyncio.Event()  # out was taken
+        self.space.set()
+
+    async def produce(self) -> None:
+        loop = asyncio.get_running_loop()
+        encoder = self.encoder
+        try:
+            async for item in self.items:
+                if "name" in item:
+                    line = encoder.add(item)
+                else:
+                    line = encoder.add_line(item)
+                if encoder.pending == 0:
+                    self.since = None
+                elif self.since is None:
+                    self.since = loop.time()
+                    self.ready.set()  # start the timer
+                if line:
+                    self.out.append(line)
+                    self.ready.set()
+                    # wait until the block is sent (backpressure)
+                    self.space.clear()
+                    await self.space.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self.ready.set()
+            aclose = getattr(self.items, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            timeout = None
+            if self.since is not None:
+                timeout = max(0.0, self.since + self.flush_delay - loop.time())
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                # slow source: send the pending entries
+                self.since = None
+                yield self.encoder.flush()
+                continue
+            if not self.out:
+                if self.finished:
+                    break
+                self.ready.clear()
+                continue
+            lines = "".join(self.out)
+            self.out = []
+            if not self.finished:
+                self.ready.clear()
+            self.space.set()
+            yield lines
+        if self.error is not None:
+            # the pending entries are left (ex. add_line() of an error)
+            raise self.error
+        yield self.encoder.flush()
+
+
+async def encode_stream(items: AsyncIterator[dict],
+                        encoder: Optional[ColumnarEncoder] = None,
+                        flush_delay: float = 0.02):
+    """
+    Columnar lines (the header and blocks) of items
+    (Gfls_Entry.json_dump(), or {"line": ...}).
+    An exception of items is raised after the blocks so far.
+    """
+    if encoder is None:
+        encoder = ColumnarEncoder()
+    yield encoder.header()
+    b = _Blocks(items, encoder, flush_delay)
+    task = asyncio.create_task(b.produce())
+    try:
+        async for lines in b.consume():
+            if lines:
+                yield lines
+    finally:
+        if not task.done():
+            task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+def decode(lines: Iterable[str]) -> Iterator[dict]:
+    """
+    Entries (same as output_format=json) and other objects
+    ({"line": ...}, {"error": ...}) from the lines.
+    """
+    columns = list(COLUMNS)
+    values = {key: [] for key in DICTIONARY}
+    for line in lines:
+        if not line.strip():
+            continue
+        obj = json.loads(line)
+        if "columns" in obj:
+            columns = obj["columns"]
+            values = {key: [] for key in obj.get("dictionary", [])}
+            continue
+        if "n" not in obj:
+            yield obj
+            continue
+        for key, new in obj.get("dict", {}).items():
+            values[key].extend(new)
+        data = dict(zip(columns, obj["data"]))
+        for i in range(obj["n"]):
+            row = {}
+            for key, column in data.items():
+                value = column[i]
+                if key in values and value is not None:
+                    value = values[key][value]
+                row[key] = value
+            mode_str = row.get("mode_str") or ""
+            is_dir = mode_str.startswith("d")
+            is_sym = mode_str.startswith("l")
+            path = row.get("path")
+            if path is None and row.get("dir") is not None:
+                path = join_path(row["dir"], row["name"])
+            row.update(path=path, is_file=not is_dir and not is_sym,
+                       is_dir=is_dir, is_sym=is_sym)
+            yield {key: row.get(key) for key in ENTRY_KEYS}
@@ -0,0 +1,240 @@
+# dir_filter.py
+# Filter, sort and top-K of entries from gfls_generator()
+from __future__ import annotations
+from typing import AsyncIterator, Callable, List, Optional
+import fnmatch
+import heapq
+import re
+try:
+    from re import _parser as sre_parse  # Python 3.11 or later
+except ImportError:
+    import sre_parse
+
+from gfls_entry import Gfls_Entry
+
+ENTRY_TYPES = ("file", "dir", "link")
+SORT_KEYS = ("name", "path", "size", "mtime")
+
+# The regex is matched in the event loop, so patterns that may take
+# a long time (catastrophic backtracking) are rejected:
+# - longer than REGEX_MAX_LENGTH
+# - more than REGEX_MAX_REPEATS repetitions (ex. "a.*b.*c")
+# - a repetition in a repetition (ex. "(a+)+"),
+#   an alternation in a repetition (ex. "(a|ab)*"), backreferences
+REGEX_MAX_LENGTH = 256
+REGEX_MAX_REPEATS = 3
+
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+if hasattr(sre_parse, "POSSESSIVE_REPEAT"):
+    _REPEATS.add(sre_parse.POSSESSIVE_REPEAT)
+_GROUPREFS = {sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS}
+for _name in ("GROUPREF_IGNORE", "GROUPREF_LOC_IGNORE", "GROUPREF_UNI_IGNORE"):
+    if hasattr(sre_parse, _name):
+        _GROUPREFS.add(getattr(sre_parse, _name))
+
+
+def _subpatterns(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (tuple, list)):
+        for v in av:
+            yield from _subpatterns(v)
+
+
+def _count_repeats(pattern, in_repeat: bool) -> int:
+    n = 0
+    for op, av in pattern:
+        if op in _GROUPREFS:
+            raise ValueError("backreferences are not allowed")
+        repeat = op in _REPEATS and av[1] > 1
+        if repeat:
+            if in_repeat:
+                raise ValueError("nested repetitions are not allowed")
+            n += 1
+        elif op is sre_parse.BRANCH and in_repeat:
+            raise ValueError("alternations in a repetition are not allowed")
+        for sub in _subpatterns(av):
+            n += _count_repeats(sub, in_repeat or repeat)
+    return n
+
+
+def compile_regex(regex: str) -> re.Pattern:
+    """
+    Raises ValueError for invalid or too complex regex.
+    """
+    if len(regex) > REGEX_MAX_LENGTH:
+        raise ValueError(f"regex is too long (max {REGEX_MAX_LENGTH})")
+    try:
+        parsed = sre_parse.parse(regex)
+        if _count_repeats(parsed, False) > REGEX_MAX_REPEATS:
+            raise ValueError(
+                f"too many repetitions (max {REGEX_MAX_REPEATS})")
+        return re.compile(regex)
+    except re.error as e:
+        raise ValueError(f"invalid regex: {e}")
+
+
+class DirFilter:
+    """
+    Conditions of entries (all of specified conditions must match).
+    Raises ValueError for invalid pattern or regex.
+    """
+    def __init__(self,
+                 pattern: Optional[str] = None,
+                 regex: Optional[str] = None,
+                 entry_type: Optional[str] = None,
+                 min_size: Optional[int] = None,
+                 max_size: Optional[int] = None,
+                 min_mtime: Optional[float] = None,
+                 max_mtime: Optional[float] = None,
+                 uname: Optional[str] = None,
+                 gname: Optional[str] = None):
+        self.pattern = pattern
+        self.regex = regex
+        self.entry_type = entry_type
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_mtime = min_mtime
+        self.max_mtime = max_mtime
+        self.uname = uname
+        self.gname = gname
+        if entry_type is not None and entry_type not in ENTRY_TYPES:
+            raise ValueError(f"invalid type: {entry_type}")
+        # glob matches the whole name (case-sensitive)
+        self._pattern = None
+        if pattern is not None:
+            self._pattern = re.compile(fnmatch.translate(pattern))
+        self._regex = None
+        if regex is not None:
+            self._regex = compile_regex(regex)
+
+    def active(self) -> bool:
+        return any(v is not None for v in (
+            self.pattern, self.regex, self.entry_type, self.min_size,
+            self.max_size, self.min_mtime, self.max_mtime, self.uname,
+            self.gname))
+
+    def describe(self) -> str:
+        return (f"{self.pattern},{self.regex},{self.entry_type},"
+                f"{self.min_size},{self.max_size},"
+                f"{self.min_mtime},{self.max_mtime},"
+                f"{self.uname},{self.gname}")
+
+    def match(self, entry: Gfls_Entry) -> bool:
+        name = entry.name or ""
+        if self._pattern is not None and not self._pattern.match(name):
+            return False
+        if self._regex is not None and not self._regex.search(name):
+            return False
+        if self.entry_type is not None:
+            if entry.is_dir:
+                t = "dir"
+            elif entry.is_sym:
+                t = "link"
+            else:
+                t = "file"
+            if t != self.entry_type:
+                return False
+        size = entry.size or 0
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        mtime = entry.mtime or 0
+        if self.min_mtime is not None and mtime < self.min_mtime:
+            return False
+        if self.max_mtime is not None and mtime > self.max_mtime:
+            return False
+        if self.uname is not None and entry.uname != self.uname:
+            return False
+        if self.gname is not None and entry.gname != self.gname:
+            return False
+        return True
+
+
+def sort_key_func(key: str) -> Callable[[Gfls_Entry], object]:
+    if key not in SORT_KEYS:
+        raise ValueError(f"invalid sort key: {key}")
+    if key in ("name", "path"):
+        return lambda e: getattr(e, key) or ""
+    return lambda e: getattr(e, key) or 0
+
+
+async def filter_entries(entries: AsyncIterator, dir_filter: DirFilter):
+    """
+    Lines other than Gfls_Entry (ex. error messages) are passed through.
+    """
+    match = dir_filter.match
+    try:
+        async for entry in entries:
+            if not isinstance(entry, Gfls_Entry) or match(entry):
+                yield entry
+    finally:
+        await entries.aclose()
+
+
+class _Reverse:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+async def sort_entries(entries: AsyncIterator, key: str,
+                       reverse: bool, top: int) -> List:
+    """
+    Same as sorted(entries, key=key, reverse=reverse)[:top]
+    (stable), but only top entries are kept in memory (heap).
+    Lines other than Gfls_Entry are placed first.
+    """
+    if top is None or top < 1:
+        # the whole listing must not be buffered
+        raise ValueError("top must be a positive integer")
+    keyfunc = sort_key_func(key)
+    others = []
+    # heap of (priority, entry): the root is the first to be dropped.
+    # priority includes seq (unique), so entries are never compared.
+    heap: list = []
+    seq = 0
+    async for entry in entries:
+        if not isinstance(entry, Gfls_Entry):
+            others.append(entry)
+            continue
+        seq += 1
+        if reverse:
+            # largest first; earlier first for the same key
+            priority = (keyfunc(entry), -seq)
+        else:
+            priority = _Reverse((keyfunc(entry), seq))
+        item = (priority, entry)
+        if len(heap) < top:
+            heapq.heappush(heap, item)
+        elif heap[0] < item:
+            heapq.heapreplace(heap, item)
+    heap.sort(reverse=True)
+    return others + [entry for _, entry in heap]
+
+
+async def sorted_entries(entries: AsyncIterator, key: str,
+                         reverse: bool, top: int):
+    for entry in await sort_entries(entries, key, reverse, top):
+        yield entry
+
+
+async def limit_entries(entries, top: int):
+    """
+    First top entries.  The rest of entries (gfls) is stopped.
+    """
+    count = 0
+    try:
+        async for entry in entries:
+            yield entry
+            if isinstance(entry, Gfls_Entry):
+                count += 1
+                if count >= top:
+                    break
+    finally:
+        await entries.aclose()
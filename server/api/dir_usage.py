@@ -0,0 +1,156 @@
+# dir_usage.py
+# Disk usage (size and number of entries) per directory from the
+# entries of a recursive listing (gfls -R or RecursiveWalker ordered)
+#
+# The entries of a directory are followed by its subdirectories
+# (preorder), so a directory is complete when the listing moves out of
+# it.  Only the directories from the root to the current one are kept
+# (memory is proportional to the depth of the tree, not the number of
+# entries, and the subdirectories of directories up to max_depth).
+# Totals of directories are output in postorder (children before the
+# parent, the root directory last).
+from __future__ import annotations
+from typing import AsyncIterator, Callable, List
+import time
+
+from gfls_entry import Gfls_Entry
+
+
+class _Usage:
+    __slots__ = ("path", "depth", "size", "files", "dirs", "empty")
+
+    def __init__(self, path: str, depth: int):
+        self.path = path
+        self.depth = depth
+        self.size = 0
+        self.files = 0  # not directories (including symlinks)
+        self.dirs = 0
+        # subdirectories not listed yet (output as zero if empty)
+        self.empty: List[str] = []
+
+    def add(self, other: _Usage) -> None:
+        self.size += other.size
+        self.files += other.files
+        self.dirs += other.dirs
+
+    def dump(self) -> dict:
+        return {"path": self.path, "depth": self.depth, "size": self.size,
+                "files": self.files, "dirs": self.dirs}
+
+
+def _contains(dirpath: str, path: str) -> bool:
+    return path == dirpath or path.startswith(dirpath.rstrip("/") + "/")
+
+
+class DiskUsage:
+    """
+    max_depth: totals of directories deeper than max_depth are not
+               output (but included in their parents)
+    """
+    def __init__(self, root: str, max_depth: int = 1):
+        self.max_depth = max_depth
+        self.total = _Usage(root, 0)  # all entries so far
+        self._stack: List[_Usage] = [_Usage(root, 0)]
+
+    @property
+    def current(self) -> str:
+        return self._stack[-1].path
+
+    def _pop(self, out: list) -> None:
+        node = self._stack.pop()
+        for path in node.empty:
+            out.append(_Usage(path, node.depth + 1).dump())
+        if node.depth <= self.max_depth:
+            out.append(node.dump())
+        if self._stack:
+            self._stack[-1].add(node)
+
+    def add(self, entry: Gfls_Entry) -> List[dict]:
+        """
+        Totals of the directories completed before the entry.
+        """
+        out = []
+        if entry.name in (".", ".."):
+            return out
+        root = self._stack[0].path
+        if entry.path == root:
+            # the root is a file
+            dirname = root
+        else:
+            dirname = entry.dirname
+            if dirname is None or not _contains(root, dirname):
+                return out
+        while len(self._stack) > 1 and not _contains(self.current, dirname):
+            self._pop(out)
+        while self.current != dirname:
+            # subdirectory (and the parents without entries)
+            parent = self._stack[-1]
+            rest = dirname[len(parent.path.rstrip("/")) + 1:]
+            child = parent.path.rstrip("/") + "/" + rest.split("/", 1)[0]
+            if parent.empty and parent.empty[0] == child:
+                parent.empty.pop(0)
+            elif child in parent.empty:
+                parent.empty.remove(child)
+            self._stack.append(_Usage(child, parent.depth + 1))
+        node = self._stack[-1]
+        if entry.is_dir:
+            node.dirs += 1
+            self.total.dirs += 1
+            if node.depth < self.max_depth and entry.path is not None:
+                node.empty.append(entry.path)
+        else:
+            size = entry.size or 0
+            node.files += 1
+            node.size += size
+            self.total.files += 1
+            self.total.size += size
+        return out
+
+    def finish(self) -> List[dict]:
+        """
+        Totals of the remaining directories (the root directory last).
+        """
+        out = []
+        while self._stack:
+            self._pop(out)
+        return out
+
+    def progress(self) -> dict:
+        """
+        Partial totals of all entries so far.
+        """
+        return {"progress": True, "path": self.current,
+                "size": self.total.size, "files": self.total.files,
+                "dirs": self.total.dirs}
+
+
+async def disk_usage(entries: AsyncIterator, root: str,
+                     max_depth: int = 1,
+                     progress_interval: float = 1.0,
+                     clock: Callable[[], float] = time.monotonic):
+    """
+    Totals of directories (dict) from the entries of a recursive
+    listing of root.  DiskUsage.progress() is output every
+    progress_interval seconds (<= 0: not output).
+    The entries are closed (aclose) when this generator is closed
+    (ex. disconnected).
+    """
+    usage = DiskUsage(root, max_depth)
+    last = clock()
+    try:
+        async for entry in entries:
+            if not isinstance(entry, Gfls_Entry):
+                continue
+            for record in usage.add(entry):
+                yield record
+            if progress_interval > 0:
+                now = clock()
+                if now - last >= progress_interval:
+                    last = now
+                    yield usage.progress()
+    finally:
+        aclose = getattr(entries, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    for record in usage.finish():
+        yield record
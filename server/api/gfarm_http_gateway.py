@@ -2,7 +2,10 @@ import asyncio
 import base64
 import bz2
 from datetime import datetime
+import email.utils
 import gzip
+import hashlib
+import ipaddress
 import json
 import logging
 from logging.handlers import SysLogHandler
@@ -63,7 +66,26 @@ from starlette.middleware.sessions import SessionMiddleware
 
 from cryptography.fernet import Fernet
 
-from redis_client import RedisClient
+from redis_client import RedisClient, MemoryRedisClient
+from gfarm_worker import GfarmWorkerPool
+from ttl_cache import TTLCache
+from refresher import Refresher
+import session_codec
+from http_client import SharedTransport, http2_available
+from listing_snapshot import ListingSnapshotStore, SnapshotNotFound
+import ndjson_stream
+import content_encoding
+from gfls_entry import Gfls_Entry
+from gfls_walker import RecursiveWalker
+from dir_filter import (DirFilter, filter_entries, sorted_entries,
+                        limit_entries)
+import dir_columnar
+from dir_usage import disk_usage
+from dir_columnar import ColumnarEncoder
+import metrics
+from gfarm_scheduler import (GfarmScheduler, SchedulerBusy,
+                             RequestSlotsMiddleware,
+                             LANE_INTERACTIVE, LANE_BULK)
 
 # https://github.com/mpdavis/python-jose/blob/master/jose/jwt.py
 from jose import jwt
@@ -266,9 +288,204 @@ except Exception as e:
     logger.warning("Invalid value for SESSION_MAX_AGE: " + str(e))
     RECURSIVE_MAX_DEPTH = 16
 
+try:
+    RECURSIVE_PARALLEL = int(conf.GFARM_HTTP_RECURSIVE_PARALLEL)
+except Exception:
+    RECURSIVE_PARALLEL = 4
+try:
+    RECURSIVE_MAX_BUFFERED = int(conf.GFARM_HTTP_RECURSIVE_MAX_BUFFERED)
+except Exception:
+    RECURSIVE_MAX_BUFFERED = 10000
+try:
+    DU_PROGRESS_INTERVAL = float(conf.GFARM_HTTP_DU_PROGRESS_INTERVAL)
+except Exception:
+    DU_PROGRESS_INTERVAL = 1.0  # sec.
+
+try:
+    GFARM_WORKER = str2bool(conf.GFARM_HTTP_GFARM_WORKER)
+except Exception:
+    GFARM_WORKER = True
+try:
+    GFARM_WORKER_IDLE_TIMEOUT = float(
+        conf.GFARM_HTTP_GFARM_WORKER_IDLE_TIMEOUT)
+except Exception:
+    GFARM_WORKER_IDLE_TIMEOUT = 30.0  # sec.
+try:
+    GFARM_WORKER_MAX_BATCH = int(conf.GFARM_HTTP_GFARM_WORKER_MAX_BATCH)
+except Exception:
+    GFARM_WORKER_MAX_BATCH = 64
+try:
+    GFARM_WORKER_MAX_INFLIGHT = int(conf.GFARM_HTTP_GFARM_WORKER_MAX_INFLIGHT)
+except Exception:
+    GFARM_WORKER_MAX_INFLIGHT = 2
+
+try:
+    SCHED_MAX_PROCS = int(conf.GFARM_HTTP_SCHED_MAX_PROCS)
+except Exception:
+    SCHED_MAX_PROCS = 64
+try:
+    SCHED_MAX_BULK_PROCS = int(conf.GFARM_HTTP_SCHED_MAX_BULK_PROCS)
+except Exception:
+    SCHED_MAX_BULK_PROCS = 32
+try:
+    SCHED_MAX_PROCS_PER_REQUEST = int(
+        conf.GFARM_HTTP_SCHED_MAX_PROCS_PER_REQUEST)
+except Exception:
+    SCHED_MAX_PROCS_PER_REQUEST = 8
+try:
+    SCHED_INTERACTIVE_WEIGHT = float(conf.GFARM_HTTP_SCHED_INTERACTIVE_WEIGHT)
+except Exception:
+    SCHED_INTERACTIVE_WEIGHT = 4.0
+try:
+    # "user1:2,user2:0.5"
+    SCHED_USER_WEIGHTS = {}
+    for item in conf.GFARM_HTTP_SCHED_USER_WEIGHTS.split(","):
+        if item.strip():
+            u, w = item.rsplit(":", 1)
+            SCHED_USER_WEIGHTS[u.strip()] = float(w)
+except Exception:
+    SCHED_USER_WEIGHTS = {}
+try:
+    SCHED_MAX_QUEUE = int(conf.GFARM_HTTP_SCHED_MAX_QUEUE)
+except Exception:
+    SCHED_MAX_QUEUE = 1024
+try:
+    SCHED_MAX_QUEUE_PER_USER = int(conf.GFARM_HTTP_SCHED_MAX_QUEUE_PER_USER)
+except Exception:
+    SCHED_MAX_QUEUE_PER_USER = 128
+try:
+    SCHED_QUEUE_TIMEOUT = float(conf.GFARM_HTTP_SCHED_QUEUE_TIMEOUT)
+except Exception:
+    SCHED_QUEUE_TIMEOUT = 60.0  # sec.
+try:
+    SCHED_RETRY_AFTER = int(conf.GFARM_HTTP_SCHED_RETRY_AFTER)
+except Exception:
+    SCHED_RETRY_AFTER = 5  # sec.
+
+try:
+    STAT_CACHE_TTL = float(conf.GFARM_HTTP_STAT_CACHE_TTL)
+except Exception:
+    STAT_CACHE_TTL = 5.0  # sec.
+try:
+    STAT_CACHE_SIZE = int(conf.GFARM_HTTP_STAT_CACHE_SIZE)
+except Exception:
+    STAT_CACHE_SIZE = 10000
+try:
+    IDENTITY_CACHE_TTL = float(conf.GFARM_HTTP_IDENTITY_CACHE_TTL)
+except Exception:
+    IDENTITY_CACHE_TTL = 600.0  # sec.
+try:
+    IDENTITY_CACHE_SIZE = int(conf.GFARM_HTTP_IDENTITY_CACHE_SIZE)
+except Exception:
+    IDENTITY_CACHE_SIZE = 1000
+try:
+    TOKEN_VERIFY_CACHE_SIZE = int(conf.GFARM_HTTP_TOKEN_VERIFY_CACHE_SIZE)
+except Exception:
+    TOKEN_VERIFY_CACHE_SIZE = 10000
+try:
+    TOKEN_VERIFY_CACHE_TTL = float(conf.GFARM_HTTP_TOKEN_VERIFY_CACHE_TTL)
+except Exception:
+    TOKEN_VERIFY_CACHE_TTL = 3600.0  # sec.
+try:
+    SESSION_COOKIE_FORMAT = conf.GFARM_HTTP_SESSION_COOKIE_FORMAT.lower()
+except Exception:
+    SESSION_COOKIE_FORMAT = "v2"
+try:
+    SESSION_DECODE_CACHE_SIZE = int(conf.GFARM_HTTP_SESSION_DECODE_CACHE_SIZE)
+except Exception:
+    SESSION_DECODE_CACHE_SIZE = 1000
+try:
+    SESSION_DECODE_CACHE_TTL = float(conf.GFARM_HTTP_SESSION_DECODE_CACHE_TTL)
+except Exception:
+    SESSION_DECODE_CACHE_TTL = 60.0  # sec.
+try:
+    METRICS = str2bool(conf.GFARM_HTTP_METRICS)
+except Exception:
+    METRICS = False
+try:
+    METRICS_TOKEN = conf.GFARM_HTTP_METRICS_TOKEN or None
+except Exception:
+    METRICS_TOKEN = None
+try:
+    METRICS_ALLOW = [ipaddress.ip_network(net.strip(), strict=False)
+                     for net in conf.GFARM_HTTP_METRICS_ALLOW.split(",")
+                     if net.strip()]
+except Exception:
+    METRICS_ALLOW = []
+try:
+    STAT_BATCH_PARALLEL = int(conf.GFARM_HTTP_STAT_BATCH_PARALLEL)
+except Exception:
+    STAT_BATCH_PARALLEL = 4
+try:
+    STAT_BATCH_MAX_PATHS = int(conf.GFARM_HTTP_STAT_BATCH_MAX_PATHS)
+except Exception:
+    STAT_BATCH_MAX_PATHS = 10000
+try:
+    DIR_ETAG = str2bool(conf.GFARM_HTTP_DIR_ETAG)
+except Exception:
+    DIR_ETAG = False
+try:
+    CACHE_CONTROL_FILE = str2none(conf.GFARM_HTTP_CACHE_CONTROL_FILE)
+except Exception:
+    CACHE_CONTROL_FILE = "private, no-cache"
+try:
+    CACHE_CONTROL_DIR = str2none(conf.GFARM_HTTP_CACHE_CONTROL_DIR)
+except Exception:
+    CACHE_CONTROL_DIR = "private, no-cache"
+try:
+    CACHE_CONTROL_ATTR = str2none(conf.GFARM_HTTP_CACHE_CONTROL_ATTR)
+except Exception:
+    CACHE_CONTROL_ATTR = "private, no-cache"
+try:
+    DIR_SNAPSHOT_TTL = float(conf.GFARM_HTTP_DIR_SNAPSHOT_TTL)
+except Exception:
+    DIR_SNAPSHOT_TTL = 600.0  # sec.
+try:
+    DIR_PAGE_MAX = int(conf.GFARM_HTTP_DIR_PAGE_MAX)
+except Exception:
+    DIR_PAGE_MAX = 10000
+
+try:
+    STREAM_FRAME_BYTES = int(conf.GFARM_HTTP_STREAM_FRAME_BYTES)
+except Exception:
+    STREAM_FRAME_BYTES = 65536
+try:
+    STREAM_FRAME_DELAY = float(conf.GFARM_HTTP_STREAM_FRAME_DELAY)
+except Exception:
+    STREAM_FRAME_DELAY = 0.02  # sec.
+
+try:
+    COMPRESS_ENCODINGS = [e.strip() for e in
+                          str2list(conf.GFARM_HTTP_COMPRESS_ENCODINGS)
+                          if e.strip()]
+except Exception:
+    COMPRESS_ENCODINGS = ["zstd", "br", "gzip"]
+COMPRESS_ENCODINGS = [e for e in COMPRESS_ENCODINGS
+                      if e in content_encoding.available_encodings()]
+try:
+    COMPRESS_GZIP_LEVEL = int(conf.GFARM_HTTP_COMPRESS_GZIP_LEVEL)
+except Exception:
+    COMPRESS_GZIP_LEVEL = 6
+try:
+    COMPRESS_BR_LEVEL = int(conf.GFARM_HTTP_COMPRESS_BR_LEVEL)
+except Exception:
+    COMPRESS_BR_LEVEL = 4
+try:
+    COMPRESS_ZSTD_LEVEL = int(conf.GFARM_HTTP_COMPRESS_ZSTD_LEVEL)
+except Exception:
+    COMPRESS_ZSTD_LEVEL = 3
+COMPRESS_LEVELS = {"gzip": COMPRESS_GZIP_LEVEL,
+                   "br": COMPRESS_BR_LEVEL,
+                   "zstd": COMPRESS_ZSTD_LEVEL}
+try:
+    COMPRESS_MIN_SIZE = int(conf.GFARM_HTTP_COMPRESS_MIN_SIZE)
+except Exception:
+    COMPRESS_MIN_SIZE = 1024
+
 TMPDIR = conf.GFARM_HTTP_TMPDIR
 TMPDIR_TOKENS = os.path.join(TMPDIR, "tokens")
 TMPDIR_TARTMP = os.path.join(TMPDIR, "tartmp")
+TMPDIR_LISTING = os.path.join(TMPDIR, "listing")
 
 # always use Redis as Token Store
 TOKEN_STORE = "database"  # "session" | "database"
@@ -327,6 +544,56 @@ try:
     REDIS_LOCK_INTERVAL = float(conf.GFARM_HTTP_REDIS_LOCK_INTERVAL)  # seconds
 except Exception:
     REDIS_LOCK_INTERVAL = 1.0
+try:
+    REDIS_BACKEND = conf.GFARM_HTTP_REDIS_BACKEND.lower()
+except Exception:
+    REDIS_BACKEND = "redis"  # "redis" | "memory"
+try:
+    REDIS_MAX_CONNECTIONS = int(conf.GFARM_HTTP_REDIS_MAX_CONNECTIONS)
+except Exception:
+    REDIS_MAX_CONNECTIONS = 50
+try:
+    REDIS_SOCKET_TIMEOUT = float(conf.GFARM_HTTP_REDIS_SOCKET_TIMEOUT)
+except Exception:
+    REDIS_SOCKET_TIMEOUT = 5.0  # sec.
+try:
+    REDIS_SOCKET_CONNECT_TIMEOUT = float(
+        conf.GFARM_HTTP_REDIS_SOCKET_CONNECT_TIMEOUT)
+except Exception:
+    REDIS_SOCKET_CONNECT_TIMEOUT = 5.0  # sec.
+try:
+    REDIS_HEALTH_CHECK_INTERVAL = int(
+        conf.GFARM_HTTP_REDIS_HEALTH_CHECK_INTERVAL)
+except Exception:
+    REDIS_HEALTH_CHECK_INTERVAL = 30  # sec.
+try:
+    REDIS_RETRY_ATTEMPTS = int(conf.GFARM_HTTP_REDIS_RETRY_ATTEMPTS)
+except Exception:
+    REDIS_RETRY_ATTEMPTS = 3
+try:
+    # "host1:port1,host2:port2"
+    REDIS_SENTINELS = []
+    for hostport in str2none(conf.GFARM_HTTP_REDIS_SENTINELS).split(","):
+        host, port = hostport.strip().rsplit(":", 1)
+        REDIS_SENTINELS.append((host, int(port)))
+except Exception:
+    REDIS_SENTINELS = []
+try:
+    REDIS_SENTINEL_SERVICE_NAME = conf.GFARM_HTTP_REDIS_SENTINEL_SERVICE_NAME
+except Exception:
+    REDIS_SENTINEL_SERVICE_NAME = "mymaster"
+try:
+    SESSION_STORE = conf.GFARM_HTTP_SESSION_STORE.lower()
+except Exception:
+    SESSION_STORE = "cookie"  # "cookie" | "server"
+try:
+    ACCESS_TOKEN_CACHE_SIZE = int(conf.GFARM_HTTP_ACCESS_TOKEN_CACHE_SIZE)
+except Exception:
+    ACCESS_TOKEN_CACHE_SIZE = 10000
+try:
+    ACCESS_TOKEN_CACHE_TTL = float(conf.GFARM_HTTP_ACCESS_TOKEN_CACHE_TTL)
+except Exception:
+    ACCESS_TOKEN_CACHE_TTL = 10.0  # sec.
 
 try:
     LOCAL_LOGFILE = str2none(conf.GFARM_HTTP_LOCAL_LOGFILE)
@@ -393,6 +660,47 @@ try:
 except Exception:
     HTTP_RETRY_INTERVAL = 0.5
 
+try:
+    OIDC_REFRESH_INTERVAL = float(conf.GFARM_HTTP_OIDC_REFRESH_INTERVAL)
+except Exception:
+    OIDC_REFRESH_INTERVAL = 600.0  # sec.
+
+try:
+    OIDC_REFETCH_MIN_INTERVAL = float(
+        conf.GFARM_HTTP_OIDC_REFETCH_MIN_INTERVAL)
+except Exception:
+    OIDC_REFETCH_MIN_INTERVAL = 10.0  # sec.
+
+try:
+    OIDC_REFRESH_BACKOFF_MAX = float(conf.GFARM_HTTP_OIDC_REFRESH_BACKOFF_MAX)
+except Exception:
+    OIDC_REFRESH_BACKOFF_MAX = 300.0  # sec.
+
+try:
+    HTTP_TIMEOUT = float(conf.GFARM_HTTP_OIDC_TIMEOUT)
+except Exception:
+    HTTP_TIMEOUT = 10.0  # sec.
+
+try:
+    HTTP_MAX_CONNECTIONS = int(conf.GFARM_HTTP_OIDC_MAX_CONNECTIONS)
+except Exception:
+    HTTP_MAX_CONNECTIONS = 100
+
+try:
+    HTTP_MAX_KEEPALIVE = int(conf.GFARM_HTTP_OIDC_MAX_KEEPALIVE)
+except Exception:
+    HTTP_MAX_KEEPALIVE = 20
+
+try:
+    HTTP_KEEPALIVE_EXPIRY = float(conf.GFARM_HTTP_OIDC_KEEPALIVE_EXPIRY)
+except Exception:
+    HTTP_KEEPALIVE_EXPIRY = 30.0  # sec.
+
+try:
+    HTTP2 = str2bool(conf.GFARM_HTTP_OIDC_HTTP2)
+except Exception:
+    HTTP2 = True
+
 GFARM_PREFIX = "gfarm"
 
 
@@ -415,6 +723,14 @@ def conf_check_invalid():
        and OIDC_REDIRECT_URI_PAGE != "auth":
         logger.error("INVALID: GFARM_HTTP_OIDC_REDIRECT_URI_PAGE")
         error = True
+    if SESSION_STORE not in ("cookie", "server"):
+        logger.error("INVALID: GFARM_HTTP_SESSION_STORE")
+        error = True
+    elif SESSION_STORE == "server" and TOKEN_STORE.lower() != "database":
+        # tokens are kept in Redis only if TOKEN_STORE=database
+        logger.error("INVALID: GFARM_HTTP_SESSION_STORE=server"
+                     " requires Redis as token store")
+        error = True
     if error:
         exit_error()
 
@@ -602,18 +918,89 @@ def manage_tempfiles():
 
     os.makedirs(TMPDIR_TOKENS, mode=0o700, exist_ok=True)
     os.makedirs(TMPDIR_TARTMP, mode=0o700, exist_ok=True)
+    os.makedirs(TMPDIR_LISTING, mode=0o700, exist_ok=True)
     check_tempdir_mode()
 
 
 manage_tempfiles()
 
+#############################################################################
+# Metrics (GET /metrics)
+
+metrics_registry = metrics.Registry()
+METRIC_REQUEST_SECONDS = metrics.Histogram(
+    "gfarm_http_request_duration_seconds",
+    "Time until the last byte of the response",
+    ["method", "route", "status"], registry=metrics_registry)
+METRIC_STREAMS_ACTIVE = metrics.Gauge(
+    "gfarm_http_streams_active",
+    "Streaming responses in progress", registry=metrics_registry)
+METRIC_COMMAND_FIRST_BYTE_SECONDS = metrics.Histogram(
+    "gfarm_http_command_first_byte_seconds",
+    "Time from spawn to the first byte of stdout of gf* commands",
+    ["command"], registry=metrics_registry)
+METRIC_COMMAND_SECONDS = metrics.Histogram(
+    "gfarm_http_command_duration_seconds",
+    "Time from spawn to exit of gf* commands",
+    ["command"], registry=metrics_registry)
+METRIC_COMMAND_EXIT = metrics.Counter(
+    "gfarm_http_command_exit",
+    "Exit codes of gf* commands",
+    ["command", "code"], registry=metrics_registry)
+METRIC_COMMANDS_ACTIVE = metrics.Gauge(
+    "gfarm_http_commands_active",
+    "Running gf* processes", ["command"], registry=metrics_registry)
+METRIC_TRANSFER_BYTES = metrics.Counter(
+    "gfarm_http_transfer_bytes",
+    "Bytes transferred by /file, /zip and /copy",
+    ["route", "direction"], registry=metrics_registry)
+METRIC_REDIS_SECONDS = metrics.Histogram(
+    "gfarm_http_redis_duration_seconds",
+    "Latency of Redis operations",
+    ["op"], registry=metrics_registry)
+METRIC_OIDC_SECONDS = metrics.Histogram(
+    "gfarm_http_oidc_request_duration_seconds",
+    "Latency of HTTP requests to the OpenID provider",
+    ["method", "status"], registry=metrics_registry)
+METRIC_OIDC_RETRIES = metrics.Counter(
+    "gfarm_http_oidc_request_retries",
+    "Retries of HTTP requests to the OpenID provider",
+    ["method", "reason"], registry=metrics_registry)
+METRIC_TOKEN_VERIFY_SECONDS = metrics.Histogram(
+    "gfarm_http_token_verify_duration_seconds",
+    "CPU time of access token signature verification",
+    ["result"], buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                         0.01, 0.025, 0.05, 0.1),
+    registry=metrics_registry)
+METRIC_TOKEN_VERIFY_CACHE = metrics.Counter(
+    "gfarm_http_token_verify_cache",
+    "Lookups of verified access tokens", ["result"],
+    registry=metrics_registry)
+METRIC_SCHED_ACTIVE = metrics.Gauge(
+    "gfarm_http_scheduler_active",
+    "gf* processes admitted by the scheduler", ["lane"],
+    registry=metrics_registry)
+METRIC_SCHED_QUEUED = metrics.Gauge(
+    "gfarm_http_scheduler_queued",
+    "Requests waiting for the scheduler", ["lane"],
+    registry=metrics_registry)
+
+
+def observe_redis(op, seconds):
+    METRIC_REDIS_SECONDS.labels(op).observe(seconds)
+
+
 #############################################################################
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Load
-    if TOKEN_STORE.lower() == "database":
+    if TOKEN_STORE.lower() == "database" and REDIS_BACKEND == "memory":
+        # single process only
+        app.state.redis = MemoryRedisClient(observe=observe_redis,
+                                            logger=logger)
+    elif TOKEN_STORE.lower() == "database":
         app.state.redis = RedisClient(host=REDIS_HOST,
                                       port=REDIS_PORT,
                                       db=REDIS_DB,
@@ -624,9 +1011,27 @@ async def lifespan(app: FastAPI):
                                       ssl_ca_certs=REDIS_SSL_CA_CERTS,
                                       username=REDIS_USERNAME,
                                       password=REDIS_PASSWORD,
+                                      max_connections=REDIS_MAX_CONNECTIONS,
+                                      socket_timeout=REDIS_SOCKET_TIMEOUT,
+                                      socket_connect_timeout=(
+                                          REDIS_SOCKET_CONNECT_TIMEOUT),
+                                      health_check_interval=(
+                                          REDIS_HEALTH_CHECK_INTERVAL),
+                                      retry_attempts=REDIS_RETRY_ATTEMPTS,
+                                      sentinels=REDIS_SENTINELS,
+                                      sentinel_service_name=(
+                                          REDIS_SENTINEL_SERVICE_NAME),
+                                      observe=observe_redis,
                                       logger=logger)
+    if hasattr(app.state, "redis"):
         await app.state.redis.connect()
     app.state.zip_executor = ThreadPoolExecutor()
+    http_transport.open()
+    if OIDC_CLIENT_ID:
+        oidc_metadata_refresher.start()
+    if TOKEN_VERIFY:
+        oidc_jwks_refresher.start()
+    listing_snapshot_sweeper.start()
     try:
         yield
     finally:
@@ -635,6 +1040,11 @@ async def lifespan(app: FastAPI):
             await app.state.redis.close()
         if hasattr(app.state, "zip_executor"):
             app.state.zip_executor.shutdown(wait=True, cancel_futures=True)
+        await gfstat_workers.close()
+        await oidc_metadata_refresher.stop()
+        await oidc_jwks_refresher.stop()
+        await listing_snapshot_sweeper.stop()
+        await http_transport.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -665,6 +1075,7 @@ app.add_middleware(
     # allow_methods=["*"],
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
 
 # https://www.starlette.io/middleware/#sessionmiddleware
@@ -672,7 +1083,23 @@ app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET,
                    same_site="lax",
                    max_age=SESSION_MAX_AGE)
 
+app.add_middleware(metrics.MetricsMiddleware,
+                   requests=METRIC_REQUEST_SECONDS,
+                   streams=METRIC_STREAMS_ACTIVE)
+
+app.add_middleware(RequestSlotsMiddleware)
+
 # TODO disable OIDC authorization if OIDC_CLIENT_ID is None
+# connection pool for IdP (keep-alive)
+http_transport = SharedTransport(
+    verify=VERIFY_CERT,
+    http2=HTTP2 and http2_available(),
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY))
+http_client = httpx.AsyncClient(transport=http_transport,
+                                timeout=HTTP_TIMEOUT)
+
 oauth = OAuth()
 oauth.register(
     name="my_oidc_provider",
@@ -682,20 +1109,38 @@ oauth.register(
     client_kwargs={
         # 'scope': 'hpci',
         'verify': VERIFY_CERT,
+        'transport': http_transport,  # shared with http_request()
+        'timeout': HTTP_TIMEOUT,
     },
 )
 provider = oauth.my_oidc_provider
-metadata = None  # cached forever
+
+
+async def fetch_oidc_metadata():
+    response = await http_get(OIDC_META_URL)
+    response.raise_for_status()
+    return response.json()
+
+
+def update_oidc_metadata(meta):
+    if DEBUG:
+        logger.debug("oidc_metadata:\n" + pf(meta))
+    # share with authlib (authorize_redirect(), authorize_access_token())
+    provider.server_metadata.update(meta)
+    provider.server_metadata["_loaded_at"] = time.time()
+
+
+oidc_metadata_refresher = Refresher(
+    "oidc_metadata", fetch_oidc_metadata,
+    refresh_interval=OIDC_REFRESH_INTERVAL,
+    min_refetch_interval=OIDC_REFETCH_MIN_INTERVAL,
+    backoff_max=OIDC_REFRESH_BACKOFF_MAX,
+    on_update=update_oidc_metadata,
+    logger=logger)
 
 
 async def oidc_metadata():
-    global metadata
-    if metadata is None:
-        # cache
-        metadata = await provider.load_server_metadata()
-        if DEBUG:
-            logger.debug("oidc_metadata:\n" + pf(metadata))
-    return metadata
+    return await oidc_metadata_refresher.get()
 
 
 async def oidc_keys_url():
@@ -752,8 +1197,21 @@ else:
     decompress_str = decompress_str_gzip
 
 
+# "v2." + Fernet token (base64url) of session_codec.pack(data)
+SESSION_COOKIE_V2_PREFIX = "v2."
+
+# cookie value -> decrypted dict
+session_decode_cache = TTLCache(maxsize=SESSION_DECODE_CACHE_SIZE,
+                                ttl=SESSION_DECODE_CACHE_TTL)
+
+
 def encrypt_json(data):
-    if fer:
+    if fer and SESSION_COOKIE_FORMAT == "v2":
+        encrypted = SESSION_COOKIE_V2_PREFIX + fer.encrypt(
+            session_codec.pack(data)).decode()
+        logger.debug(f"encrypt_token: encrypted_len={len(encrypted)}")
+        return encrypted
+    elif fer:
         # dict -> JSON str
         s = json.dumps(data)
         # JSON str -> JSON bin (compressed)
@@ -771,7 +1229,13 @@ def encrypt_json(data):
 
 def decrypt_json(data):
     if fer:
-        try:
+        decrypted = session_decode_cache.get(data)
+        if decrypted is not None:
+            return dict(decrypted)  # may be modified by caller
+        if data.startswith(SESSION_COOKIE_V2_PREFIX):
+            eb = data[len(SESSION_COOKIE_V2_PREFIX):].encode()
+            decrypted = session_codec.unpack(fer.decrypt(eb))
+        else:
             # base85 str -> encrypted bin
             eb = base64.b85decode(data)
             # encrypted bin -> JSON bin (compressed)
@@ -780,14 +1244,13 @@ def decrypt_json(data):
             s = decompress_str(cb)
             # JSON str -> dict
             decrypted = json.loads(s)
-            return decrypted
-        except Exception:
-            raise
+        session_decode_cache.set(data, decrypted)
+        return dict(decrypted)
     else:
         return data
 
 
-async def encrypt_token(token, request):
+async def encrypt_token(token, request, store=True):
     if TOKEN_STORE.lower() == "database":
         session_ref = request.session.get("token")
         if session_ref:
@@ -803,17 +1266,24 @@ async def encrypt_token(token, request):
             session_ref = {"token_id": REDIS_ID_PREFIX + uuid.uuid4().hex,
                            "key": Fernet.generate_key().decode()}
 
-        session_ref["access_token"] = token.get("access_token")
+        if SESSION_STORE == "server":
+            # cookie has only the reference to Redis
+            session_ref.pop("access_token", None)
+            await set_at_to_db(request, session_ref,
+                               token.get("access_token"), store=store)
+        else:
+            session_ref["access_token"] = token.get("access_token")
 
-        token_id = session_ref.get("token_id")
-        f_session = Fernet(session_ref.get("key").encode())
+        if store:
+            token_id = session_ref.get("token_id")
+            f_session = Fernet(session_ref.get("key").encode())
 
-        s = token.get("refresh_token")
-        cb = compress_str(s)
-        eb = f_session.encrypt(cb)
+            s = token.get("refresh_token")
+            cb = compress_str(s)
+            eb = f_session.encrypt(cb)
 
-        store = request.app.state.redis
-        await store.setex(token_id, REDIS_TTL, eb)
+            redis = request.app.state.redis
+            await redis.setex(token_id, REDIS_TTL, eb)
         set_data = session_ref
     else:
         set_data = token
@@ -823,18 +1293,66 @@ async def encrypt_token(token, request):
 
 async def decrypt_token(request, encrypted_token):
     try:
-        return decrypt_json(encrypted_token)
+        token = decrypt_json(encrypted_token)
+        if (TOKEN_STORE.lower() == "database" and isinstance(token, dict)
+                and "token_id" in token and "access_token" not in token):
+            # created in SESSION_STORE=server mode
+            access_token = await get_at_from_db(request, token)
+            if not access_token:
+                return None
+            token["access_token"] = access_token
+        return token
     except Exception as e:
         ipaddr = get_client_ip_from_request(request)
         logger.warning(f"{ipaddr}:0 decrypt_token error=" + str(e))
         return None
 
 
-async def set_token(request: Request, token):
+def access_token_db_key(token_id):
+    return f"{token_id}:at"
+
+
+# (token_id, key) -> access token (SESSION_STORE=server)
+access_token_cache = TTLCache(maxsize=ACCESS_TOKEN_CACHE_SIZE,
+                              ttl=ACCESS_TOKEN_CACHE_TTL)
+
+
+def access_token_cache_key(session_ref):
+    return (session_ref.get("token_id"), session_ref.get("key"))
+
+
+async def set_at_to_db(request, session_ref, access_token, store=True):
+    if store:
+        f_session = Fernet(session_ref.get("key").encode())
+        eb = f_session.encrypt(compress_str(access_token))
+        redis = request.app.state.redis
+        await redis.setex(access_token_db_key(session_ref.get("token_id")),
+                          REDIS_TTL, eb)
+    access_token_cache.set(access_token_cache_key(session_ref), access_token)
+
+
+async def get_at_from_db(request, session_ref, use_cache=True):
+    cache_key = access_token_cache_key(session_ref)
+    if use_cache:
+        access_token = access_token_cache.get(cache_key)
+        if access_token is not None:
+            return access_token
+    redis = request.app.state.redis
+    eb = await redis.get(access_token_db_key(session_ref.get("token_id")))
+    if eb is None:
+        return None
+    f_session = Fernet(session_ref.get("key").encode())
+    access_token = decompress_str(f_session.decrypt(eb))
+    access_token_cache.set(cache_key, access_token)
+    return access_token
+
+
+async def set_token(request: Request, token, store=True):
     necessary_token = {}
     necessary_token["access_token"] = token.get("access_token")
     necessary_token["refresh_token"] = token.get("refresh_token")
-    necessary_token = await encrypt_token(necessary_token, request)
+    necessary_token = await encrypt_token(necessary_token, request,
+                                          store=store)
     request.session["token"] = necessary_token
 
 
@@ -842,6 +1360,12 @@ USE_HTTPX = True
 TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
 
 
+def http_retry_backoff(attempt):
+    # exponential backoff with jitter
+    delay = HTTP_RETRY_INTERVAL * (2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
 async def http_request(method, url, data=None,
                        attempts: int = HTTP_MAX_ATTEMPTS):
     if not url:
@@ -849,21 +1373,29 @@ async def http_request(method, url, data=None,
     last_exc = None
     attempts = max(1, attempts)
     for attempt in range(1, attempts + 1):
+        start = time.monotonic()
         try:
             if USE_HTTPX:
-                async with httpx.AsyncClient(verify=VERIFY_CERT) as client:
-                    response = await client.request(method, url, data=data)
+                response = await http_client.request(method, url, data=data)
             else:
-                response = requests.request(method, url, data=data,
-                                            verify=VERIFY_CERT)
+                # blocking: do not stop the event loop
+                response = await asyncio.to_thread(
+                    requests.request, method, url, data=data,
+                    verify=VERIFY_CERT, timeout=HTTP_TIMEOUT)
+            METRIC_OIDC_SECONDS.labels(method, response.status_code).observe(
+                time.monotonic() - start)
         except (httpx.RequestError, requests.exceptions.RequestException) as e:
+            METRIC_OIDC_SECONDS.labels(method, "error").observe(
+                time.monotonic() - start)
             last_exc = e
             if attempt >= attempts:
                 raise
-            await asyncio.sleep(HTTP_RETRY_INTERVAL)
+            METRIC_OIDC_RETRIES.labels(method, type(e).__name__).inc()
+            await asyncio.sleep(http_retry_backoff(attempt))
             continue
         if response.status_code in TRANSIENT_STATUS and attempt < attempts:
-            await asyncio.sleep(HTTP_RETRY_INTERVAL)
+            METRIC_OIDC_RETRIES.labels(method, response.status_code).inc()
+            await asyncio.sleep(http_retry_backoff(attempt))
             continue
         return response
     if last_exc:
@@ -904,123 +1436,255 @@ async def release_lock_db(token_id: str, val: str):
         logger.exception(f"release_lock_db failed to remove {token_id}")
 
 
-async def get_rt_from_db(session_ref):
-    token_id = session_ref.get("token_id")
-    if token_id is None:
-        return None
-    token_key = session_ref.get("key")
-    if token_key is None:
-        raise RuntimeError("Redis fetch failed: "
-                           "session_ref does not contain 'token_key'")
-    store = app.state.redis
-    eb = await store.get(token_id)
+def decrypt_rt(session_ref, eb):
     if not eb:
         return None
-    f_session = Fernet(token_key.encode())
+    f_session = Fernet(session_ref.get("key").encode())
     cb = f_session.decrypt(eb)
     return decompress_str(cb)
 
 
+async def refresh_token_request(refresh_token):
+    meta = await oidc_metadata()
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token,
+        "client_id": OIDC_CLIENT_ID,
+        "client_secret": OIDC_CLIENT_SECRET,
+    }
+    token_endpoint_url = meta.get('token_endpoint')
+    response = await http_post(token_endpoint_url, data)
+    response.raise_for_status()
+    return response.json()
+
+
+def refreshed_token_key(token_id):
+    return f"{token_id}:refreshed"
+
+
+def encrypt_refreshed_token(session_ref, new_token):
+    # shared only with the processes having the same session key
+    f_session = Fernet(session_ref.get("key").encode())
+    necessary_token = {
+        "access_token": new_token.get("access_token"),
+        "refresh_token": new_token.get("refresh_token"),
+    }
+    return f_session.encrypt(compress_str(json.dumps(necessary_token)))
+
+
+def decrypt_refreshed_token(session_ref, eb):
+    if not eb:
+        return None
+    try:
+        f_session = Fernet(session_ref.get("key").encode())
+        new_token = json.loads(decompress_str(f_session.decrypt(eb)))
+    except Exception as e:
+        logger.warning(f"refreshed token decrypt error: {str(e)}")
+        return None
+    if new_token.get("access_token") == session_ref.get("access_token"):
+        return None  # not refreshed
+    return new_token
+
+
+async def refresh_token_db(request: Request, session_ref):
+    token_id = session_ref.get("token_id")
+    if not token_id:
+        raise RuntimeError("Redis lock failed: token_id is empty")
+    store = request.app.state.redis
+    # subscribe before locking not to miss the notification
+    waiter = await store.subscribe(token_id)
+    lock_val = None
+    try:
+        # the lock and the tokens in one round trip
+        keys = (refreshed_token_key(token_id), token_id)
+        ok, lock_val, values = await store.lock_and_get(
+            token_id, REDIS_LOCK_TTL, keys)
+        if not ok:
+            lock_val = None
+            # another process is refreshing: wait for the new token
+            await asyncio.wait({waiter}, timeout=REDIS_LOCK_TTL)
+            if waiter.done() and not waiter.cancelled():
+                new_token = decrypt_refreshed_token(session_ref,
+                                                    waiter.result())
+                if new_token:
+                    logger.debug("use refreshed token notified")
+                    return new_token, False
+            # timeout: fall back to polling
+            lock_val = await acquire_lock_db(token_id)
+            values = await store.mget(keys)
+        refreshed_eb, rt_eb = values
+        # refreshed just before getting the lock?
+        new_token = decrypt_refreshed_token(session_ref, refreshed_eb)
+        if new_token:
+            return new_token, False
+        refresh_token = decrypt_rt(session_ref, rt_eb)
+        if not refresh_token:
+            return None, False
+        new_token = await refresh_token_request(refresh_token)
+        await set_token(request, new_token)
+        eb = encrypt_refreshed_token(session_ref, new_token)
+        await store.setex_and_publish(refreshed_token_key(token_id),
+                                      REDIS_LOCK_TTL, eb, token_id)
+        return new_token, True
+    except Exception:
+        logger.exception("failed to refresh token")
+        raise
+    finally:
+        store.unsubscribe(token_id, waiter)
+        if lock_val:
+            try:
+                await release_lock_db(token_id, lock_val)
+            except Exception:
+                logger.exception("failed to release refresh_token lock")
+
+
+# (event loop, token_id or hash of refresh_token) -> Future
+refresh_inflight = {}
+
+
 async def use_refresh_token(request: Request, token):
     logger.debug("use_refresh_token is called")
     using_db = TOKEN_STORE.lower() == "database"
-    token_id = None
-    lock_val = None
     if using_db:
-        token_id = token.get("token_id")
-        try:
-            lock_val = await acquire_lock_db(token_id)
-            refresh_token = await get_rt_from_db(token)
-            if not refresh_token:
-                await release_lock_db(token_id, lock_val)
-                return None
-        except Exception:
-            logger.exception("failed to get refresh_token")
-            if token_id and lock_val:
-                await release_lock_db(token_id, lock_val)
-            raise
+        key = token.get("token_id")
     else:
         refresh_token = token.get("refresh_token")
+        key = token_cache_key(refresh_token) if refresh_token else None
+    loop = asyncio.get_running_loop()
+    key = (loop, key)
+    fut = refresh_inflight.get(key)
+    if fut is not None:
+        # refreshing by another request in this process
+        new_token = await asyncio.shield(fut)
+        if new_token:
+            await set_token(request, new_token, store=False)
+        return new_token
+    fut = loop.create_future()
+    refresh_inflight[key] = fut
     try:
-        meta = await oidc_metadata()
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token,
-            "client_id": OIDC_CLIENT_ID,
-            "client_secret": OIDC_CLIENT_SECRET,
-        }
-        token_endpoint_url = meta.get('token_endpoint')
-        response = await http_post(token_endpoint_url, data)
-        response.raise_for_status()
-        new_token = response.json()
-        await set_token(request, new_token)
+        if using_db:
+            new_token, stored = await refresh_token_db(request, token)
+            if new_token and not stored:
+                await set_token(request, new_token, store=False)
+        else:
+            new_token = await refresh_token_request(refresh_token)
+            await set_token(request, new_token)
+        fut.set_result(new_token)
         return new_token
-    except httpx.HTTPError:
-        raise
-    except requests.exceptions.RequestException:
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # retrieved
         raise
-    except Exception:
+    except BaseException:
+        fut.cancel()
         raise
     finally:
-        if using_db and token_id and lock_val:
-            try:
-                await release_lock_db(token_id, lock_val)
-            except Exception:
-                logger.exception("failed to release refresh_token lock")
+        del refresh_inflight[key]
 
 
 def jwt_error(msg):
     return HTTPException(status_code=500, detail=f"JWT error: {msg}")
 
 
-jwks_cache = None
-jwks_cache_time = None
-jwks_cache_timeout = 600  # sec.
+async def fetch_oidc_jwks():
+    jwks_url = await oidc_keys_url()
+    response = await http_get(jwks_url)
+    response.raise_for_status()
+    return response.json()
+
+
+# kid -> JWK
+oidc_jwk_index = {}
+
+
+def update_oidc_jwks(jwks):
+    global oidc_jwk_index
+    index = {}
+    for key in jwks.get("keys", []):
+        kid = key.get("kid")
+        if kid is not None:
+            index[kid] = key
+    oidc_jwk_index = index
+    if not OIDC_KEYS_URL:
+        # share with authlib (parse_id_token())
+        provider.server_metadata["jwks"] = jwks
+
+
+oidc_jwks_refresher = Refresher(
+    "oidc_jwks", fetch_oidc_jwks,
+    refresh_interval=OIDC_REFRESH_INTERVAL,
+    min_refetch_interval=OIDC_REFETCH_MIN_INTERVAL,
+    backoff_max=OIDC_REFRESH_BACKOFF_MAX,
+    on_update=update_oidc_jwks,
+    logger=logger)
 
 
-# caching jwks
 async def oidc_jwks():
-    global jwks_cache
-    global jwks_cache_time
-    now = int(time.time())
-    if jwks_cache_time is None or now > jwks_cache_time + jwks_cache_timeout:
-        # timeout
-        jwks_cache_time = now
-        jwks_url = await oidc_keys_url()
-        try:
-            response = await http_get(jwks_url)
-            jwks_cache = response.json()
-        except Exception as e:
-            logger.error(f"http_get :{str(e)}")
-        return jwks_cache
-    else:
-        logger.debug("use cached jwks")
-        return jwks_cache
+    return await oidc_jwks_refresher.get()
+
+
+async def oidc_jwk(kid):
+    jwks = await oidc_jwks()
+    if kid is None:
+        return jwks
+    key = oidc_jwk_index.get(kid)
+    if key is None:
+        # key rotation: fetch again (rate limited)
+        logger.debug(f"unknown kid: {kid}")
+        await oidc_jwks_refresher.refetch()
+        key = oidc_jwk_index.get(kid)
+        if key is None:
+            raise jwt_error(f"Unknown key ID: {kid}")
+    return key
+
+
+# sha256(access token) -> verified claims
+verified_claims_cache = TTLCache(maxsize=TOKEN_VERIFY_CACHE_SIZE,
+                                 ttl=TOKEN_VERIFY_CACHE_TTL)
+
+
+def token_cache_key(access_token):
+    return hashlib.sha256(access_token.encode()).digest()
 
 
 async def verify_token(access_token, use_raise=False):
-    try:
-        jwks = await oidc_jwks()
-        # if DEBUG:
-        #     logger.debug("jwks=\n" + pf(jwks))
-    except Exception:
-        # logger.error(f"verify_token initialization error: {e}")
-        logger.exception("verify_token initialization error")
-        raise
+    key = None
+    if access_token:
+        key = token_cache_key(access_token)
+        claims = verified_claims_cache.get(key)
+        if claims is not None:
+            METRIC_TOKEN_VERIFY_CACHE.labels("hit").inc()
+            return claims
+        METRIC_TOKEN_VERIFY_CACHE.labels("miss").inc()
     try:
         header = jwt.get_unverified_header(access_token)
         if not header:
             raise jwt_error("Invalid header")
         alg = header.get("alg")
+        # never wait for IdP unless kid is unknown
+        jwk = await oidc_jwk(header.get("kid"))
         options = {'leeway': -TOKEN_MIN_VALID_TIME_REMAINING}
-        claims = jwt.decode(
-            access_token,
-            jwks,
-            algorithms=alg,
-            audience=TOKEN_AUDIENCE,
-            issuer=TOKEN_ISSUERS,
-            options=options,
-        )
+        start = time.process_time()
+        try:
+            claims = jwt.decode(
+                access_token,
+                jwk,
+                algorithms=alg,
+                audience=TOKEN_AUDIENCE,
+                issuer=TOKEN_ISSUERS,
+                options=options,
+            )
+        except Exception:
+            METRIC_TOKEN_VERIFY_SECONDS.labels("error").observe(
+                time.process_time() - start)
+            raise
+        METRIC_TOKEN_VERIFY_SECONDS.labels("ok").observe(
+            time.process_time() - start)
+        # valid until the same time as jwt.decode() with the leeway
+        exp = claims.get("exp")
+        if key is not None and isinstance(exp, (int, float)):
+            ttl = exp - TOKEN_MIN_VALID_TIME_REMAINING - time.time()
+            verified_claims_cache.set(key, claims, ttl=ttl)
         return claims
     except Exception as e:
         logger.error(f"Access token verification error: {e}")
@@ -1066,6 +1730,13 @@ async def get_token(request: Request):
         return None
     if not await is_expired_token(token):
         return token
+    if SESSION_STORE == "server" and "token_id" in token:
+        # refreshed by another process?
+        access_token = await get_at_from_db(request, token, use_cache=False)
+        if access_token and access_token != token.get("access_token"):
+            token["access_token"] = access_token
+            if not await is_expired_token(token):
+                return token
     new_token = await use_refresh_token(request, token)
     if new_token:
         if not await is_expired_token(new_token, use_raise=True):
@@ -1078,6 +1749,29 @@ def delete_token(request: Request):
     request.session.pop("token", None)
 
 
+async def revoke_token(request: Request):
+    """
+    Logout: the tokens saved in Redis (TOKEN_STORE=database) are removed
+    as well, so a copied session cookie is no longer accepted.
+    """
+    encrypted_token = request.session.get("token")
+    delete_token(request)
+    if not encrypted_token or TOKEN_STORE.lower() != "database":
+        return
+    try:
+        session_ref = decrypt_json(encrypted_token)
+    except Exception:
+        return
+    if not isinstance(session_ref, dict) or "token_id" not in session_ref:
+        return
+    token_id = session_ref["token_id"]
+    access_token_cache.pop(access_token_cache_key(session_ref))
+    redis = request.app.state.redis
+    for key in (token_id, access_token_db_key(token_id),
+                refreshed_token_key(token_id)):
+        await redis.delete(key)
+
+
 async def get_access_token(request: Request) -> Optional[str]:
     token = await get_token(request)
     if token:
@@ -1219,9 +1913,9 @@ async def user_info(request: Request,
     if user or authorization:
         try:
             env = await set_env(request, authorization)
-            username = await get_username(env)
-            if username:
-                name, _, home_directory, _ = await gfuser_info(env, username)
+            identity = await get_user_identity(env)
+            if identity:
+                name, home_directory, _ = identity
                 return JSONResponse(content={"username": name,
                                              "loginname": user,
                                              "home_directory": home_directory})
@@ -1234,9 +1928,9 @@ async def user_info(request: Request,
         name = ANONYMOUS_USERNAME
         try:
             env = await set_env(request, authorization)
-            username = await get_username(env)
-            if username:
-                _, _, home_directory, _ = await gfuser_info(env, username)
+            identity = await get_user_identity(env)
+            if identity:
+                _, home_directory, _ = identity
             else:
                 raise
         except Exception:
@@ -1314,7 +2008,7 @@ def check_csrf(request, csrf_token=None, x_csrf_token=None):
 async def logout(request: Request,
                  state: Optional[str] = Query(None, description="CSRF token")):
     check_csrf(request, state)
-    delete_token(request)
+    await revoke_token(request)
     delete_user_passwd(request)
     request.session.pop("error", None)
     url = request.url_for("login_page")
@@ -1375,7 +2069,8 @@ def delete_user_passwd(request: Request):
 
 async def get_next_url(request: Request,
                        env=None,
-                       authorization: Union[str, None] = None):
+                       authorization: Union[str, None] = None,
+                       username: Union[str, None] = None):
     try:
         if env is None:
             env = await set_env(request, authorization)
@@ -1385,10 +2080,10 @@ async def get_next_url(request: Request,
 
     url = request.session.get("next_url", None)
     if url is None:
-        username = await get_username(env)
-        if username is None:
+        identity = await get_user_identity(env, username)
+        if identity is None:
             return request.url_for("index").path
-        _, _, home, _ = await gfuser_info(env, username)
+        _, home, _ = identity
         return request.url_for("index").path + STORAGE_URL_PREFIX + home
     return url
 
@@ -1399,13 +2094,12 @@ async def login_passwd(request: Request,
                        password: str = Form(),
                        csrf_token: Optional[str] = Form(None)):
     check_csrf(request, csrf_token)
-    delete_token(request)
+    await revoke_token(request)
     set_user_passwd(request, username, password)
     env = await set_env(request, None)
     p = await gfwhoami(env)
-    url = await get_next_url(request, env)
     try:
-        await gfarm_command_standard_response(env, p, "gfwhoami")
+        res = await gfarm_command_standard_response(env, p, "gfwhoami")
         # OK
         log_login(request, username, "password")
     except Exception as e:
@@ -1413,6 +2107,13 @@ async def login_passwd(request: Request,
         err = str(e)
         request.session["error"] = err
         log_login_error(request, username, "password", err)
+        url = request.session.get("next_url", None)
+        if url is None:
+            url = request.url_for("index").path
+        return RedirectResponse(url=url, status_code=303)
+    # reuse the result of gfwhoami
+    gfarm_username = res.body.decode().rstrip()
+    url = await get_next_url(request, env, username=gfarm_username)
     return RedirectResponse(url=url, status_code=303)
 
 
@@ -1585,6 +2286,26 @@ def get_user_from_env(env):
     return env.get(LOG_USERNAME_KEY, "UNKNOWN_USER")
 
 
+CREDENTIAL_ENV_KEYS = (
+    'GFARM_CONFIG_FILE',
+    'GFARM_SASL_MECHANISMS',
+    'GFARM_SASL_USER',
+    'GFARM_SASL_PASSWORD',
+    'JWT_USER_PATH',
+)
+
+
+def get_credential_key(env):
+    # env with the same key authenticates to Gfarm as the same user
+    h = hashlib.sha256()
+    for key in CREDENTIAL_ENV_KEYS:
+        h.update(key.encode())
+        h.update(b"=")
+        h.update(str(env.get(key, "")).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
 def get_client_ip_from_env(env):
     return env.get(LOG_CLIENT_IP_KEY, "NO_CLIENT_IP")
 
@@ -1594,7 +2315,7 @@ def get_client_ip_from_request(request):
     return request.client.host
 
 
-# Used only by archive_files()
+# Used by CredentialKeeper
 # - Creates a token file and sets its path in env when filepath is None.
 # - Updates the token file when filepath is not None.
 async def update_token_file(request, env, filepath=None, expire=None):
@@ -1623,13 +2344,13 @@ async def update_token_file(request, env, filepath=None, expire=None):
             delete=False) as fp:
         # Write access_token in the token file
         fp.write(access_token)
-        if token_file is None:
-            # set to env
-            token_file = fp.name
-            env['JWT_USER_PATH'] = token_file
-        else:
-            # update
-            os.rename(fp.name, token_file)
+    if token_file is None:
+        # set to env
+        token_file = fp.name
+        env['JWT_USER_PATH'] = token_file
+    else:
+        # update atomically (readers never see a partial file)
+        os.replace(fp.name, token_file)
 
     ipaddr = get_client_ip_from_request(request)
     logger.debug(
@@ -1638,6 +2359,92 @@ async def update_token_file(request, env, filepath=None, expire=None):
     return token_file, env, exp
 
 
+class CredentialKeeper:
+    """
+    Keep the credential of a long-running operation valid.
+
+    For session (login) users, the access token is passed to Gfarm
+    commands by a token file (JWT_USER_PATH), and a timer task
+    refreshes the file shortly before the access token expires.
+    Streaming loops therefore do not need to check the token.
+    Otherwise (ex. Authorization header), env is used as is.
+    """
+    RETRY_INTERVAL = 10  # sec.
+
+    def __init__(self, request, env):
+        self.request = request
+        self.env = env
+        self.filepath = None
+        self.expire = None
+        self._task = None
+
+    async def start(self):
+        self.filepath, self.env, self.expire = await update_token_file(
+            self.request, self.env)
+        if self.filepath and self.expire is not None:
+            self._task = asyncio.create_task(self._keep())
+        return self.env
+
+    def _next_delay(self):
+        # update_token_file() refreshes the token after this time
+        return self.expire - TOKEN_MIN_VALID_TIME_REMAINING - time.time() + 1
+
+    async def _keep(self):
+        user = get_user_from_env(self.env)
+        ipaddr = get_client_ip_from_env(self.env)
+        while True:
+            await asyncio.sleep(max(0, self._next_delay()))
+            try:
+                filepath, _, exp = await update_token_file(
+                    self.request, self.env, self.filepath, self.expire)
+            except Exception as e:
+                logger.error(f"{ipaddr}:0 user={user},"
+                             f" access_token file update error: {e}")
+                await asyncio.sleep(self.RETRY_INTERVAL)
+                continue
+            if filepath is None:
+                logger.warning(f"{ipaddr}:0 user={user},"
+                               " access_token cannot be refreshed")
+                return
+            if exp is None or exp == self.expire:
+                await asyncio.sleep(self.RETRY_INTERVAL)
+            self.expire = exp if exp is not None else self.expire
+
+    async def stop(self):
+        # may be called more than once
+        task, self._task = self._task, None
+        filepath, self.filepath = self.filepath, None
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        if filepath:
+            try:
+                os.remove(filepath)
+            except Exception as e:
+                user = get_user_from_env(self.env)
+                ipaddr = get_client_ip_from_env(self.env)
+                logger.error(f"{ipaddr}:0 user={user},"
+                             f" os.remove({filepath}) error: {e}")
+
+
+class CredentialStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that stops the CredentialKeeper when the response
+    ends, even if the body is never iterated (ex. disconnected before
+    the first chunk).
+    """
+    def __init__(self, content, keeper: CredentialKeeper, **kwargs):
+        super().__init__(content, **kwargs)
+        self.keeper = keeper
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.keeper.stop()
+
+
 #############################################################################
 def keyval(s):
     # s: "  Key1: Val1..."
@@ -1795,24 +2602,17 @@ def parse_gfstat(file_info_str):
     return Stat.model_validate(file_info)  # Pydantic V2
 
 
-def from_rwx(rwx, highchar):
-    perm = 0
-    highbit = 0
-    r = rwx[0]
-    w = rwx[1]
-    x = rwx[2]
-    if r == 'r':
-        perm |= 0o4
-    if w == 'w':
-        perm |= 0o2
-    if x == 'x':
-        perm |= 0o1
-    elif x == highchar:
-        perm |= 0o1
-        highbit = 0o1
-    elif x == highchar.upper():
-        highbit = 0o1
-    return perm, highbit
+def split_gfstat(stdout):
+    # gfstat path1 path2 ... -> one block per "File:" line
+    blocks = []
+    current = None
+    for line in stdout.splitlines():
+        if line.lstrip().startswith("File:"):
+            current = []
+            blocks.append(current)
+        if current is not None:
+            current.append(line)
+    return ["\n".join(b) for b in blocks]
 
 
 class ACInfo(BaseModel):
@@ -1919,9 +2719,82 @@ def parse_gfcksum(data):
 
 
 #############################################################################
+gfarm_scheduler = GfarmScheduler(
+    max_procs=SCHED_MAX_PROCS,
+    lane_limits={LANE_BULK: SCHED_MAX_BULK_PROCS},
+    lane_weights={LANE_INTERACTIVE: SCHED_INTERACTIVE_WEIGHT,
+                  LANE_BULK: 1.0},
+    user_weights=SCHED_USER_WEIGHTS,
+    max_queue=SCHED_MAX_QUEUE,
+    max_queue_per_user=SCHED_MAX_QUEUE_PER_USER,
+    queue_timeout=SCHED_QUEUE_TIMEOUT,
+    retry_after=SCHED_RETRY_AFTER,
+    max_procs_per_request=SCHED_MAX_PROCS_PER_REQUEST,
+    logger=logger)
+
+# keep references to the watcher tasks
+gfarm_scheduler_watchers = set()
+
+
+def get_scheduler_user(env):
+    user = get_user_from_env(env)
+    if user == "anonymous":
+        # distinguish anonymous users by client address
+        return f"{user}@{get_client_ip_from_env(env)}"
+    return user
+
+
+async def gfarm_scheduler_acquire(env, lane):
+    return await gfarm_scheduler.acquire(get_scheduler_user(env), lane)
+
+
+def command_exited(command, start, return_code):
+    METRIC_COMMANDS_ACTIVE.labels(command).dec()
+    METRIC_COMMAND_SECONDS.labels(command).observe(time.monotonic() - start)
+    METRIC_COMMAND_EXIT.labels(command, return_code).inc()
+
+
+async def gfarm_scheduler_release_on_exit(proc, slot, command, start):
+    return_code = None
+    try:
+        return_code = await proc.wait()
+    finally:
+        gfarm_scheduler.release(slot)
+        command_exited(command, start, return_code)
+
+
+async def gfarm_subprocess_exec(command, *args, env,
+                                stdin, stdout, stderr,
+                                lane=LANE_INTERACTIVE):
+    # wait for a free slot of the lane (or raise SchedulerBusy)
+    slot = await gfarm_scheduler_acquire(env, lane)
+    start = time.monotonic()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            command, *args,
+            env=env,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr)
+    except BaseException:
+        gfarm_scheduler.release(slot)
+        raise
+    METRIC_COMMANDS_ACTIVE.labels(command).inc()
+    if proc.stdout is not None:
+        proc.stdout = metrics.TimedStreamReader(
+            proc.stdout,
+            lambda: METRIC_COMMAND_FIRST_BYTE_SECONDS.labels(
+                command).observe(time.monotonic() - start))
+    task = asyncio.create_task(
+        gfarm_scheduler_release_on_exit(proc, slot, command, start))
+    gfarm_scheduler_watchers.add(task)
+    task.add_done_callback(gfarm_scheduler_watchers.discard)
+    return proc
+
+
 async def gfwhoami(env):
     args = []
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfwhoami', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -1936,7 +2809,7 @@ async def gfrm(env, path, force=False, recursive=False):
     if recursive:
         args.append("-r")
     args.append(path)
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfrm', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -1946,7 +2819,7 @@ async def gfrm(env, path, force=False, recursive=False):
 
 async def gfmv(env, src, dest):
     args = [src, dest]
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfmv', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -1954,21 +2827,67 @@ async def gfmv(env, src, dest):
         stderr=asyncio.subprocess.PIPE)
 
 
-def sync_gfexport(env, path):
+async def sync_gfexport(env, path):
     args = ['gfexport', path]
-    return subprocess.Popen(
-        args, shell=False, close_fds=True,
-        env=env,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL), args
+    slot = await gfarm_scheduler_acquire(env, LANE_BULK)
+    start = time.monotonic()
+    try:
+        p = subprocess.Popen(
+            args, shell=False, close_fds=True,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+    except BaseException:
+        gfarm_scheduler.release(slot)
+        raise
+    METRIC_COMMANDS_ACTIVE.labels('gfexport').inc()
+    gfarm_scheduler_release_on_popen_exit(p, slot, 'gfexport', start)
+    return p, args
+
+
+POPEN_POLL_INTERVAL = 0.5  # sec.
+
+
+def gfarm_scheduler_release_on_popen_exit(p, slot, command, start):
+    # release the slot when the process exits
+    # (without an executor thread waiting for it)
+    loop = asyncio.get_running_loop()
+
+    def exited():
+        gfarm_scheduler.release(slot)
+        command_exited(command, start, p.returncode)
+
+    try:
+        fd = os.pidfd_open(p.pid)
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        def readable():
+            loop.remove_reader(fd)
+            os.close(fd)
+            p.poll()
+            exited()
+
+        loop.add_reader(fd, readable)
+        return
+
+    # pidfd is not supported: poll
+    def poll():
+        if p.poll() is None:
+            loop.call_later(POPEN_POLL_INTERVAL, poll)
+        else:
+            exited()
+
+    poll()
 
 
 async def gfexport(env, path):
     args = [path]
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfexport', *args,
         env=env,
+        lane=LANE_BULK,
         stdin=asyncio.subprocess.DEVNULL,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE), args
@@ -1980,9 +2899,10 @@ async def gfreg(env, path, mtime):
     else:
         args = []
     args += ['-', path]
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfreg', *args,
         env=env,
+        lane=LANE_BULK,
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.DEVNULL,
         stderr=asyncio.subprocess.PIPE), args
@@ -1994,7 +2914,8 @@ async def gfls(env,
                _recursive=False,
                _long=False,
                _T=False,
-               effperm=False):
+               effperm=False,
+               lane=LANE_INTERACTIVE):
     args = []
     if _all:
         args.append('-a')
@@ -2007,163 +2928,15 @@ async def gfls(env,
     if effperm:
         args.append('-e')
     args.append(path)
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfls', *args,
         env=env,
+        lane=lane,
         stdin=asyncio.subprocess.DEVNULL,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.STDOUT)
 
 
-class Gfls_Entry:
-    name: str | None = None
-    path: str | None = None
-    mode_str: str | None = None
-    is_file: bool | None = None
-    is_dir: bool | None = None
-    is_sym: bool | None = None
-    linkname: str | None = None
-    nlink: int | None = None
-    uname: str | None = None
-    gname: str | None = None
-    size: int | None = None
-    mtime: float | None = None
-    perms: str | None = None
-
-    def __init__(
-            self,
-            name: Optional[str] = None,
-            nlink: Optional[int] = None,
-            uname: Optional[str] = None,
-            gname: Optional[str] = None,
-            size: Optional[int] = None,
-            dirname: Optional[str] = None,
-            mtime_str: Optional[str] = None,
-            mode_str: Optional[str] = None,
-            perms: Optional[str] = None):
-        self.name = name
-        self.nlink = nlink
-        self.uname = uname
-        self.gname = gname
-        self.size = size
-        self.perms = perms
-        self.set_dirname(dirname)
-        self.set_mtime(mtime_str)
-        self.set_mode(mode_str)
-        self.set_linkname(name, self.is_sym)
-
-    def set_dirname(self, dirname):
-        self.dirname = dirname
-        if dirname is not None:
-            if self.name == "." or self.name is None:
-                self.path = dirname
-            else:
-                self.path = os.path.join(self.dirname, self.name)
-
-    def set_mode(self, mode_str):
-        self.mode_str = mode_str
-        if mode_str is None:
-            self.mode = None
-            self.is_dir = None
-            self.is_sym = None
-            return
-        mode = 0
-        perm, highbit = from_rwx(mode_str[1:4], 's')
-        mode |= (perm << 6)
-        mode |= (highbit << 11)
-        perm, highbit = from_rwx(mode_str[4:7], 's')
-        mode |= (perm << 3)
-        mode |= (highbit << 10)
-        perm, highbit = from_rwx(mode_str[7:10], 't')
-        mode |= perm
-        mode |= (highbit << 9)
-        self.mode = mode
-        self.is_dir = mode_str.startswith('d')
-        self.is_sym = mode_str.startswith('l')
-
-    def set_mtime(self, mtime_str):
-        self.mtime_str = mtime_str
-        if mtime_str is None:
-            self.mtime = None
-            return
-        mtime = time.mktime(
-            time.strptime(mtime_str, '%b %d %H:%M:%S %Y'))
-        self.mtime = mtime
-
-    def set_linkname(self, name, is_sym):
-        self.linkname = ''
-        if is_sym is None:
-            return
-        if is_sym:
-            pair = name.split(' -> ')
-            self.name = pair[0]
-            self.linkname = pair[1]
-
-    def set_line(self, line):
-        self.line = line
-
-    def json_dump(self):
-        return {
-            "mode_str": self.mode_str,
-            "is_file": not self.is_dir and not self.is_sym,
-            "is_dir": self.is_dir,
-            "is_sym": self.is_sym,
-            "linkname": self.linkname,
-            "nlink": self.nlink,
-            "uname": self.uname,
-            "gname": self.gname,
-            "size": self.size,
-            "mtime": self.mtime,
-            "name": self.name,
-            "path": self.path,
-            "perms": self.perms
-        }
-
-    def line_dump(self):
-        return self.line
-
-    def parse(line,
-              is_file, long_format, full_format_time, effperm, dirname=None):
-        if not long_format:
-            return line
-
-        split_count = 8
-        if effperm:
-            split_count += 1
-        if full_format_time:
-            split_count += 1
-
-        parts = line.strip().split(None, split_count)
-        if len(parts) < 10:
-            return line
-
-        perms = parts.pop(0) if effperm else None
-        mode_str = parts.pop(0)
-        nlink = int(parts.pop(0))
-        uname = parts.pop(0)
-        gname = parts.pop(0)
-        size = int(parts.pop(0))
-        month = parts.pop(0)
-        day = parts.pop(0)
-        time = parts.pop(0)
-        if full_format_time:
-            year = parts.pop(0)
-            mtime_str = f"{month} {day} {time} {year}"
-        else:
-            mtime_str = f"{month} {day} {time}"
-
-        name = parts.pop(0)
-        new_entry = Gfls_Entry(name, nlink, uname, gname,
-                               size, dirname, mtime_str, mode_str, perms)
-
-        if is_file:
-            new_entry.name = os.path.basename(new_entry.name)
-
-        new_entry.set_line(line)
-
-        return new_entry
-
-
 async def gfls_generator(
         env,
         path,
@@ -2173,57 +2946,123 @@ async def gfls_generator(
         long_format: bool = True,
         time_format: Literal['full', 'short'] = 'full',
         effperm: bool = False,
-        ign_err: bool = False) -> AsyncGenerator[Union[str, Gfls_Entry], None]:
+        ign_err: bool = False,
+        lane: str = LANE_INTERACTIVE
+) -> AsyncGenerator[Union[str, Gfls_Entry], None]:
+    # is_file=None: detect from the output of gfls
+    # (gfls prints the specified path itself as the name for a file)
+    detect = is_file is None
     dirname = os.path.dirname(path) if is_file else path
     p = await gfls(env, path,
-                   show_hidden, recursive, long_format, time_format, effperm)
+                   show_hidden, recursive, long_format, time_format, effperm,
+                   lane=lane)
 
     elist = []
     stderr_task = asyncio.create_task(log_stderr("gfls", p, elist))
     seen_lines = []
 
-    async for raw in p.stdout:  # Get each line separated by a newline (\n)
-        line = raw.decode("utf-8", errors="replace").rstrip("\n")
-        if not line:
-            continue
-        seen_lines.append(line)
+    try:
+        # Get each line separated by a newline (\n)
+        async for raw in p.stdout:
+            line = raw.decode("utf-8", errors="replace").rstrip("\n")
+            if not line:
+                continue
+            seen_lines.append(line)
 
-        entry = None
-        try:
-            entry = Gfls_Entry.parse(
-                line=line,
-                is_file=is_file,
-                long_format=long_format,
-                full_format_time=(time_format == 'full'),
-                effperm=effperm,
-            )
-        except Exception as e:
-            logger.error(f"gfls_generator: {str(e)}")
-            logger.debug(line)
-        if isinstance(entry, Gfls_Entry):
-            entry.set_dirname(dirname)
-            yield entry
-            continue
+            entry = None
+            try:
+                entry = Gfls_Entry.parse(
+                    line=line,
+                    is_file=is_file,
+                    long_format=long_format,
+                    full_format_time=(time_format == 'full'),
+                    effperm=effperm,
+                )
+            except Exception as e:
+                logger.error(f"gfls_generator: {str(e)}")
+                logger.debug(line)
+            if isinstance(entry, Gfls_Entry):
+                if detect:
+                    detect = False
+                    if (entry.name == path
+                            or entry.name == path.rstrip("/")):
+                        is_file = True
+                        dirname = os.path.dirname(path)
+                        entry.name = os.path.basename(entry.name)
+                entry.set_dirname(dirname)
+                yield entry
+                continue
 
-        if recursive:
-            dirname = os.path.normpath(line[:-1])
-        else:
-            yield line
+            if recursive:
+                dirname = os.path.normpath(line[:-1])
+            else:
+                yield line
 
-    await stderr_task
-    return_code = await p.wait()
+        await stderr_task
+        return_code = await p.wait()
+    finally:
+        # stopped (ex. aclose() after enough entries, disconnected)
+        if p.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                p.kill()
+            with contextlib.suppress(ProcessLookupError, ChildProcessError):
+                await p.wait()
+        if not stderr_task.done():
+            stderr_task.cancel()
 
     if not ign_err and return_code != 0:
         msg = "\n".join(elist) if len(elist) > 0 else "\n".join(seen_lines)
         raise RuntimeError(msg)
 
 
+def gfls_recursive_generator(
+        env,
+        path,
+        is_file,
+        ordered: bool = True,
+        show_hidden: bool = True,
+        long_format: bool = True,
+        time_format: Literal['full', 'short'] = 'full',
+        effperm: bool = False,
+        ign_err: bool = False,
+        lane: str = LANE_INTERACTIVE
+) -> AsyncGenerator[Union[str, Gfls_Entry], None]:
+    """
+    Same as gfls_generator(recursive=True), but the directories are
+    listed by "gfls -l" (without -R) in parallel (RECURSIVE_PARALLEL).
+    ordered=False: breadth-first instead of the order of "gfls -R".
+    """
+    if RECURSIVE_PARALLEL <= 1 or not long_format:
+        # subdirectories are known only by long format
+        return gfls_generator(env, path, is_file, show_hidden, True,
+                              long_format, time_format, effperm, ign_err,
+                              lane)
+
+    def list_dir(dirpath, dir_is_file):
+        return gfls_generator(env, dirpath, dir_is_file, show_hidden, False,
+                              long_format, time_format, effperm, ign_err,
+                              lane)
+
+    # no depth limit (same as "gfls -R")
+    walker = RecursiveWalker(list_dir,
+                             workers=RECURSIVE_PARALLEL,
+                             ordered=ordered,
+                             max_buffered=RECURSIVE_MAX_BUFFERED,
+                             logger=logger)
+    return walker.walk(path, is_file)
+
+
+def stream_frames(chunks):
+    # join small lines of a streaming response (ndjson_stream.frames)
+    return ndjson_stream.frames(chunks, STREAM_FRAME_BYTES, STREAM_FRAME_DELAY)
+
+
 async def gfmkdir(env, path, p=False):
     args = []
     if p:
         args.append('-p')
     args.append(path)
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfmkdir', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2233,7 +3072,7 @@ async def gfmkdir(env, path, p=False):
 
 async def gfrmdir(env, path):
     args = [path]
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfrmdir', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2248,7 +3087,7 @@ async def gfln(env, srcpath, linkpath, symlink):
     args.append(srcpath)
     args.append(linkpath)
 
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfln', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2262,8 +3101,11 @@ async def gfstat(env, path, metadata, check_symlink=None):
         args.append('-M')
     if check_symlink:
         args.append('-l')
-    args.append(path)
-    return await asyncio.create_subprocess_exec(
+    if isinstance(path, list):
+        args.extend(path)
+    else:
+        args.append(path)
+    return await gfarm_subprocess_exec(
         'gfstat', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2273,7 +3115,7 @@ async def gfstat(env, path, metadata, check_symlink=None):
 
 async def gfchmod(env, path, mode):
     args = [mode, path]
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfchmod', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2291,9 +3133,10 @@ async def gfcksum(env,
     if host:
         args.extend(["-h", host])
 
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfcksum', *args,
         env=env,
+        lane=LANE_BULK,
         stdin=asyncio.subprocess.DEVNULL,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE), args
@@ -2320,9 +3163,10 @@ async def gfptar(env,
         args.extend([f"-{cmd}", outdir, "-C", basedir, "--"])
         args.extend(src)
 
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfptar', *args,
         env=env,
+        lane=LANE_BULK,
         stdin=asyncio.subprocess.DEVNULL,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE), args
@@ -2334,7 +3178,7 @@ async def gfuser(env, username: str = None, cmd: str = None):
         args.append(f"-{cmd}")
     if username:
         args.append(username)
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfuser', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2348,7 +3192,7 @@ async def gfgroup(env, groupname: str = None, cmd: str = None):
         args.append(f"-{cmd}")
     if groupname is not None:
         args.append(groupname)
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfgroup', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2373,7 +3217,7 @@ async def gfsetfacl(env, path,
     elif acl_file is not None:
         args.extend(["-M", acl_file])
     args.append(path)
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfsetfacl', *args,
         env=env,
         stdin=asyncio.subprocess.PIPE,
@@ -2383,7 +3227,7 @@ async def gfsetfacl(env, path,
 
 async def gfgetfacl(env, path):
     args = [path]
-    return await asyncio.create_subprocess_exec(
+    return await gfarm_subprocess_exec(
         'gfgetfacl', *args,
         env=env,
         stdin=asyncio.subprocess.DEVNULL,
@@ -2438,20 +3282,201 @@ class FileInfo:
         self.mtime = mtime
 
 
-async def get_file_info(env, path) -> FileInfo:
-    metadata = False
-    proc = await gfstat(env, path, metadata)
+def gfstat_error_path(line, paths):
+    """
+    The path of an error line of gfstat ("<path>: <message>",
+    or "gfstat: <path>: <message>"), or None.
+    The longest path matches if paths contain "<path>: ...".
+    """
+    for prefix in ("", "gfstat: "):
+        if not line.startswith(prefix):
+            continue
+        rest = line[len(prefix):]
+        matched = [p for p in paths if rest.startswith(p + ": ")]
+        if matched:
+            return max(matched, key=len)
+    return None
+
+
+async def gfstat_batch(env, paths, metadata=False, check_symlink=False):
+    """
+    Stat many paths with one gfstat process.
+    Returns {path: Stat or Exception}.
+    """
+    proc = await gfstat(env, list(paths), metadata, check_symlink)
     elist = []
     stderr_task = asyncio.create_task(log_stderr("gfstat", proc, elist))
     data = await proc.stdout.read()
     stdout = data.decode()
     await stderr_task
     return_code = await proc.wait()
-    if return_code != 0:
-        err = classify_gfarm_error(elist)
-        # err.stderr = elist
-        raise err
-    st = parse_gfstat(stdout)
+
+    results = {}
+    blocks = split_gfstat(stdout)
+    if len(paths) == 1:
+        path = paths[0]
+        if return_code == 0 and len(blocks) > 0:
+            results[path] = parse_gfstat(blocks[0])
+        else:
+            results[path] = classify_gfarm_error(elist)
+        return results
+
+    stats = [parse_gfstat(b) for b in blocks]
+    if return_code == 0 and len(stats) == len(paths):
+        # same order as arguments
+        return dict(zip(paths, stats))
+    by_name = {st.File: st for st in stats}
+    errors = {}
+    for e in elist:
+        path = gfstat_error_path(e, paths)
+        if path is not None:
+            errors.setdefault(path, []).append(e)
+    retry = []
+    for path in paths:
+        st = by_name.get(path)
+        if st is not None:
+            results[path] = st
+            continue
+        errs = errors.get(path)
+        if errs:
+            results[path] = classify_gfarm_error(errs)
+        else:
+            retry.append(path)
+    for path in retry:
+        # cannot be matched: stat it alone
+        res = await gfstat_batch(env, [path], metadata, check_symlink)
+        results.update(res)
+    return results
+
+
+async def gfstat_worker_run_plain(env, paths):
+    return await gfstat_batch(env, paths, metadata=False)
+
+
+async def gfstat_worker_run_metadata(env, paths):
+    return await gfstat_batch(env, paths, metadata=True)
+
+
+gfstat_workers = GfarmWorkerPool(gfstat_worker_run_plain,
+                                 idle_timeout=GFARM_WORKER_IDLE_TIMEOUT,
+                                 max_batch=GFARM_WORKER_MAX_BATCH,
+                                 max_inflight=GFARM_WORKER_MAX_INFLIGHT,
+                                 logger=logger)
+gfstat_metadata_workers = GfarmWorkerPool(
+    gfstat_worker_run_metadata,
+    idle_timeout=GFARM_WORKER_IDLE_TIMEOUT,
+    max_batch=GFARM_WORKER_MAX_BATCH,
+    max_inflight=GFARM_WORKER_MAX_INFLIGHT,
+    logger=logger)
+
+
+# (credential key, path, metadata) -> Stat
+stat_cache = TTLCache(maxsize=STAT_CACHE_SIZE, ttl=STAT_CACHE_TTL)
+# incremented by every invalidation
+stat_cache_generation = 0
+
+
+def stat_cache_path(path):
+    return path.rstrip("/") or "/"
+
+
+def invalidate_stat_cache(*paths, recursive=False):
+    """
+    Remove cached Stat of the paths and their parent directories
+    for all users.  recursive=True also removes entries under the paths.
+    """
+    global stat_cache_generation
+    stat_cache_generation += 1
+    if len(stat_cache) == 0:
+        return
+    targets = set()
+    prefixes = []
+    for path in paths:
+        if not path:
+            continue
+        path = stat_cache_path(path)
+        targets.add(path)
+        targets.add(stat_cache_path(os.path.dirname(path)))
+        if recursive:
+            prefixes.append(path.rstrip("/") + "/")
+    prefixes = tuple(prefixes)
+
+    def match(key):
+        path = key[1]
+        return path in targets or (prefixes and path.startswith(prefixes))
+
+    n = stat_cache.delete_if(match)
+    logger.debug(f"invalidate_stat_cache: {paths}: {n} entries")
+
+
+async def get_stat(env, path, metadata=False) -> Stat:
+    """
+    gfstat via the per-credential worker (batched with other requests
+    of the same user).  Raises classified exception on error.
+    """
+    key = (get_credential_key(env), stat_cache_path(path), metadata)
+    st = stat_cache.get(key)
+    if st is not None:
+        return st
+    generation = stat_cache_generation
+    if GFARM_WORKER:
+        pool = gfstat_metadata_workers if metadata else gfstat_workers
+        st = await pool.submit(key[0], env, path)
+    else:
+        res = await gfstat_batch(env, [path], metadata)
+        st = res[path]
+        if isinstance(st, Exception):
+            raise st
+    # not cached if modified while executing gfstat
+    if generation == stat_cache_generation:
+        stat_cache.set(key, st)
+    return st
+
+
+async def get_stats(env, paths, metadata=False):
+    """
+    Stat many paths with as few gfstat processes as possible.
+    Yields (path, Stat or Exception) in order of completion.
+    """
+    pending = []
+    for path in dict.fromkeys(paths):  # unique, keep order
+        key = (get_credential_key(env), stat_cache_path(path), metadata)
+        st = stat_cache.get(key)
+        if st is not None:
+            yield path, st
+        else:
+            pending.append(path)
+    if len(pending) == 0:
+        return
+
+    chunk_size = max(1, GFARM_WORKER_MAX_BATCH)
+    chunks = [pending[i:i + chunk_size]
+              for i in range(0, len(pending), chunk_size)]
+    sem = asyncio.Semaphore(max(1, STAT_BATCH_PARALLEL))
+    generation = stat_cache_generation
+
+    async def run(chunk):
+        async with sem:
+            return await gfstat_batch(env, chunk, metadata)
+
+    tasks = [asyncio.create_task(run(chunk)) for chunk in chunks]
+    try:
+        for task in asyncio.as_completed(tasks):
+            results = await task
+            for path, st in results.items():
+                if not isinstance(st, Exception) \
+                   and generation == stat_cache_generation:
+                    key = (get_credential_key(env), stat_cache_path(path),
+                           metadata)
+                    stat_cache.set(key, st)
+                yield path, st
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def get_file_info(env, path) -> FileInfo:
+    st = await get_stat(env, path)
     exists = True
     is_file = (st.Filetype == "regular file")
     size = st.Size
@@ -2465,6 +3490,146 @@ async def get_file_info(env, path) -> FileInfo:
     )
 
 
+async def get_stat_or_none(env, path, metadata=False) -> Optional[Stat]:
+    try:
+        return await get_stat(env, path, metadata)
+    except Exception as e:
+        logger.debug(f"get_stat_or_none: {path}: {str(e)}")
+        return None
+
+
+def stat_etag(st: Stat, weak=False, variant=None) -> Optional[str]:
+    """
+    ETag from gfstat: changed when the file is replaced (Inode, Gen),
+    or modified (Size, Modify).  variant distinguishes representations
+    of the same file (ex. options of /dir).
+    """
+    if st.Inode is None or st.ModifySeconds is None:
+        return None
+    tag = (f"{st.Inode:x}-{st.Gen or 0:x}-{st.Size or 0:x}"
+           f"-{st.ModifySeconds:x}.{st.ModifyNanos or 0:x}")
+    if variant:
+        tag += "-" + hashlib.sha256(variant.encode()).hexdigest()[:12]
+    if weak:
+        return f'W/"{tag}"'
+    return f'"{tag}"'
+
+
+def body_etag(data: bytes) -> str:
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+
+def http_date(seconds) -> str:
+    return email.utils.formatdate(seconds, usegmt=True)
+
+
+def cache_headers(etag, mtime=None, cache_control=None) -> dict:
+    headers = {}
+    if etag is not None:
+        headers["ETag"] = etag
+    if mtime is not None:
+        headers["Last-Modified"] = http_date(mtime)
+    if cache_control is not None:
+        headers["Cache-Control"] = cache_control
+    return headers
+
+
+def is_not_modified(request: Request, etag, mtime=None) -> bool:
+    """
+    Evaluate If-None-Match (weak comparison) or If-Modified-Since
+    (ignored if If-None-Match exists) of GET request. (RFC 9110)
+    """
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        if etag is None:
+            return False
+        if inm.strip() == "*":
+            return True
+        opaque = etag.removeprefix("W/")
+        return any(tag.strip().removeprefix("W/") == opaque
+                   for tag in inm.split(","))
+    ims = request.headers.get("if-modified-since")
+    if ims is not None and mtime is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def not_modified_response(headers) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                    headers=headers)
+
+
+def response_encoding(request: Request, media_type) -> Optional[str]:
+    """
+    Content-Encoding from Accept-Encoding (None: identity)
+    """
+    if (not COMPRESS_ENCODINGS
+            or not content_encoding.is_compressible(media_type)):
+        return None
+    return content_encoding.choose_encoding(
+        request.headers.get("accept-encoding"), COMPRESS_ENCODINGS)
+
+
+def add_vary(headers: dict, name: str) -> dict:
+    vary = headers.get("Vary")
+    if not vary:
+        headers["Vary"] = name
+    elif name.lower() not in (v.strip().lower() for v in vary.split(",")):
+        headers["Vary"] = f"{vary}, {name}"
+    return headers
+
+
+def encode_headers(headers: dict, media_type, encoding) -> dict:
+    """
+    Vary and Content-Encoding.  (ETag must be encoded_etag().)
+    encoding=None: only Vary (ex. for 304)
+    """
+    if COMPRESS_ENCODINGS and content_encoding.is_compressible(media_type):
+        add_vary(headers, "Accept-Encoding")
+    if encoding is None:
+        return headers
+    headers["Content-Encoding"] = encoding
+    for key in list(headers):
+        if key.lower() == "content-length":
+            del headers[key]
+    return headers
+
+
+def encoded_etag(etag, encoding):
+    # different ETag for each encoding
+    return content_encoding.encoded_etag(etag, encoding)
+
+
+def encode_stream(chunks, encoding, flush_each=False):
+    # compress chunk by chunk
+    # flush_each=True: each chunk is sent without waiting for the next
+    if encoding is None:
+        return chunks
+    return content_encoding.compress_stream(
+        chunks, encoding, COMPRESS_LEVELS[encoding], flush_each)
+
+
+async def encoded_response(request: Request, body: bytes, media_type,
+                           headers=None) -> Response:
+    headers = dict(headers or {})
+    encoding = response_encoding(request, media_type)
+    if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+        level = COMPRESS_LEVELS[encoding]
+        if len(body) >= content_encoding.THREAD_MIN_SIZE:
+            body = await asyncio.to_thread(
+                content_encoding.compress_bytes, body, encoding, level)
+        else:
+            body = content_encoding.compress_bytes(body, encoding, level)
+    else:
+        encoding = None
+    encode_headers(headers, media_type, encoding)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
 async def can_access(env, path, check_perm="w"):
     try:
         info = await get_file_info(env, path)
@@ -2520,6 +3685,41 @@ async def gfuser_info(env, gfarm_username):
     return name, authority, home_directory, identifier
 
 
+# credential key -> (gfarm username, home directory, identifier)
+identity_cache = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+
+
+def get_credential_ttl(env):
+    # access token cannot be used after "exp"
+    if env.get('GFARM_SASL_MECHANISMS') != 'XOAUTH2':
+        return None
+    try:
+        claims = jwt.get_unverified_claims(env.get('GFARM_SASL_PASSWORD'))
+        return claims["exp"] - time.time()
+    except Exception:
+        return 0
+
+
+async def get_user_identity(env, username=None):
+    """
+    (gfarm username, home directory, identifier) of the credentials.
+    The result is cached until the access token expires.
+    Returns None if gfwhoami fails.
+    """
+    key = get_credential_key(env)
+    identity = identity_cache.get(key)
+    if identity is not None:
+        return identity
+    if username is None:
+        username = await get_username(env)
+        if username is None:
+            return None
+    name, _, home_directory, identifier = await gfuser_info(env, username)
+    identity = (name, home_directory, identifier)
+    identity_cache.set(key, identity, ttl=get_credential_ttl(env))
+    return identity
+
+
 async def get_lsinfo(env, path, depth) -> Gfls_Entry:
     if depth > RECURSIVE_MAX_DEPTH:
         raise RuntimeError(
@@ -2530,7 +3730,7 @@ async def get_lsinfo(env, path, depth) -> Gfls_Entry:
         info = FileInfo(exists=False, is_file=False, size=0, mtime=0)
 
     async for entry in gfls_generator(env, path, info.is_file,
-                                      show_hidden=True):
+                                      show_hidden=True, recursive=False):
         entry.name = os.path.basename(path)
         if entry.is_sym:
             if ":" in entry.linkname or \
@@ -2585,7 +3785,7 @@ class AuthenticationError(Exception):
         self.stderr = stderr or []
 
 
-def gfarm_http_error(command, code, message, stdout, elist):
+def gfarm_http_error(command, code, message, stdout, elist, headers=None):
     detail = {
         "command": command,
         "message": message,
@@ -2595,10 +3795,12 @@ def gfarm_http_error(command, code, message, stdout, elist):
     return HTTPException(
         status_code=code,
         detail=detail,
+        headers=headers,
     )
 
 
 EXC_TO_STATUS = {
+    SchedulerBusy: status.HTTP_429_TOO_MANY_REQUESTS,
     FileNotFoundError: status.HTTP_404_NOT_FOUND,
     PermissionError: status.HTTP_403_FORBIDDEN,
     ConnectionRefusedError: status.HTTP_403_FORBIDDEN,
@@ -2623,17 +3825,25 @@ def classify_gfarm_error(elist: list[str]):
     return RuntimeError(msg or "Internal Server Error")
 
 
-def raise_gfarm_http_error(command, err: Exception, stdout="", elist=[]):
+def get_http_status(err: Exception):
     # Select HTTP code depending on exception class (undefined is 500)
-    code = next(
+    return next(
         (code for exc, code in EXC_TO_STATUS.items() if isinstance(err, exc)),
         status.HTTP_500_INTERNAL_SERVER_ERROR,
     )
+
+
+def raise_gfarm_http_error(command, err: Exception, stdout="", elist=[]):
+    code = get_http_status(err)
     stderr = getattr(err, "stderr", [])
     stderr = stderr if isinstance(stderr, list) else [stderr]
     error_list = stderr if len(stderr) > 0 else elist
     message = f"{str(err)}"
-    raise gfarm_http_error(command, code, message, stdout, error_list)
+    headers = None
+    if isinstance(err, SchedulerBusy):
+        headers = {"Retry-After": str(err.retry_after)}
+    raise gfarm_http_error(command, code, message, stdout, error_list,
+                           headers=headers)
 
 
 async def gfarm_command_standard_response(env, proc, command):
@@ -2676,6 +3886,59 @@ async def read_proc_output(opname, proc, elist):
 
 
 #############################################################################
+@app.exception_handler(SchedulerBusy)
+async def scheduler_busy_handler(request: Request, exc: SchedulerBusy):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": {
+            "command": None,
+            "message": str(exc),
+            "stdout": "",
+            "stderr": [],
+        }},
+        headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.get("/status/scheduler")
+async def scheduler_status(
+        request: Request,
+        authorization: Union[str, None] = Header(default=None)):
+    env = await set_env(request, authorization)
+    if get_user_from_env(env) == "anonymous":
+        raise INVALID_AUTHZ
+    return JSONResponse(content=gfarm_scheduler.stats())
+
+
+def metrics_allowed(request, authorization):
+    if METRICS_ALLOW:
+        try:
+            ipaddr = ipaddress.ip_address(get_client_ip_from_request(request))
+        except ValueError:
+            return False
+        if not any(ipaddr in net for net in METRICS_ALLOW):
+            return False
+    if METRICS_TOKEN:
+        expected = f"{AUTHZ_KEY_BEARER} {METRICS_TOKEN}"
+        if not secrets.compare_digest((authorization or "").encode(),
+                                      expected.encode()):
+            return False
+    return True
+
+
+@app.get("/metrics")
+async def get_metrics(request: Request,
+                      authorization: Union[str, None] = Header(default=None)):
+    if not METRICS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not metrics_allowed(request, authorization):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    for lane, st in gfarm_scheduler.stats()["lanes"].items():
+        METRIC_SCHED_ACTIVE.labels(lane).set(st["active"])
+        METRIC_SCHED_QUEUED.labels(lane).set(st["queued"])
+    return Response(content=metrics_registry.render(),
+                    media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/conf/me")
 async def whoami(request: Request,
                  authorization: Union[str, None] = Header(default=None)):
@@ -2687,6 +3950,222 @@ async def whoami(request: Request,
     return await gfarm_command_standard_response(env, p, opname)
 
 
+listing_snapshots = ListingSnapshotStore(TMPDIR_LISTING,
+                                         ttl=DIR_SNAPSHOT_TTL)
+
+
+async def sweep_listing_snapshots():
+    return await asyncio.to_thread(listing_snapshots.cleanup_all)
+
+
+# expired snapshots of all users: at startup and every DIR_SNAPSHOT_TTL
+listing_snapshot_sweeper = Refresher(
+    "listing_snapshots", sweep_listing_snapshots,
+    refresh_interval=DIR_SNAPSHOT_TTL,
+    logger=logger)
+
+
+def listing_sort_key(entry):
+    if isinstance(entry, Gfls_Entry):
+        return entry.path or entry.name or ""
+    return entry
+
+
+async def prefetch_entries(opname, entries):
+    """
+    Reads entries until the first Gfls_Entry (or two lines) before
+    the response is started, so that an error of gfls for the path
+    itself (ex. not found) is returned as HTTP status.
+    Returns (all entries including the read ones, RuntimeError or None).
+    The RuntimeError is raised again by the returned entries.
+    """
+    head = []
+    head_error = None
+    try:
+        async for entry in entries:
+            head.append(entry)
+            if isinstance(entry, Gfls_Entry) or len(head) >= 2:
+                break
+    except RuntimeError as e:
+        err = classify_gfarm_error([str(e)])
+        if not isinstance(err, RuntimeError):
+            raise_gfarm_http_error(opname, err)
+        head_error = e
+
+    async def chain():
+        try:
+            for entry in head:
+                yield entry
+            if head_error is not None:
+                raise head_error
+            async for entry in entries:
+                yield entry
+        finally:
+            await entries.aclose()
+
+    return chain(), head_error
+
+
+async def stream_lines(env, opname, gfarm_path, lines, error_line=None):
+    """
+    Lines of a streaming response (the status code is already sent).
+    An error of gfls (RuntimeError) is sent as the last line by
+    error_line(message, err_code)
+    (default: {"error": message, "err_code": err_code}).
+    """
+    try:
+        async for line in lines:
+            yield line
+    except RuntimeError as e:
+        err = classify_gfarm_error([str(e)])
+        message = f"Failed to execute {opname}: path={gfarm_path} : {str(e)}"
+        if isinstance(err, PermissionError):
+            err_code = status.HTTP_403_FORBIDDEN
+        else:
+            err_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        if error_line is None:
+            yield json.dumps({"error": message, "err_code": err_code}) + "\n"
+        else:
+            yield error_line(message, err_code)
+        user = get_user_from_env(env)
+        ipaddr = get_client_ip_from_env(env)
+        logger.error(f"{ipaddr}:0 user={user}, cmd={opname}, {message}")
+    finally:
+        # disconnected: gfls is killed
+        await lines.aclose()
+
+
+def ndjson_response(request, lines):
+    media_type = 'application/x-ndjson'
+    encoding = response_encoding(request, media_type)
+    headers = encode_headers(cache_headers(None, None, CACHE_CONTROL_DIR),
+                             media_type, encoding)
+    # each frame is compressed and sent without waiting for the next
+    content = encode_stream(stream_frames(lines), encoding, flush_each=True)
+    return StreamingResponse(content=content, media_type=media_type,
+                             headers=headers)
+
+
+def gfls_entries(env, gfarm_path, gfls_options, ordered=True,
+                 lane=LANE_INTERACTIVE):
+    # gfls_options: parameters of gfls_generator() (recursive: parallel)
+    options = dict(gfls_options)
+    if options.pop("recursive", False):
+        return gfls_recursive_generator(
+            env, gfarm_path, None, ordered=ordered, lane=lane, **options)
+    return gfls_generator(env, gfarm_path, None, recursive=False,
+                          lane=lane, **options)
+
+
+def dir_entries(env, gfarm_path, gfls_options, dir_filter=None,
+                sort=None, reverse=False, top=None, ordered=True,
+                entries=None):
+    """
+    gfls_entries() (or entries) -> filter -> sort or first top entries
+    ordered=False: any order of directories for recursive listing
+    """
+    if entries is None:
+        entries = gfls_entries(env, gfarm_path, gfls_options,
+                               ordered=(ordered and sort is None))
+    if dir_filter is not None and dir_filter.active():
+        entries = filter_entries(entries, dir_filter)
+    if sort is not None:
+        entries = sorted_entries(entries, sort, reverse, top)
+    elif top is not None:
+        entries = limit_entries(entries, top)
+    return entries
+
+
+async def dir_list_page(request, env, opname, gfarm_path, cursor, limit,
+                        output_format, gfls_options, dir_filter=None,
+                        sort=None, reverse=False, top=None):
+    user = get_user_from_env(env)
+    if limit is None:
+        limit = DIR_PAGE_MAX
+    if limit < 1:
+        code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        message = "limit must be a positive integer"
+        raise gfarm_http_error(opname, code, message, "", [])
+    limit = min(limit, DIR_PAGE_MAX)
+
+    if cursor is None:
+        # the first page: run gfls and save the sorted listing
+        # (written while reading gfls; not kept in memory)
+        writer = await asyncio.to_thread(listing_snapshots.writer, user)
+        try:
+            # sorted by the writer: no need to list in the order of gfls -R
+            seq = 0
+            async for entry in dir_entries(env, gfarm_path, gfls_options,
+                                           dir_filter, sort, reverse, top,
+                                           ordered=(top is None)):
+                if not isinstance(entry, Gfls_Entry):
+                    line = entry
+                elif output_format in ('json', 'columnar'):
+                    # columnar: converted for each page
+                    line = ndjson_stream.dumps(entry.json_dump())
+                else:
+                    line = entry.line_dump()
+                # sort: already sorted by sorted_entries()
+                key = listing_sort_key(entry) if sort is None else seq
+                seq += 1
+                if writer.add(key, line):
+                    await asyncio.to_thread(writer.spill)
+            cursor = await asyncio.to_thread(writer.commit)
+        except RuntimeError as e:
+            raise_gfarm_http_error(opname, classify_gfarm_error([str(e)]))
+        finally:
+            await asyncio.to_thread(writer.abort)
+    try:
+        lines, next_cursor, total = await asyncio.to_thread(
+            listing_snapshots.read, user, cursor, limit)
+    except SnapshotNotFound:
+        code = status.HTTP_410_GONE
+        message = "The cursor has expired. Restart the listing."
+        raise gfarm_http_error(opname, code, message, "", [])
+    except ValueError as e:
+        code = status.HTTP_400_BAD_REQUEST
+        raise gfarm_http_error(opname, code, str(e), "", [])
+
+    headers = {"X-Total-Count": str(total), "Vary": "Accept"}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if output_format == 'columnar':
+        content = columnar_page(lines)
+    else:
+        content = "".join(line + "\n" for line in lines)
+    return await encoded_response(request, content.encode("utf-8"),
+                                  dir_media_type(output_format), headers)
+
+
+def columnar_page(lines) -> str:
+    # NDJSON lines of a snapshot -> columnar
+    encoder = ColumnarEncoder()
+    out = [encoder.header()]
+    for line in lines:
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict) and "path" in obj and "mode_str" in obj:
+            out.append(encoder.add(obj))
+        else:
+            out.append(encoder.add_line({"line": line}))
+    out.append(encoder.flush())
+    return "".join(out)
+
+
+def dir_media_type(output_format) -> str:
+    if output_format == 'json':
+        return 'application/x-ndjson'
+    if output_format == 'columnar':
+        return dir_columnar.MEDIA_TYPE
+    return 'text/plain'
+
+
+DirEntryType = Literal['file', 'dir', 'link']
+DirSortKey = Literal['name', 'path', 'size', 'mtime']
+
+
 @app.get("/dir/{gfarm_path:path}")
 async def dir_list(gfarm_path: str,
                    request: Request,
@@ -2695,8 +4174,31 @@ async def dir_list(gfarm_path: str,
                    recursive: bool = False,
                    long_format: bool = True,  # noqa: E741
                    time_format: Literal['full', 'short'] = 'full',
-                   output_format: Literal['json', 'plain'] = 'json',
+                   output_format: Optional[
+                       Literal['json', 'plain', 'columnar']] = Query(
+                           None, description="json (default), plain or "
+                           "columnar (default if Accept prefers "
+                           f"{dir_columnar.MEDIA_TYPE})"),
                    ign_err: bool = False,
+                   limit: Optional[int] = None,
+                   cursor: Optional[str] = None,
+                   pattern: Optional[str] = Query(
+                       None, description="glob of entry name"),
+                   regex: Optional[str] = Query(
+                       None, description="regular expression of entry name"),
+                   entry_type: Optional[DirEntryType] = Query(
+                       None, alias="type"),
+                   min_size: Optional[int] = None,
+                   max_size: Optional[int] = None,
+                   min_mtime: Optional[float] = Query(
+                       None, description="seconds since the Epoch"),
+                   max_mtime: Optional[float] = Query(
+                       None, description="seconds since the Epoch"),
+                   sort: Optional[DirSortKey] = None,
+                   order: Literal['asc', 'desc'] = 'asc',
+                   top: Optional[int] = Query(
+                       None, description="only first N entries"
+                       " (required by sort, up to DIR_PAGE_MAX)"),
                    authorization: Union[str, None] = Header(default=None)):
     opname = "gfls"
     apiname = "/dir"
@@ -2705,61 +4207,288 @@ async def dir_list(gfarm_path: str,
     user = get_user_from_env(env)
     ipaddr = get_client_ip_from_env(env)
     log_operation(env, request.method, apiname, opname, gfarm_path)
+
     try:
-        info = await get_file_info(env, gfarm_path)
-    except Exception as err:
-        raise_gfarm_http_error(opname, err)
+        dir_filter = DirFilter(pattern=pattern, regex=regex,
+                               entry_type=entry_type,
+                               min_size=min_size, max_size=max_size,
+                               min_mtime=min_mtime, max_mtime=max_mtime)
+        if sort is not None and top is None:
+            # sorted entries are kept in memory (up to top)
+            raise ValueError("sort requires top")
+        if top is not None and not 1 <= top <= DIR_PAGE_MAX:
+            raise ValueError(f"top must be 1 to {DIR_PAGE_MAX}")
+        if ((dir_filter.active() or sort is not None or top is not None
+             or output_format == 'columnar') and not long_format):
+            raise ValueError(
+                "filter, sort, top and columnar require long_format")
+    except ValueError as e:
+        code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        raise gfarm_http_error(opname, code, str(e), "", [])
+    if output_format is None:
+        # negotiated by Accept
+        if long_format and dir_columnar.accepted(
+                request.headers.get("accept")):
+            output_format = 'columnar'
+        else:
+            output_format = 'json'
+    reverse = (order == 'desc')
+    gfls_options = dict(show_hidden=show_hidden,
+                        recursive=recursive,
+                        long_format=long_format,
+                        time_format=time_format,
+                        effperm=effperm,
+                        ign_err=ign_err)
+
+    if limit is not None or cursor is not None:
+        # Paginated: entries sorted by path (or sort). The first page
+        # creates a snapshot, and the next pages (X-Next-Cursor) are
+        # read from the snapshot without gfls. The other parameters
+        # are ignored when cursor is specified.
+        return await dir_list_page(
+            request, env, opname, gfarm_path, cursor, limit, output_format,
+            gfls_options, dir_filter, sort, reverse, top)
+
+    # Weak ETag from gfstat of the directory (changed by creating,
+    # removing or renaming entries, but not by modifying the files
+    # in it).  Only for names (long_format=off): sizes, mtimes and
+    # modes of the entries are not covered.  Not for recursive listing.
+    validators = DIR_ETAG and not recursive and not long_format
+    variant = (f"{user},{show_hidden},{effperm},{long_format},"
+               f"{time_format},{output_format},{ign_err},"
+               f"{dir_filter.describe()},{sort},{order},{top}")
+    media_type = dir_media_type(output_format)
+    encoding = response_encoding(request, media_type)
+    st = None
+    stat_task = None
+    if validators:
+        if ("if-none-match" in request.headers
+                or "if-modified-since" in request.headers):
+            # conditional: gfstat before gfls
+            st = await get_stat_or_none(env, gfarm_path)
+            if st is not None:
+                etag = encoded_etag(
+                    stat_etag(st, weak=True, variant=variant), encoding)
+                if is_not_modified(request, etag, st.ModifySeconds):
+                    headers = cache_headers(etag, st.ModifySeconds,
+                                            CACHE_CONTROL_DIR)
+                    add_vary(headers, "Accept")
+                    return not_modified_response(
+                        encode_headers(headers, media_type, None))
+        else:
+            # gfstat in parallel with gfls
+            stat_task = asyncio.create_task(
+                get_stat_or_none(env, gfarm_path))
+
+    # Start gfls without gfstat. Whether the path is a file is detected
+    # from the output. The first line is held until the second line
+    # (or the end) to return an error of gfls as HTTP status.
+    # Filter, sort and top are applied while reading the output of gfls.
+    try:
+        source, head_error = await prefetch_entries(
+            opname, gfls_entries(env, gfarm_path, gfls_options,
+                                 ordered=(sort is None)))
+    except HTTPException:
+        if stat_task is not None:
+            stat_task.cancel()
+        raise
+    entries = dir_entries(env, gfarm_path, gfls_options,
+                          dir_filter, sort, reverse, top, entries=source)
+
+    if stat_task is not None:
+        st = await stat_task
+    if st is not None and head_error is None:
+        etag = encoded_etag(stat_etag(st, weak=True, variant=variant),
+                            encoding)
+        headers = cache_headers(etag, st.ModifySeconds, CACHE_CONTROL_DIR)
+    else:
+        headers = cache_headers(None, None, CACHE_CONTROL_DIR)
+    add_vary(headers, "Accept")
+    encode_headers(headers, media_type, encoding)
 
     output_data = []
+    # columnar: entries are sent in blocks
+    encoder = ColumnarEncoder() if output_format == 'columnar' else None
 
-    async def list_generator():
-        try:
-            async for entry in gfls_generator(
-                    env, gfarm_path, info.is_file,
-                    show_hidden=show_hidden,
-                    recursive=recursive,
-                    long_format=long_format,
-                    time_format=time_format,
-                    effperm=effperm,
-                    ign_err=ign_err):
-                if isinstance(entry, Gfls_Entry):
-                    if output_format == 'json':
-                        # output_data.append(entry.json_dump())
-                        # print(entry.json_dump())
-                        yield json.dumps(entry.json_dump()) + "\n"
-                    else:
-                        # output_data.append(entry.line_dump())
-                        yield entry.line_dump() + "\n"
-                else:
-                    # output_data.append(entry)
-                    yield entry + "\n"
-        except RuntimeError as e:
-            err = classify_gfarm_error([str(e)])
-            message = f"Failed to execute gfls: path={gfarm_path} : {str(e)}"
-            if isinstance(err, PermissionError):
-                err_code = status.HTTP_403_FORBIDDEN
-            else:
-                err_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    def to_output(entry):
+        if isinstance(entry, Gfls_Entry):
             if output_format == 'json':
-                yield json.dumps(
-                    {"error": message, "err_code": err_code}) + "\n"
+                # output_data.append(entry.json_dump())
+                # print(entry.json_dump())
+                return ndjson_stream.dumps(entry.json_dump()) + "\n"
             else:
-                yield message + "\n"
-            logger.error(
-                f"{ipaddr}:0 user={user}, cmd={opname}, {message}")
-            # raise gfarm_http_error(opname, code, message, str(e), elist)
+                # output_data.append(entry.line_dump())
+                return entry.line_dump() + "\n"
+        else:
+            # output_data.append(entry)
+            return entry + "\n"
+
+    async def columnar_items():
+        async for entry in entries:
+            if isinstance(entry, Gfls_Entry):
+                yield entry.json_dump()
+            else:
+                yield {"line": entry}
+
+    async def list_generator():
+        try:
+            if encoder is not None:
+                # a slow listing is also sent every STREAM_FRAME_DELAY
+                async with contextlib.aclosing(dir_columnar.encode_stream(
+                        columnar_items(), encoder,
+                        STREAM_FRAME_DELAY)) as lines:
+                    async for line in lines:
+                        yield line
+                return
+            async for entry in entries:
+                yield to_output(entry)
+        finally:
+            await entries.aclose()
+
+    def error_line(message, err_code):
+        if encoder is not None:
+            return encoder.add_line({"error": message, "err_code": err_code})
+        elif output_format == 'json':
+            return json.dumps({"error": message, "err_code": err_code}) + "\n"
+        return message + "\n"
 
     logger.debug(f"{ipaddr}:0 user={user}, cmd={opname}, stdout={output_data}")
-    if output_format == 'json':
-        return StreamingResponse(content=list_generator(),
-                                 media_type='application/x-ndjson')
+    lines = stream_lines(env, opname, gfarm_path, list_generator(),
+                         error_line)
+    # each frame is compressed and sent without waiting for the next
+    content = encode_stream(stream_frames(lines), encoding, flush_each=True)
+    if output_format != 'plain':
+        return StreamingResponse(content=content,
+                                 media_type=media_type,
+                                 headers=headers)
         # return JSONResponse(content=output_data)
 
-    return StreamingResponse(content=list_generator(),
-                             media_type='text/plain')
+    return StreamingResponse(content=content,
+                             media_type='text/plain',
+                             headers=headers)
     # return PlainTextResponse(content="\n".join(output_data))
 
 
+@app.get("/du/{gfarm_path:path}")
+async def dir_usage(gfarm_path: str,
+                    request: Request,
+                    depth: int = Query(
+                        1, description="totals of directories up to depth "
+                        "(0: only gfarm_path)"),
+                    show_hidden: bool = True,
+                    ign_err: bool = False,
+                    authorization: Union[str, None] = Header(default=None)):
+    """
+    Size and number of files and directories under each directory
+    (NDJSON, children before the parent, gfarm_path last).
+    {"progress": true, ...} lines are partial totals of the walk.
+    """
+    opname = "gfls"
+    apiname = "/du"
+    gfarm_path = fullpath(gfarm_path)
+    env = await set_env(request, authorization)
+    log_operation(env, request.method, apiname, opname, gfarm_path)
+    if depth < 0:
+        code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        message = "depth must be 0 or a positive integer"
+        raise gfarm_http_error(opname, code, message, "", [])
+
+    # same order as "gfls -R": the memory is proportional to the depth
+    entries, _ = await prefetch_entries(opname, gfls_recursive_generator(
+        env, gfarm_path, None, ordered=True, show_hidden=show_hidden,
+        long_format=True, time_format='full', ign_err=ign_err,
+        lane=LANE_BULK))
+
+    async def usage_generator():
+        records = disk_usage(entries, gfarm_path, depth,
+                             DU_PROGRESS_INTERVAL)
+        try:
+            async for record in records:
+                yield ndjson_stream.dumps(record) + "\n"
+        finally:
+            await records.aclose()
+
+    return ndjson_response(
+        request, stream_lines(env, opname, gfarm_path, usage_generator()))
+
+
+@app.get("/find/{gfarm_path:path}")
+async def find(gfarm_path: str,
+               request: Request,
+               pattern: Optional[str] = Query(
+                   None, description="glob of the name (ex. *.txt)"),
+               regex: Optional[str] = Query(
+                   None, description="regular expression of the name"),
+               entry_type: Optional[DirEntryType] = Query(None, alias="type"),
+               min_size: Optional[int] = None,
+               max_size: Optional[int] = None,
+               min_mtime: Optional[float] = Query(
+                   None, description="seconds since the Epoch"),
+               max_mtime: Optional[float] = Query(
+                   None, description="seconds since the Epoch"),
+               uname: Optional[str] = Query(None, description="owner"),
+               gname: Optional[str] = Query(None, description="group"),
+               max_results: Optional[int] = Query(
+                   None, description="stop after N matches"),
+               show_hidden: bool = True,
+               effperm: bool = False,
+               ign_err: bool = False,
+               authorization: Union[str, None] = Header(default=None)):
+    """
+    Entries under gfarm_path matching all of the conditions
+    (NDJSON, same as GET /dir?output_format=json).
+    """
+    opname = "gfls"
+    apiname = "/find"
+    gfarm_path = fullpath(gfarm_path)
+    env = await set_env(request, authorization)
+    log_operation(env, request.method, apiname, opname, gfarm_path)
+
+    try:
+        dir_filter = DirFilter(pattern=pattern, regex=regex,
+                               entry_type=entry_type,
+                               min_size=min_size, max_size=max_size,
+                               min_mtime=min_mtime, max_mtime=max_mtime,
+                               uname=uname, gname=gname)
+        if max_results is not None and max_results < 1:
+            raise ValueError("max_results must be a positive integer")
+    except ValueError as e:
+        code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        raise gfarm_http_error(opname, code, str(e), "", [])
+
+    # only the first line of the root directory is read before the
+    # response (not the first match: the response is started soon)
+    walk, _ = await prefetch_entries(opname, gfls_recursive_generator(
+        env, gfarm_path, None, ordered=False, show_hidden=show_hidden,
+        long_format=True, time_format='full', effperm=effperm,
+        ign_err=ign_err, lane=LANE_BULK))
+
+    async def found():
+        # conditions are checked for each line of gfls while walking
+        # (the order of directories does not matter)
+        try:
+            async for entry in walk:
+                if (isinstance(entry, Gfls_Entry)
+                        and entry.name not in (".", "..")):
+                    yield entry
+        finally:
+            await walk.aclose()
+
+    async def find_generator():
+        entries = filter_entries(found(), dir_filter)
+        if max_results is not None:
+            # gfls is killed after max_results entries
+            entries = limit_entries(entries, max_results)
+        try:
+            async for entry in entries:
+                yield ndjson_stream.dumps(entry.json_dump()) + "\n"
+        finally:
+            await entries.aclose()
+
+    return ndjson_response(
+        request, stream_lines(env, opname, gfarm_path, find_generator()))
+
+
 @app.get("/symlink/{gfarm_path:path}")
 async def get_symlink(gfarm_path: str,
                       request: Request,
@@ -2774,13 +4503,7 @@ async def get_symlink(gfarm_path: str,
     elist = []
     try:
         log_operation(env, request.method, apiname, opname, gfarm_path)
-        metadata = True
-        proc = await gfstat(env, gfarm_path, metadata, False)
-
-        stdout = await read_proc_output(opname, proc, elist)
-        if stdout is None:
-            raise classify_gfarm_error(elist)
-        st = parse_gfstat(stdout)
+        st = await get_stat(env, gfarm_path, metadata=True)
         logger.debug("Stat=\n" + pf(st.model_dump()))
         if st.Filetype == "regular file" and not get_fullpath:
             return JSONResponse(content={
@@ -2831,7 +4554,10 @@ async def symlink_create(
     env = await set_env(request, authorization)
     log_operation(env, request.method, apiname, opname, gfarm_path)
     proc = await gfln(env, gfarm_path, symlink_path, symlink)
-    return await gfarm_command_standard_response(env, proc, opname)
+    try:
+        return await gfarm_command_standard_response(env, proc, opname)
+    finally:
+        invalidate_stat_cache(symlink_path)
 
 
 @app.put("/dir/{gfarm_path:path}")
@@ -2847,7 +4573,10 @@ async def dir_create(gfarm_path: str,
     env = await set_env(request, authorization)
     log_operation(env, request.method, apiname, opname, gfarm_path)
     proc = await gfmkdir(env, gfarm_path, p)
-    return await gfarm_command_standard_response(env, proc, opname)
+    try:
+        return await gfarm_command_standard_response(env, proc, opname)
+    finally:
+        invalidate_stat_cache(gfarm_path)
 
 
 @app.delete("/dir/{gfarm_path:path}")
@@ -2862,7 +4591,10 @@ async def dir_remove(gfarm_path: str,
     env = await set_env(request, authorization)
     log_operation(env, request.method, apiname, opname, gfarm_path)
     p = await gfrmdir(env, gfarm_path)
-    return await gfarm_command_standard_response(env, p, opname)
+    try:
+        return await gfarm_command_standard_response(env, p, opname)
+    finally:
+        invalidate_stat_cache(gfarm_path, recursive=True)
 
 
 # BUFSIZE = 1
@@ -2886,17 +4618,28 @@ async def file_export(gfarm_path: str,
     ipaddr = get_client_ip_from_env(env)
     log_operation(env, request.method, apiname, opname, gfarm_path)
     try:
-        info = await get_file_info(env, gfarm_path)
+        st = await get_stat(env, gfarm_path)
     except Exception as err:
         raise_gfarm_http_error(opname, err)
-    if not info.is_file:
+    if st.Filetype != "regular file":
         code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
         message = "The requested URL does not represent a file."
         stdout = ""
         elist = []
         raise gfarm_http_error(opname, code, message, stdout, elist)
 
-    if int(info.size) <= 0:
+    # compressed only if the type is text (ex. text/plain, text/csv)
+    ct = get_content_type(gfarm_path)
+    encoding = None
+    if int(st.Size) >= COMPRESS_MIN_SIZE:
+        encoding = response_encoding(request, ct)
+    validators = encode_headers(
+        cache_headers(encoded_etag(stat_etag(st), encoding),
+                      st.ModifySeconds, CACHE_CONTROL_FILE),
+        ct, None)
+    if is_not_modified(request, validators.get("ETag"), st.ModifySeconds):
+        return not_modified_response(validators)
+    if int(st.Size) <= 0:
         return Response(status_code=204)  # 0 byte OK
 
     env = await set_env(request, authorization)  # may refresh
@@ -2906,7 +4649,7 @@ async def file_export(gfarm_path: str,
         stderr_task = asyncio.create_task(log_stderr(opname, p, elist))
     else:
         # stderr is not supported
-        p, args = sync_gfexport(env, gfarm_path)
+        p, args = await sync_gfexport(env, gfarm_path)
 
     # size > 0
     if ASYNC_GFEXPORT:
@@ -2926,6 +4669,8 @@ async def file_export(gfarm_path: str,
         raise gfarm_http_error(opname, code, message, stdout, elist)
 
     async def generate():
+        sent_bytes = METRIC_TRANSFER_BYTES.labels(apiname, "out")
+        sent_bytes.inc(len(first_byte))
         yield first_byte
 
         while True:
@@ -2935,6 +4680,7 @@ async def file_export(gfarm_path: str,
                 d = p.stdout.read(BUFSIZE)
             if not d:
                 break
+            sent_bytes.inc(len(d))
             yield d
         if ASYNC_GFEXPORT:
             await stderr_task
@@ -2947,9 +4693,9 @@ async def file_export(gfarm_path: str,
                 f"{ipaddr}:0 user={user}, cmd={opname}, path={gfarm_path},"
                 f" return={return_code}, stderr={str(elist)}")
 
-    ct = get_content_type(gfarm_path)
-    cl = str(info.size)
+    cl = str(st.Size)
     headers = {"content-length": cl}
+    headers.update(validators)
     if action == 'download':
         filename = os.path.basename(gfarm_path).strip()
         ascii_fallback = filename.encode("ascii", "ignore").decode()
@@ -2962,7 +4708,8 @@ async def file_export(gfarm_path: str,
             f"filename*=UTF-8''{encoded}"
         )
         headers.update({"content-disposition": cd})
-    return StreamingResponse(content=generate(),
+    encode_headers(headers, ct, encoding)
+    return StreamingResponse(content=encode_stream(generate(), encoding),
                              media_type=ct,
                              headers=headers,
                              )
@@ -3043,14 +4790,12 @@ async def zip_export(request: Request,
     user = get_user_from_env(env)
     ipaddr = get_client_ip_from_env(env)
     log_operation(env, request.method, apiname, opname, paths)
-    filedatas = []
-    for filepath in paths:
-        try:
-            env = await set_env(request, authorization)
-            info = await get_file_info(env, filepath)
-        except Exception as err:
-            raise_gfarm_http_error(opname, err)
-        filedatas.append((filepath, info.is_file))
+    is_file = {}
+    async for filepath, st in get_stats(env, paths):
+        if isinstance(st, Exception):
+            raise_gfarm_http_error(opname, st)
+        is_file[filepath] = (st.Filetype == "regular file")
+    filedatas = [(filepath, is_file[filepath]) for filepath in paths]
 
     async def add_entry_to_zip(zipf: zipfile.ZipFile, entry: Gfls_Entry,
                                loop, executor):
@@ -3080,8 +4825,7 @@ async def zip_export(request: Request,
             stderr_task = None
             dest = None
             try:
-                env_e = await set_env(request, authorization)
-                proc, _ = await gfexport(env_e, entry.path)
+                proc, _ = await gfexport(env, entry.path)
                 elist = []
                 stderr_task = asyncio.create_task(
                     log_stderr(opname, proc, elist))
@@ -3155,9 +4899,8 @@ async def zip_export(request: Request,
             try:
                 for filepath, is_file in filedatas:
                     parent = os.path.dirname(filepath)
-                    env_p = await set_env(request, authorization)
-                    async for entry in gfls_generator(
-                            env_p, filepath, is_file):
+                    async for entry in gfls_recursive_generator(
+                            env, filepath, is_file, ordered=False):
                         if await request.is_disconnected():
                             stop_evt.set()
                         if stop_evt.is_set():
@@ -3232,8 +4975,10 @@ async def zip_export(request: Request,
                                      flush_immediately=True)
         task = asyncio.create_task(create_zip(zip_writer))
         try:
+            sent_bytes = METRIC_TRANSFER_BYTES.labels(apiname, "out")
             async for chunk in zip_writer.get_chunks():
                 logger.debug("zip: generate(): yield")
+                sent_bytes.inc(len(chunk))
                 yield chunk
         except asyncio.CancelledError:
             logger.info(
@@ -3246,6 +4991,7 @@ async def zip_export(request: Request,
         finally:
             with contextlib.suppress(asyncio.CancelledError):
                 await task
+            await keeper.stop()
             logger.debug("zip_export done")
 
     date_str = datetime.now().strftime('%Y%m%d-%H%M%S')
@@ -3253,8 +4999,13 @@ async def zip_export(request: Request,
     base_folder_name = os.path.basename(target_dir) or "download"
     zipname = f"{base_folder_name}_{date_str}.zip"
     headers = {"Content-Disposition": f'attachment; filename="{zipname}"'}
-    return StreamingResponse(
+    # refreshed in background until the response ends
+    # (create_zip() uses this env)
+    keeper = CredentialKeeper(request, env)
+    env = await keeper.start()
+    return CredentialStreamingResponse(
         content=generate(),
+        keeper=keeper,
         media_type="application/zip",
         headers=headers)
 
@@ -3290,8 +5041,10 @@ async def file_import(gfarm_path: str,
     elist = []
     stderr_task = asyncio.create_task(log_stderr(opname, p, elist))
     error = None
+    received_bytes = METRIC_TRANSFER_BYTES.labels(apiname, "in")
     try:
         async for chunk in request.stream():
+            received_bytes.inc(len(chunk))
             p.stdin.write(chunk)
             await p.stdin.drain()  # speedup
     except Exception as e:
@@ -3314,6 +5067,7 @@ async def file_import(gfarm_path: str,
         return_code = await p2.wait()
         logger.debug(f"{ipaddr}:0 user={user}, cmd={gfmv_cmd}, src={tmppath},"
                      f" dest={gfarm_path}, return={return_code}")
+        invalidate_stat_cache(gfarm_path)
         if return_code == 0:
             return Response(status_code=200)
 
@@ -3351,7 +5105,10 @@ async def file_remove(gfarm_path: str,
     env = await set_env(request, authorization)
     log_operation(env, request.method, apiname, opname, gfarm_path)
     p = await gfrm(env, gfarm_path, force, recursive)
-    return await gfarm_command_standard_response(env, p, opname)
+    try:
+        return await gfarm_command_standard_response(env, p, opname)
+    finally:
+        invalidate_stat_cache(gfarm_path, recursive=True)
 
 
 @app.put("/copy")
@@ -3389,22 +5146,29 @@ async def file_copy(copy_data: FileOperation,
     tmpname = f"gfarm-http.copy.{filename_prefix}.{randstr}"
     tmppath = os.path.join(dest_dir, tmpname)
 
-    p_export, args = await gfexport(env, gfarm_path)
-    stderr_export = asyncio.create_task(
-        log_stderr("gfexport", p_export, elist))
-    first_byte = await p_export.stdout.read(1)
-    if not first_byte:
-        await stderr_export
-        if await can_access(env, gfarm_path, "r"):
-            code = status.HTTP_403_FORBIDDEN
-            message = f"Cannot read: {gfarm_path}"
-        else:
-            code = status.HTTP_500_INTERNAL_SERVER_ERROR
-            message = f"Failed to execute: gfexport {' '.join(args)}"
-        stdout = ""
-        raise gfarm_http_error(opname, code, message, stdout, elist)
+    # refreshed in background until the response ends
+    keeper = CredentialKeeper(request, env)
+    env = await keeper.start()
+    try:
+        p_export, args = await gfexport(env, gfarm_path)
+        stderr_export = asyncio.create_task(
+            log_stderr("gfexport", p_export, elist))
+        first_byte = await p_export.stdout.read(1)
+        if not first_byte:
+            await stderr_export
+            if await can_access(env, gfarm_path, "r"):
+                code = status.HTTP_403_FORBIDDEN
+                message = f"Cannot read: {gfarm_path}"
+            else:
+                code = status.HTTP_500_INTERNAL_SERVER_ERROR
+                message = f"Failed to execute: gfexport {' '.join(args)}"
+            stdout = ""
+            raise gfarm_http_error(opname, code, message, stdout, elist)
 
-    p_reg, _ = await gfreg(env, tmppath, info.mtime)
+        p_reg, _ = await gfreg(env, tmppath, info.mtime)
+    except BaseException:
+        await keeper.stop()
+        raise
     stderr_reg = asyncio.create_task(log_stderr("gfreg", p_reg, elist))
     opname = "gfreg"
     log_operation(env, request.method, apiname, opname, gfarm_path)
@@ -3414,10 +5178,12 @@ async def file_copy(copy_data: FileOperation,
                       "error": None,
                       "done": False}
 
-    async def progress_generator():
+    async def copy_generator():
+        copied_bytes = METRIC_TRANSFER_BYTES.labels(apiname, "copy")
         copied = 1
         p_reg.stdin.write(first_byte)
         await p_reg.stdin.drain()
+        copied_bytes.inc(1)
         current_status["copied"] = copied
         yield json.dumps(current_status) + "\n"
         try:
@@ -3428,6 +5194,7 @@ async def file_copy(copy_data: FileOperation,
                 p_reg.stdin.write(chunk)
                 await p_reg.stdin.drain()
                 copied += len(chunk)
+                copied_bytes.inc(len(chunk))
                 # yield JSON line
                 current_status["copied"] = copied
                 yield json.dumps(current_status) + "\n"
@@ -3474,20 +5241,20 @@ async def file_copy(copy_data: FileOperation,
 
         # final move
         try:
-            fresh_env = await set_env(request, authorization)
-            p_mv = await gfmv(fresh_env, tmppath, dest_path)
+            p_mv = await gfmv(env, tmppath, dest_path)
             stderr_mv = asyncio.create_task(log_stderr("gfmv", p_mv, elist))
             opname = "gfmv"
-            log_operation(fresh_env, request.method,
+            log_operation(env, request.method,
                           apiname, opname, gfarm_path)
             await stderr_mv
             return_code_mv = await p_mv.wait()
+            invalidate_stat_cache(dest_path)
 
             if return_code_mv != 0:
                 raise RuntimeError(f"gfmv failed: rc={return_code_mv}")
 
             ok, error_message = await match_checksum(
-                fresh_env, request.method, apiname,
+                env, request.method, apiname,
                 gfarm_path, dest_path, elist)
             current_status["warn"] = error_message if ok is None else None
             current_status["error"] = None if ok is None else error_message
@@ -3496,8 +5263,7 @@ async def file_copy(copy_data: FileOperation,
 
         except Exception as e:
             try:
-                fresh_env = await set_env(request, authorization)
-                p_clean = await gfrm(fresh_env, tmppath, force=True)
+                p_clean = await gfrm(env, tmppath, force=True)
                 await asyncio.create_task(log_stderr("gfrm", p_clean, elist))
                 await p_clean.wait()
             except Exception:
@@ -3506,8 +5272,16 @@ async def file_copy(copy_data: FileOperation,
             current_status["done"] = True
             yield json.dumps(current_status) + "\n"
 
-    return StreamingResponse(progress_generator(),
-                             media_type="application/x-ndjson")
+    async def progress_generator():
+        try:
+            async for line in copy_generator():
+                yield line
+        finally:
+            await keeper.stop()
+
+    return CredentialStreamingResponse(stream_frames(progress_generator()),
+                                       keeper=keeper,
+                                       media_type="application/x-ndjson")
 
 
 @app.post("/move")
@@ -3524,7 +5298,51 @@ async def move_rename(request: Request,
     log_operation(env, request.method, apiname, opname,
                   {"src": src, "dest": dest})
     p = await gfmv(env, src, dest)
-    return await gfarm_command_standard_response(env, p, opname)
+    try:
+        return await gfarm_command_standard_response(env, p, opname)
+    finally:
+        invalidate_stat_cache(src, dest, recursive=True)
+
+
+class StatPaths(BaseModel):
+    paths: List[str]
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "paths": ["/tmp/testfile1", "/tmp/testdir1"],
+                }
+            ]
+        }
+    }
+
+
+@app.post("/attr")
+async def get_attrs(stat_paths: StatPaths,
+                    request: Request,
+                    authorization: Union[str, None] = Header(default=None)):
+    opname = "gfstat"
+    apiname = "/attr"
+    paths = [fullpath(path.lstrip("/")) for path in stat_paths.paths]
+    if STAT_BATCH_MAX_PATHS > 0 and len(paths) > STAT_BATCH_MAX_PATHS:
+        code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        message = f"Too many paths (max {STAT_BATCH_MAX_PATHS})"
+        raise gfarm_http_error(opname, code, message, "", [])
+    env = await set_env(request, authorization)
+    log_operation(env, request.method, apiname, opname, paths)
+
+    async def generate():
+        async for path, st in get_stats(env, paths, metadata=True):
+            if isinstance(st, Exception):
+                yield json.dumps({"File": path,
+                                  "error": str(st),
+                                  "err_code": get_http_status(st)}) + "\n"
+            else:
+                yield json.dumps(st.model_dump()) + "\n"
+
+    return StreamingResponse(content=stream_frames(generate()),
+                             media_type="application/x-ndjson")
 
 
 @app.get("/attr/{gfarm_path:path}")
@@ -3547,13 +5365,16 @@ async def get_attr(gfarm_path: str,
         log_operation(env, request.method, apiname, opname, gfarm_path)
         logger.debug(f"{ipaddr}:0 user={user}, "
                      f"cmd={opname}, path={gfarm_path}")
-        metadata = True
-        proc = await gfstat(env, gfarm_path, metadata, check_symlink)
+        if check_symlink:
+            metadata = True
+            proc = await gfstat(env, gfarm_path, metadata, check_symlink)
 
-        stdout = await read_proc_output(opname, proc, elist)
-        if stdout is None:
-            raise Exception(str(elist))
-        st = parse_gfstat(stdout)
+            stdout = await read_proc_output(opname, proc, elist)
+            if stdout is None:
+                raise Exception(str(elist))
+            st = parse_gfstat(stdout)
+        else:
+            st = await get_stat(env, gfarm_path, metadata=True)
         logger.debug("Stat=\n" + pf(st.model_dump()))
         result_json = st.model_dump()
 
@@ -3591,10 +5412,19 @@ async def get_attr(gfarm_path: str,
                 result_json["Cksum"] = ""
                 result_json["CksumType"] = ""
 
-        return JSONResponse(content=result_json)
+        # ETag of the response body (Access etc. are changed
+        # without changing Modify)
+        response = JSONResponse(content=result_json)
+        headers = cache_headers(body_etag(response.body), None,
+                                CACHE_CONTROL_ATTR)
+        if is_not_modified(request, headers["ETag"]):
+            return not_modified_response(headers)
+        response.headers.update(headers)
+        return response
 
     except Exception as err:
-        if "authentication error" in str(elist):
+        if isinstance(err, AuthenticationError) \
+                or "authentication error" in str(elist):
             code = status.HTTP_401_UNAUTHORIZED
             message = "Authentication error"
             raise gfarm_http_error(opname, code, message, stdout, elist)
@@ -3621,7 +5451,11 @@ async def change_attr(gfarm_path: str,
         log_operation(env, request.method, apiname, opname,
                       (stat.Mode, gfarm_path))
         proc = await gfchmod(env, gfarm_path, stat.Mode)
-        response = await gfarm_command_standard_response(env, proc, opname)
+        try:
+            response = await gfarm_command_standard_response(
+                env, proc, opname)
+        finally:
+            invalidate_stat_cache(gfarm_path)
     if response:
         return response
     else:
@@ -3683,6 +5517,7 @@ async def set_acl(gfarm_path: str,
     acl_str = acl.make_acl_str("\n") + "\n"
     proc, args = await gfsetfacl(env, gfarm_path, _b=True, acl_file="-")
     stdout, _ = await proc.communicate(input=acl_str.encode())
+    invalidate_stat_cache(gfarm_path)
     elist = []
     stdout = stdout.decode()
     return_code = await proc.wait()
@@ -3752,9 +5587,11 @@ async def get_usernames(request: Request,
                 'identifier': parts[3]
             }
             name_entries.append(entry_dict)
-        return JSONResponse(content={"list": name_entries})
+        content = {"list": name_entries}
     else:
-        return JSONResponse(content={"list": name_list})
+        content = {"list": name_list}
+    return await encoded_response(request, JSONResponse(content).body,
+                                  "application/json")
 
 
 @app.get("/groups")
@@ -3781,9 +5618,11 @@ async def get_groups(request: Request,
                 'menbers': parts[1]
             }
             name_entries.append(entry_dict)
-        return JSONResponse(content={"list": name_entries})
+        content = {"list": name_entries}
     else:
-        return JSONResponse(content={"list": name_list})
+        content = {"list": name_list}
+    return await encoded_response(request, JSONResponse(content).body,
+                                  "application/json")
 
 
 class Tar(BaseModel):
@@ -3818,8 +5657,9 @@ async def archive_files(
     apiname = "/gfptar"
     env = await set_env(request, authorization)
     # Set the token file path in env for long-term exec
-    # (updated in progress_generator())
-    tokenfilepath, env, expire = await update_token_file(request, env)
+    # (refreshed in background until the response ends)
+    keeper = CredentialKeeper(request, env)
+    env = await keeper.start()
     user = get_user_from_env(env)
     ipaddr = get_client_ip_from_env(env)
     log_operation(env, request.method, apiname, opname, tar_data)
@@ -3841,41 +5681,38 @@ async def archive_files(
     options = tar_dict.get("options", None)
 
     try:
-        info = await get_file_info(env, basedir if cmd == 't' else outdir)
-    except Exception as err:
-        if cmd != 'c' and cmd != 'x':
-            raise_gfarm_http_error(opname, err)
-        info = FileInfo(exists=False, is_file=False, size=0, mtime=0)
-    if cmd == 'c' or cmd == 'x':
-        if info.exists:
-            code = status.HTTP_403_FORBIDDEN
-            message = f"Output directory already exists : path={outdir}"
-            stdout = ""
-            raise gfarm_http_error(opname, code, message, stdout, [])
+        try:
+            info = await get_file_info(env,
+                                       basedir if cmd == 't' else outdir)
+        except Exception as err:
+            if cmd != 'c' and cmd != 'x':
+                raise_gfarm_http_error(opname, err)
+            info = FileInfo(exists=False, is_file=False, size=0, mtime=0)
+        if cmd == 'c' or cmd == 'x':
+            if info.exists:
+                code = status.HTTP_403_FORBIDDEN
+                message = f"Output directory already exists : path={outdir}"
+                stdout = ""
+                raise gfarm_http_error(opname, code, message, stdout, [])
 
-    p, args = await gfptar(env, cmd, outdir, basedir, src, options)
-    elist = []
-    stderr_task = asyncio.create_task(log_stderr(opname, p, elist))
+        p, args = await gfptar(env, cmd, outdir, basedir, src, options)
+        elist = []
+        stderr_task = asyncio.create_task(log_stderr(opname, p, elist))
 
-    first_byte = await p.stdout.read(1)
-    if not first_byte and cmd != "t":
-        await stderr_task
-        code = status.HTTP_500_INTERNAL_SERVER_ERROR
-        error = elist[-1] if len(elist) > 0 else ""
-        message = f"Failed to execute: gfptar {' '.join(args)} : {error}"
-        stdout = ""
-        try:
-            if tokenfilepath:
-                os.remove(tokenfilepath)
-        except Exception as e:
-            logger.error(
-                f"{ipaddr}:0 user={user}, cmd={opname},"
-                f"os.remove({tokenfilepath}) error: {e}")
-        raise gfarm_http_error(opname, code, message, stdout, elist)
+        first_byte = await p.stdout.read(1)
+        if not first_byte and cmd != "t":
+            await stderr_task
+            code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            error = elist[-1] if len(elist) > 0 else ""
+            message = f"Failed to execute: gfptar {' '.join(args)} : {error}"
+            stdout = ""
+            raise gfarm_http_error(opname, code, message, stdout, elist)
+    except BaseException:
+        await keeper.stop()
+        raise
 
     async def progress_generator():
         try:
-            exp = expire
             buffer = first_byte
             if b"\r" in buffer or b"\n" in buffer:
                 yield json.dumps({"message": ""}) + '\n'
@@ -3893,9 +5730,6 @@ async def archive_files(
                     yield j_line + '\n'
                     logger.debug(
                         f"{ipaddr}:0 user={user}, cmd={opname}, json={j_line}")
-                    # Update access_token
-                    _, _, exp = await update_token_file(
-                        request, env, tokenfilepath, exp)
             await stderr_task
             return_code = await p.wait()
             if return_code != 0:
@@ -3912,13 +5746,11 @@ async def archive_files(
             logger.error(
                 f"{ipaddr}:0 user={user}, cmd={opname}, Client disconnected")
         finally:
-            try:
-                if tokenfilepath:
-                    os.remove(tokenfilepath)
-            except Exception as e:
-                logger.error(
-                    f"{ipaddr}:0 user={user}, cmd={opname},"
-                    f"os.remove({tokenfilepath}) error: {e}")
-
-    return StreamingResponse(content=progress_generator(),
-                             media_type='application/x-ndjson')
+            if cmd != "t":
+                invalidate_stat_cache(outdir, recursive=True)
+            await keeper.stop()
+
+    return CredentialStreamingResponse(
+        content=stream_frames(progress_generator()),
+        keeper=keeper,
+        media_type='application/x-ndjson')
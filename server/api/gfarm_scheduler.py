@@ -0,0 +1,322 @@
+# gfarm_scheduler.py
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+
+
+class SchedulerBusy(RuntimeError):
+    # queue is full or waiting time exceeded (-> 429 Too Many Requests)
+    def __init__(self, message, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Slot:
+    __slots__ = ("user", "lane", "nested", "released")
+
+    def __init__(self, user: str, lane: str, nested: bool = False):
+        self.user = user
+        self.lane = lane
+        self.nested = nested
+        self.released = False
+
+
+# slots of the current request (see RequestSlotsMiddleware)
+_request_slots: contextvars.ContextVar[Optional[List[Slot]]] = \
+    contextvars.ContextVar("gfarm_scheduler_request_slots", default=None)
+
+
+class RequestSlotsMiddleware:
+    """
+    ASGI middleware to share the slots of a request.
+
+    While a process of a request holds a slot, the other processes of
+    the same request (ex. gfexport of each file during gfls of /zip)
+    are nested (see GfarmScheduler).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _request_slots.set([])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_slots.reset(token)
+
+
+class _Waiter:
+    __slots__ = ("user", "lane", "future", "enqueued", "held")
+
+    def __init__(self, user: str, lane: str, future: asyncio.Future,
+                 held: Optional[List[Slot]] = None):
+        self.user = user
+        self.lane = lane
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.held = held  # slots of the request (nested)
+
+
+class GfarmScheduler:
+    """
+    Admission control for gf* processes.
+
+    - max_procs: processes running at the same time in the gateway
+    - lane_limits: processes running at the same time per lane
+    - Waiting requests are served in start-time fair queuing order;
+      each (lane, user) flow advances by 1 / (lane weight * user weight)
+      per process, so that a user with many queued requests does not
+      delay other users.
+    - Nested processes (started while another process of the same
+      request holds a slot) are counted in max_procs and lane_limits,
+      but are served before the queue of new requests, and
+      nested_reserve slots are left for them; otherwise the requests
+      holding all the slots would wait for each other forever.
+      max_procs_per_request limits the processes of a request.
+    """
+    def __init__(self,
+                 max_procs: int = 64,
+                 lane_limits: Optional[Dict[str, int]] = None,
+                 lane_weights: Optional[Dict[str, float]] = None,
+                 user_weights: Optional[Dict[str, float]] = None,
+                 max_queue: int = 1024,
+                 max_queue_per_user: int = 128,
+                 queue_timeout: float = 60.0,
+                 retry_after: int = 5,
+                 max_procs_per_request: int = 8,
+                 nested_reserve: int = 1,
+                 logger=None):
+        self.max_procs = max_procs  # 0: unlimited
+        self.lane_limits = lane_limits or {}
+        self.lane_weights = lane_weights or {}
+        self.user_weights = user_weights or {}
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.max_procs_per_request = max_procs_per_request  # 0: unlimited
+        self.nested_reserve = nested_reserve
+        self.logger = logger
+
+        self._active = 0
+        self._nested = 0
+        self._nested_waiters: List[_Waiter] = []
+        self._lane_active: Dict[str, int] = {}
+        self._heaps: Dict[str, List[Tuple[float, int, _Waiter]]] = {}
+        self._queued = 0
+        self._lane_queued: Dict[str, int] = {}
+        self._user_queued: Dict[str, int] = {}
+        self._finish: Dict[Tuple[str, str], float] = {}
+        self._vtime = 0.0
+        self._seq = itertools.count()
+
+        # statistics
+        self.granted_total = 0
+        self.rejected_total = 0
+        self.timeout_total = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.waited_total = 0
+
+    def _weight(self, user: str, lane: str) -> float:
+        w = self.lane_weights.get(lane, 1.0) * self.user_weights.get(user, 1.0)
+        return w if w > 0 else 1.0
+
+    def _limit(self, limit: int, nested: bool) -> int:
+        if nested:
+            return limit
+        # new requests leave nested_reserve slots
+        return max(1, limit - self.nested_reserve)
+
+    def _has_capacity(self, lane: str, nested: bool = False) -> bool:
+        if self.max_procs > 0 \
+           and self._active >= self._limit(self.max_procs, nested):
+            return False
+        limit = self.lane_limits.get(lane, 0)
+        if limit > 0 and \
+           self._lane_active.get(lane, 0) >= self._limit(limit, nested):
+            return False
+        return True
+
+    def _nested_allowed(self, lane: str, held: List[Slot]) -> bool:
+        if self.max_procs_per_request > 0:
+            n = sum(1 for s in held if not s.released)
+            if n >= self.max_procs_per_request:
+                return False
+        return self._has_capacity(lane, nested=True)
+
+    def _grant(self, user: str, lane: str,
+               held: Optional[List[Slot]] = None) -> Slot:
+        self._active += 1
+        self._lane_active[lane] = self._lane_active.get(lane, 0) + 1
+        self.granted_total += 1
+        slot = Slot(user, lane, nested=held is not None)
+        if held is not None:
+            self._nested += 1
+            held.append(slot)
+        return slot
+
+    def _busy(self, message: str) -> SchedulerBusy:
+        if self.logger:
+            self.logger.warning(f"GfarmScheduler: {message}")
+        return SchedulerBusy(message, self.retry_after)
+
+    def _dequeued(self, waiter: _Waiter) -> None:
+        self._queued -= 1
+        self._lane_queued[waiter.lane] -= 1
+        n = self._user_queued[waiter.user] - 1
+        if n > 0:
+            self._user_queued[waiter.user] = n
+        else:
+            del self._user_queued[waiter.user]
+
+    async def acquire(self, user: str, lane: str = LANE_INTERACTIVE) -> Slot:
+        held = _request_slots.get()
+        if held is not None:
+            held[:] = [s for s in held if not s.released]
+        if held:
+            return await self._acquire_nested(user, lane, held)
+        slot = await self._acquire(user, lane)
+        if held is not None:
+            held.append(slot)
+        return slot
+
+    async def _acquire_nested(self, user: str, lane: str,
+                              held: List[Slot]) -> Slot:
+        if not self._nested_waiters and self._nested_allowed(lane, held):
+            return self._grant(user, lane, held)
+        waiter = _Waiter(user, lane,
+                         asyncio.get_running_loop().create_future(), held)
+        self._nested_waiters.append(waiter)
+        self._dispatch()
+        return await self._wait(waiter, self._nested_waiters.remove)
+
+    async def _acquire(self, user: str, lane: str) -> Slot:
+        if self._lane_queued.get(lane, 0) == 0 and self._has_capacity(lane):
+            return self._grant(user, lane)
+
+        if self.max_queue > 0 and self._queued >= self.max_queue:
+            self.rejected_total += 1
+            raise self._busy(f"queue is full (queued={self._queued})")
+        if self.max_queue_per_user > 0 \
+           and self._user_queued.get(user, 0) >= self.max_queue_per_user:
+            self.rejected_total += 1
+            raise self._busy(f"queue is full for user={user}")
+
+        # start-time fair queuing
+        flow = (lane, user)
+        start = max(self._vtime, self._finish.get(flow, 0.0))
+        self._finish[flow] = start + 1.0 / self._weight(user, lane)
+        waiter = _Waiter(user, lane,
+                         asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heaps.setdefault(lane, []),
+                       (start, next(self._seq), waiter))
+        self._queued += 1
+        self._lane_queued[lane] = self._lane_queued.get(lane, 0) + 1
+        self._user_queued[user] = self._user_queued.get(user, 0) + 1
+        self._dispatch()
+        return await self._wait(waiter, self._dequeued)
+
+    async def _wait(self, waiter: _Waiter, dequeue) -> Slot:
+        timeout = self.queue_timeout if self.queue_timeout > 0 else None
+        try:
+            slot = await asyncio.wait_for(asyncio.shield(waiter.future),
+                                          timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # granted at the same time
+                self.release(waiter.future.result())
+            else:
+                waiter.future.cancel()
+                dequeue(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeout_total += 1
+                raise self._busy(f"queue timeout for user={waiter.user}"
+                                 f" ({self.queue_timeout} sec.)")
+            raise
+        waited = time.monotonic() - waiter.enqueued
+        self.waited_total += 1
+        self.wait_seconds_total += waited
+        if waited > self.wait_seconds_max:
+            self.wait_seconds_max = waited
+        return slot
+
+    def _dispatch(self) -> None:
+        # nested processes first (the requests are already running)
+        for waiter in list(self._nested_waiters):
+            if self._nested_allowed(waiter.lane, waiter.held):
+                self._nested_waiters.remove(waiter)
+                waiter.future.set_result(
+                    self._grant(waiter.user, waiter.lane, waiter.held))
+        while True:
+            best = None
+            for lane, heap in self._heaps.items():
+                while heap and heap[0][2].future.done():
+                    heapq.heappop(heap)  # cancelled
+                if not heap or not self._has_capacity(lane):
+                    continue
+                if best is None or heap[0] < self._heaps[best][0]:
+                    best = lane
+            if best is None:
+                break
+            start, _, waiter = heapq.heappop(self._heaps[best])
+            self._vtime = max(self._vtime, start)
+            self._dequeued(waiter)
+            waiter.future.set_result(self._grant(waiter.user, waiter.lane))
+        if self._queued == 0:
+            # forget idle flows
+            self._finish.clear()
+
+    def release(self, slot: Slot) -> None:
+        if slot.released:
+            return
+        slot.released = True
+        if slot.nested:
+            self._nested -= 1
+        self._active -= 1
+        self._lane_active[slot.lane] -= 1
+        self._dispatch()
+
+    def stats(self) -> dict:
+        lanes = {}
+        for lane in set(self._lane_active) | set(self._lane_queued) \
+                | set(self.lane_limits):
+            lanes[lane] = {
+                "active": self._lane_active.get(lane, 0),
+                "queued": self._lane_queued.get(lane, 0),
+                "limit": self.lane_limits.get(lane, 0),
+            }
+        oldest = 0.0
+        now = time.monotonic()
+        for heap in self._heaps.values():
+            for _, _, waiter in heap:
+                if not waiter.future.done():
+                    oldest = max(oldest, now - waiter.enqueued)
+        avg = (self.wait_seconds_total / self.waited_total
+               if self.waited_total > 0 else 0.0)
+        return {
+            "max_procs": self.max_procs,
+            "active": self._active,
+            "nested": self._nested,
+            "nested_queued": len(self._nested_waiters),
+            "queued": self._queued,
+            "queued_users": len(self._user_queued),
+            "lanes": lanes,
+            "granted_total": self.granted_total,
+            "rejected_total": self.rejected_total,
+            "timeout_total": self.timeout_total,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_avg": avg,
+            "wait_seconds_max": self.wait_seconds_max,
+            "oldest_wait_seconds": oldest,
+        }
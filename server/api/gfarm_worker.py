@@ -0,0 +1,191 @@
+# gfarm_worker.py
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import contextvars
+import time
+
+# run_batch(env, items) -> {item: result or Exception}
+RunBatch = Callable[[dict, List[Any]], Awaitable[Dict[Any, Any]]]
+
+
+class GfarmWorker:
+    """
+    Long-lived worker bound to one set of Gfarm credentials.
+
+    Requests submitted while a batch is running are queued and executed
+    together by the next batch, so that concurrent metadata operations
+    of the same user share one gf* process (one authentication and one
+    connection to gfmd).
+    """
+    def __init__(self, key: str, env: dict, run_batch: RunBatch,
+                 idle_timeout: float = 30.0,
+                 max_batch: int = 64,
+                 max_inflight: int = 2,
+                 on_close: Optional[Callable[[GfarmWorker], None]] = None,
+                 logger=None):
+        self.key = key
+        self.env = env
+        self._run_batch = run_batch
+        self.idle_timeout = idle_timeout
+        self.max_batch = max(1, max_batch)
+        self._slots = asyncio.Semaphore(max(1, max_inflight))
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._running = 0
+        self._on_close = on_close
+        self.logger = logger
+        self.loop = asyncio.get_running_loop()
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.batches = 0
+        self.items = 0
+        self._executing: set = set()
+        self._task = self._create_task(self._dispatch())
+
+    def _create_task(self, coro) -> asyncio.Task:
+        # not in the context of the request that created the worker
+        # (ex. the slots of gfarm_scheduler): batches are shared by
+        # requests
+        return contextvars.Context().run(self.loop.create_task, coro)
+
+    def is_alive(self) -> bool:
+        if self.closed or self._task.done():
+            return False
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def submit(self, item: Any) -> Any:
+        if self.closed:
+            raise RuntimeError("GfarmWorker is closed")
+        fut = self.loop.create_future()
+        self.last_used = time.monotonic()
+        self._queue.put_nowait((item, fut))
+        return await fut
+
+    async def _dispatch(self) -> None:
+        try:
+            while True:
+                try:
+                    first = await asyncio.wait_for(self._queue.get(),
+                                                   self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if self._queue.empty() and self._running == 0:
+                        break
+                    continue
+                await self._slots.acquire()
+                batch = [first]
+                while len(batch) < self.max_batch \
+                        and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                self._running += 1
+                task = self._create_task(self._execute(batch))
+                self._executing.add(task)
+                task.add_done_callback(self._executing.discard)
+        finally:
+            self.closed = True
+            self._fail_pending(RuntimeError("GfarmWorker is closed"))
+            if self._on_close:
+                self._on_close(self)
+            if self.logger:
+                self.logger.debug("GfarmWorker evicted:"
+                                  f" batches={self.batches},"
+                                  f" items={self.items}")
+
+    async def _execute(self, batch) -> None:
+        futs: Dict[Any, List[asyncio.Future]] = {}
+        for item, fut in batch:
+            futs.setdefault(item, []).append(fut)
+        try:
+            results = await self._run_batch(self.env, list(futs.keys()))
+            for item, waiters in futs.items():
+                res = results.get(item)
+                if res is None:
+                    res = RuntimeError(f"no result: {item}")
+                for fut in waiters:
+                    if fut.done():
+                        continue
+                    if isinstance(res, BaseException):
+                        fut.set_exception(res)
+                    else:
+                        fut.set_result(res)
+        except BaseException as e:
+            for waiters in futs.values():
+                for fut in waiters:
+                    if not fut.done():
+                        fut.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self.batches += 1
+            self.items += len(batch)
+            self._running -= 1
+            self.last_used = time.monotonic()
+            self._slots.release()
+
+    def _fail_pending(self, exc: Exception) -> None:
+        while not self._queue.empty():
+            _, fut = self._queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(exc)
+
+    async def close(self) -> None:
+        self.closed = True
+        tasks = list(self._executing)
+        if not self._task.done():
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+class GfarmWorkerPool:
+    """
+    Pool of GfarmWorker keyed by credentials.
+    Idle workers are evicted after idle_timeout seconds.
+    """
+    def __init__(self, run_batch: RunBatch,
+                 idle_timeout: float = 30.0,
+                 max_batch: int = 64,
+                 max_inflight: int = 2,
+                 logger=None):
+        self._run_batch = run_batch
+        self.idle_timeout = idle_timeout
+        self.max_batch = max_batch
+        self.max_inflight = max_inflight
+        self.logger = logger
+        self._workers: Dict[str, GfarmWorker] = {}
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def _remove(self, worker: GfarmWorker) -> None:
+        if self._workers.get(worker.key) is worker:
+            del self._workers[worker.key]
+
+    def get(self, key: str, env: dict) -> GfarmWorker:
+        worker = self._workers.get(key)
+        if worker is None or not worker.is_alive():
+            worker = GfarmWorker(key, env, self._run_batch,
+                                 idle_timeout=self.idle_timeout,
+                                 max_batch=self.max_batch,
+                                 max_inflight=self.max_inflight,
+                                 on_close=self._remove,
+                                 logger=self.logger)
+            self._workers[key] = worker
+        return worker
+
+    async def submit(self, key: str, env: dict, item: Any) -> Any:
+        return await self.get(key, env).submit(item)
+
+    async def close(self) -> None:
+        workers = list(self._workers.values())
+        self._workers.clear()
+        for worker in workers:
+            if worker.is_alive():
+                await worker.close()
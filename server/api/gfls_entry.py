@@ -0,0 +1,277 @@
+# gfls_entry.py
+# Parser of "gfls -l" output
+from __future__ import annotations
+from typing import Optional
+import calendar
+import os
+import re
+import time
+
+_MONTHS = {calendar.month_abbr[i]: i for i in range(1, 13)}
+_DATE_RE = re.compile(r"(\d\d) (\d\d\d\d)", re.ASCII)  # "%d %Y"
+_HMS_RE = re.compile(r"(\d\d):(\d\d):(\d\d)", re.ASCII)  # "%H:%M:%S"
+_CACHE_MAX = 10000
+
+# (month, day, year) -> local time of 00:00:00
+#                       (None: invalid or UTC offset changes in the day)
+_midnight_cache: dict = {}
+# "HH:MM:SS" -> seconds (None: invalid)
+_hms_cache: dict = {}
+# mode_str -> (mode, is_dir, is_sym)
+_mode_cache: dict = {}
+
+
+def from_rwx(rwx, highchar):
+    perm = 0
+    highbit = 0
+    r = rwx[0]
+    w = rwx[1]
+    x = rwx[2]
+    if r == 'r':
+        perm |= 0o4
+    if w == 'w':
+        perm |= 0o2
+    if x == 'x':
+        perm |= 0o1
+    elif x == highchar:
+        perm |= 0o1
+        highbit = 0o1
+    elif x == highchar.upper():
+        highbit = 0o1
+    return perm, highbit
+
+
+def _parse_mode(mode_str):
+    mode = 0
+    perm, highbit = from_rwx(mode_str[1:4], 's')
+    mode |= (perm << 6)
+    mode |= (highbit << 11)
+    perm, highbit = from_rwx(mode_str[4:7], 's')
+    mode |= (perm << 3)
+    mode |= (highbit << 10)
+    perm, highbit = from_rwx(mode_str[7:10], 't')
+    mode |= perm
+    mode |= (highbit << 9)
+    return mode, mode_str.startswith('d'), mode_str.startswith('l')
+
+
+def _midnight(month, day, year):
+    key = (month, day, year)
+    t = _midnight_cache.get(key, False)
+    if t is not False:
+        return t
+    t = None
+    mon = _MONTHS.get(month)
+    m = _DATE_RE.fullmatch(f"{day} {year}")
+    if mon is not None and m is not None:
+        d, y = int(m[1]), int(m[2])
+        if y >= 1970 and 1 <= d <= calendar.monthrange(y, mon)[1]:
+            start = time.mktime((y, mon, d, 0, 0, 0, 0, 0, -1))
+            end = time.mktime((y, mon, d, 23, 59, 59, 0, 0, -1))
+            if end - start == 86399:
+                t = start
+    if len(_midnight_cache) >= _CACHE_MAX:
+        _midnight_cache.clear()
+    _midnight_cache[key] = t
+    return t
+
+
+def _seconds(hms):
+    sec = _hms_cache.get(hms, False)
+    if sec is not False:
+        return sec
+    sec = None
+    m = _HMS_RE.fullmatch(hms)
+    if m is not None:
+        h, mi, s = int(m[1]), int(m[2]), int(m[3])
+        if h < 24 and mi < 60 and s < 60:
+            sec = h * 3600 + mi * 60 + s
+    if len(_hms_cache) >= 86400:
+        _hms_cache.clear()
+    _hms_cache[hms] = sec
+    return sec
+
+
+def parse_mtime(month, day, hms, year):
+    """
+    Same as time.mktime(time.strptime(f"{month} {day} {hms} {year}",
+                                      '%b %d %H:%M:%S %Y')),
+    but mktime() is called only once a day.
+    """
+    t = _midnight(month, day, year)
+    if t is not None:
+        sec = _seconds(hms)
+        if sec is not None:
+            return t + sec
+    return time.mktime(time.strptime(f"{month} {day} {hms} {year}",
+                                     '%b %d %H:%M:%S %Y'))
+
+
+class Gfls_Entry:
+    __slots__ = ("name", "path", "dirname", "mode_str", "mode",
+                 "is_dir", "is_sym", "linkname", "nlink", "uname", "gname",
+                 "size", "mtime_str", "mtime", "perms", "line")
+
+    def __init__(
+            self,
+            name: Optional[str] = None,
+            nlink: Optional[int] = None,
+            uname: Optional[str] = None,
+            gname: Optional[str] = None,
+            size: Optional[int] = None,
+            dirname: Optional[str] = None,
+            mtime_str: Optional[str] = None,
+            mode_str: Optional[str] = None,
+            perms: Optional[str] = None):
+        self.name = name
+        self.nlink = nlink
+        self.uname = uname
+        self.gname = gname
+        self.size = size
+        self.perms = perms
+        self.path = None
+        self.line = None
+        self.set_dirname(dirname)
+        self.set_mtime(mtime_str)
+        self.set_mode(mode_str)
+        self.set_linkname(name, self.is_sym)
+
+    @classmethod
+    def _new(cls, name, nlink, uname, gname, size, mode_str, perms):
+        # same as __init__() without dirname and mtime_str
+        self = cls.__new__(cls)
+        self.nlink = nlink
+        self.uname = uname
+        self.gname = gname
+        self.size = size
+        self.perms = perms
+        self.path = None
+        self.dirname = None
+        self.line = None
+        self.set_mode(mode_str)
+        self.linkname = ''
+        if self.is_sym:
+            pair = name.split(' -> ')
+            name = pair[0]
+            self.linkname = pair[1]
+        self.name = name
+        return self
+
+    def set_dirname(self, dirname):
+        self.dirname = dirname
+        if dirname is not None:
+            if self.name == "." or self.name is None:
+                self.path = dirname
+            else:
+                self.path = os.path.join(self.dirname, self.name)
+
+    def set_mode(self, mode_str):
+        self.mode_str = mode_str
+        if mode_str is None:
+            self.mode = None
+            self.is_dir = None
+            self.is_sym = None
+            return
+        parsed = _mode_cache.get(mode_str)
+        if parsed is None:
+            parsed = _parse_mode(mode_str)
+            if len(_mode_cache) >= _CACHE_MAX:
+                _mode_cache.clear()
+            _mode_cache[mode_str] = parsed
+        self.mode, self.is_dir, self.is_sym = parsed
+
+    def set_mtime(self, mtime_str):
+        self.mtime_str = mtime_str
+        if mtime_str is None:
+            self.mtime = None
+            return
+        parts = mtime_str.split(" ")
+        if len(parts) == 4:
+            self.mtime = parse_mtime(*parts)
+        else:
+            self.mtime = time.mktime(
+                time.strptime(mtime_str, '%b %d %H:%M:%S %Y'))
+
+    def set_linkname(self, name, is_sym):
+        self.linkname = ''
+        if is_sym is None:
+            return
+        if is_sym:
+            pair = name.split(' -> ')
+            self.name = pair[0]
+            self.linkname = pair[1]
+
+    def set_line(self, line):
+        self.line = line
+
+    def json_dump(self):
+        return {
+            "mode_str": self.mode_str,
+            "is_file": not self.is_dir and not self.is_sym,
+            "is_dir": self.is_dir,
+            "is_sym": self.is_sym,
+            "linkname": self.linkname,
+            "nlink": self.nlink,
+            "uname": self.uname,
+            "gname": self.gname,
+            "size": self.size,
+            "mtime": self.mtime,
+            "name": self.name,
+            "path": self.path,
+            "perms": self.perms
+        }
+
+    def line_dump(self):
+        return self.line
+
+    @staticmethod
+    def parse(line,
+              is_file, long_format, full_format_time, effperm, dirname=None):
+        if not long_format:
+            return line
+
+        split_count = 8
+        if effperm:
+            split_count += 1
+        if full_format_time:
+            split_count += 1
+
+        parts = line.strip().split(None, split_count)
+        if len(parts) < 10:
+            return line
+
+        if effperm:
+            perms = parts[0]
+            i = 1
+        else:
+            perms = None
+            i = 0
+        (mode_str, nlink, uname, gname, size,
+         month, day, hms) = parts[i:i + 8]
+        i += 8
+        if full_format_time:
+            year = parts[i]
+            mtime_str = f"{month} {day} {hms} {year}"
+            i += 1
+        else:
+            year = None
+            mtime_str = f"{month} {day} {hms}"
+        name = parts[i]
+
+        new_entry = Gfls_Entry._new(name, int(nlink), uname, gname,
+                                    int(size), mode_str, perms)
+        if dirname is not None:
+            new_entry.set_dirname(dirname)
+        new_entry.mtime_str = mtime_str
+        if year is None:
+            new_entry.mtime = time.mktime(
+                time.strptime(mtime_str, '%b %d %H:%M:%S %Y'))  # error
+        else:
+            new_entry.mtime = parse_mtime(month, day, hms, year)
+
+        if is_file:
+            new_entry.name = os.path.basename(new_entry.name)
+
+        new_entry.line = line
+
+        return new_entry
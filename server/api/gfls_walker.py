@@ -0,0 +1,246 @@
+# gfls_walker.py
+# Parallel recursive listing (instead of "gfls -R")
+#
+# "gfls -R" lists a tree serially.  RecursiveWalker lists each
+# directory by list_dir() (ex. "gfls -l" without -R) with up to
+# `workers` listings at the same time.  Directories found in a listing
+# are added to the shared queue, and an idle worker takes the next one.
+#
+# ordered=True:  same order as "gfls -R" (entries of a directory, then
+#                the subdirectories in order).  The queue is ordered so
+#                that directories needed first are listed first.
+# ordered=False: breadth-first.  Entries are output as soon as they are
+#                listed.
+#
+# Like "gfls -R", an error of a directory does not stop the walk.  It is
+# raised after all the other entries are output.
+from __future__ import annotations
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+import asyncio
+import contextlib
+import heapq
+
+from gfls_entry import Gfls_Entry
+
+# list_dir(path, is_file) -> Gfls_Entry (dirname is set) or str
+ListDir = Callable[[str, Optional[bool]], AsyncIterator]
+
+
+class _Node:
+    __slots__ = ("key", "path", "depth", "entries", "children", "done",
+                 "changed")
+
+    def __init__(self, key: Tuple, path: str, depth: int):
+        self.key = key
+        self.path = path
+        self.depth = depth
+        self.entries: list = []
+        self.children: List[_Node] = []
+        self.done = False
+        self.changed = asyncio.Event()
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class RecursiveWalker:
+    """
+    list_dir: async generator of the entries of one directory
+    workers: maximum number of list_dir() at the same time
+    max_depth: subdirectories deeper than max_depth are not listed
+               (the root directory is depth 0, None: no limit)
+    max_buffered: maximum number of entries listed but not output yet
+                  (may be exceeded by the listings in progress)
+    """
+    def __init__(self, list_dir: ListDir,
+                 workers: int = 4,
+                 max_depth: Optional[int] = None,
+                 ordered: bool = True,
+                 max_buffered: int = 10000,
+                 logger=None):
+        self.list_dir = list_dir
+        self.workers = max(1, workers)
+        self.max_depth = max_depth
+        self.ordered = ordered
+        self.max_buffered = max(1, max_buffered)
+        self.logger = logger
+        self._queue: list = []  # heap of _Node
+        self._seq = 0
+        self._active = 0
+        self._buffered = 0
+        self._needed: Optional[_Node] = None
+        self._error: Optional[BaseException] = None  # stops the walk
+        self._errors: List[Exception] = []  # errors of directories
+        self._cond = asyncio.Condition()
+        self._output: asyncio.Queue = asyncio.Queue(
+            maxsize=self.max_buffered)
+        self.max_active = 0  # for statistics
+
+    def _subdir(self, parent: _Node, entry) -> Optional[_Node]:
+        if (not isinstance(entry, Gfls_Entry) or not entry.is_dir
+                or entry.name in (".", "..") or entry.path is None):
+            return None
+        if self.max_depth is not None and parent.depth + 1 > self.max_depth:
+            if self.logger:
+                self.logger.debug(
+                    f"RecursiveWalker: too deep, skipped: {entry.path}")
+            return None
+        if self.ordered:
+            # preorder of the tree
+            key = parent.key + (len(parent.children),)
+        else:
+            # breadth-first
+            self._seq += 1
+            key = (parent.depth + 1, self._seq)
+        node = _Node(key, entry.path, parent.depth + 1)
+        parent.children.append(node)
+        return node
+
+    def _ready(self) -> bool:
+        if self._error is not None:
+            return True
+        if not self._queue:
+            return self._active == 0  # finished
+        if not self.ordered or self._buffered < self.max_buffered:
+            return True
+        # the output is waiting for this directory
+        return self._queue[0] is self._needed
+
+    async def _worker(self, is_file: Optional[bool]) -> None:
+        cond = self._cond
+        while True:
+            async with cond:
+                await cond.wait_for(self._ready)
+                if self._error is not None or not self._queue:
+                    return
+                node = heapq.heappop(self._queue)
+                self._active += 1
+                self.max_active = max(self.max_active, self._active)
+            try:
+                await self._list(node, is_file if node.depth == 0 else False)
+            except Exception as e:
+                # continue the walk (same as "gfls -R")
+                if self.logger:
+                    self.logger.debug(
+                        f"RecursiveWalker: {node.path}: {str(e)}")
+                self._errors.append(e)
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+                raise
+            finally:
+                node.done = True
+                node.changed.set()
+                async with cond:
+                    self._active -= 1
+                    cond.notify_all()
+                if not self.ordered and self._active == 0 \
+                        and not self._queue:
+                    await self._output.put(None)
+
+    async def _list(self, node: _Node, is_file: Optional[bool]) -> None:
+        subdirs = []
+        try:
+            async with contextlib.aclosing(
+                    self.list_dir(node.path, is_file)) as entries:
+                async for entry in entries:
+                    if self._error is not None:
+                        return
+                    child = self._subdir(node, entry)
+                    if child is not None:
+                        subdirs.append(child)
+                    if self.ordered:
+                        node.entries.append(entry)
+                        self._buffered += 1
+                        node.changed.set()
+                    else:
+                        await self._output.put(entry)
+        finally:
+            # subdirectories listed before an error are also walked
+            if subdirs and self._error is None:
+                async with self._cond:
+                    for child in subdirs:
+                        heapq.heappush(self._queue, child)
+                    self._cond.notify_all()
+
+    async def _emit_ordered(self, root: _Node):
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            async with self._cond:
+                self._needed = node
+                self._cond.notify_all()
+            i = 0
+            while True:
+                node.changed.clear()
+                entries = node.entries
+                n = len(entries)
+                while i < n:
+                    yield entries[i]
+                    i += 1
+                if i > 0:
+                    self._buffered -= i
+                    del entries[:i]
+                    i = 0
+                    if self._buffered < self.max_buffered:
+                        async with self._cond:
+                            self._cond.notify_all()
+                if node.done and not node.entries:
+                    break
+                if self._error is not None:
+                    raise self._error
+                await node.changed.wait()
+            if self._error is not None:
+                raise self._error
+            stack.extend(reversed(node.children))
+            node.children = []
+
+    async def _emit_unordered(self):
+        while True:
+            if self._error is not None:
+                raise self._error
+            entry = await self._output.get()
+            if entry is None:
+                break
+            yield entry
+
+    async def walk(self, path: str, is_file: Optional[bool] = None):
+        """
+        Entries of path and all subdirectories (async generator).
+        An exception of list_dir() is raised after the walk (the
+        messages are joined if two or more directories failed).
+        """
+        root = _Node((), path, 0)
+        self._queue = [root]
+        tasks = [asyncio.create_task(self._worker(is_file))
+                 for _ in range(self.workers)]
+
+        def stop_on_error(task):
+            if task.cancelled() or task.exception() is None:
+                return
+            for node in (self._needed, root):
+                if node is not None:
+                    node.changed.set()
+            with contextlib.suppress(asyncio.QueueFull):
+                self._output.put_nowait(None)
+
+        for task in tasks:
+            task.add_done_callback(stop_on_error)
+        try:
+            if self.ordered:
+                async for entry in self._emit_ordered(root):
+                    yield entry
+            else:
+                async for entry in self._emit_unordered():
+                    yield entry
+            if self._error is not None:
+                raise self._error
+            if len(self._errors) == 1:
+                raise self._errors[0]
+            if self._errors:
+                raise RuntimeError(
+                    "\n".join(str(e) for e in self._errors))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
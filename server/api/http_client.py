@@ -0,0 +1,48 @@
+# http_client.py
+from __future__ import annotations
+from typing import Optional
+import asyncio
+import importlib.util
+
+import httpx
+
+
+def http2_available() -> bool:
+    # HTTP/2 of httpx requires h2 package (pip install httpx[http2])
+    return importlib.util.find_spec("h2") is not None
+
+
+class SharedTransport(httpx.AsyncBaseTransport):
+    """
+    Connection pool shared by many httpx.AsyncClient.
+
+    Closing a client (ex. "async with AsyncClient(transport=...)"
+    in authlib) does not close the pool; call close() at shutdown.
+    The pool is (re)created in the running event loop, because
+    connections cannot be used from another event loop.
+    """
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._transport: Optional[httpx.AsyncHTTPTransport] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def open(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        if self._transport is None or self._loop is not loop:
+            self._transport = httpx.AsyncHTTPTransport(**self._kwargs)
+            self._loop = loop
+        return self._transport
+
+    async def handle_async_request(
+            self, request: httpx.Request) -> httpx.Response:
+        return await self.open().handle_async_request(request)
+
+    async def aclose(self) -> None:
+        pass  # shared
+
+    async def close(self) -> None:
+        transport = self._transport
+        self._transport = None
+        self._loop = None
+        if transport is not None:
+            await transport.aclose()
@@ -0,0 +1,233 @@
+# listing_snapshot.py
+# Sorted snapshot of a directory listing for cursor pagination
+#
+# file: <basedir>/<user>/<snapshot_id>
+#   line 1: {"total": N}
+#   line 2-: output lines (sorted)
+# cursor: "<snapshot_id>.<byte offset of the next line>"
+#
+# SnapshotWriter sorts the lines while the listing is read: sorted runs
+# of run_size lines are written to temporary files and merged into the
+# snapshot, so the whole listing is never kept in memory.
+from __future__ import annotations
+from typing import Any, Iterable, List, Optional, Tuple
+import heapq
+import json
+import os
+import re
+import secrets
+import tempfile
+import time
+
+_ID_RE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+class SnapshotNotFound(Exception):
+    pass  # expired or unknown
+
+
+class ListingSnapshotStore:
+    """
+    Listings are written once and read page by page without
+    running gfls again. Snapshots older than ttl seconds are removed.
+    """
+    def __init__(self, basedir: str, ttl: float = 600.0):
+        self.basedir = basedir
+        self.ttl = ttl
+
+    def _userdir(self, user: Optional[str]) -> str:
+        name = user if user else "_"
+        if name in (".", "..") or "/" in name:
+            raise ValueError(f"invalid user name: {name}")
+        return os.path.join(self.basedir, name)
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> Tuple[str, int]:
+        snapshot_id, sep, offset = cursor.rpartition(".")
+        if not sep or not _ID_RE.match(snapshot_id) or not offset.isdigit():
+            raise ValueError(f"invalid cursor: {cursor}")
+        return snapshot_id, int(offset)
+
+    def _sweep(self, userdir: str, now: float) -> int:
+        """
+        Removes expired files in userdir.
+        Returns the number of remaining files.
+        """
+        names = os.listdir(userdir)
+        remaining = len(names)
+        for name in names:
+            path = os.path.join(userdir, name)
+            try:
+                if os.stat(path).st_mtime + self.ttl <= now:
+                    os.remove(path)
+                    remaining -= 1
+            except FileNotFoundError:
+                remaining -= 1
+        return remaining
+
+    def cleanup(self, user: Optional[str]) -> None:
+        try:
+            self._sweep(self._userdir(user), time.time())
+        except FileNotFoundError:
+            pass
+
+    def cleanup_all(self) -> int:
+        """
+        Sweeps the directories of all users (including users who never
+        come back), and removes empty ones not used for ttl seconds.
+        Returns the number of removed directories.
+        """
+        now = time.time()
+        try:
+            names = os.listdir(self.basedir)
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for name in names:
+            userdir = os.path.join(self.basedir, name)
+            try:
+                if not os.path.isdir(userdir):
+                    continue
+                # writer() updates mtime of the directory
+                # (before _sweep(), which also updates it)
+                unused = os.stat(userdir).st_mtime + self.ttl <= now
+                if self._sweep(userdir, now) == 0 and unused:
+                    os.rmdir(userdir)
+                    removed += 1
+            except OSError:
+                pass  # removed or in use
+        return removed
+
+    def writer(self, user: Optional[str],
+               run_size: int = 10000) -> SnapshotWriter:
+        self.cleanup(user)
+        userdir = self._userdir(user)
+        os.makedirs(userdir, mode=0o700, exist_ok=True)
+        # not removed by cleanup_all() while writing
+        os.utime(userdir)
+        return SnapshotWriter(userdir, run_size)
+
+    def create(self, user: Optional[str], lines: Iterable[str]) -> str:
+        """
+        lines: sorted, without newline.
+        Returns the cursor of the first line.
+        """
+        writer = self.writer(user)
+        try:
+            for i, line in enumerate(lines):
+                if writer.add(i, line):
+                    writer.spill()
+            return writer.commit()
+        finally:
+            writer.abort()
+
+    def read(self, user: Optional[str], cursor: str,
+             limit: int) -> Tuple[List[str], Optional[str], int]:
+        """
+        Returns (lines, next cursor or None, total number of lines).
+        """
+        snapshot_id, offset = self.parse_cursor(cursor)
+        path = os.path.join(self._userdir(user), snapshot_id)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            raise SnapshotNotFound(cursor)
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_mtime + self.ttl <= time.time():
+                raise SnapshotNotFound(cursor)
+            total = json.loads(f.readline())["total"]
+            start = f.tell()
+            offset = max(offset, start)
+            if offset > st.st_size:
+                raise ValueError(f"invalid cursor: {cursor}")
+            if offset > start:
+                # must point to the beginning of a line
+                f.seek(offset - 1)
+                if f.read(1) != b"\n":
+                    raise ValueError(f"invalid cursor: {cursor}")
+            f.seek(offset)
+            lines = []
+            for _ in range(limit):
+                raw = f.readline()
+                if not raw:
+                    break
+                lines.append(raw.decode("utf-8").rstrip("\n"))
+            pos = f.tell()
+            next_cursor = f"{snapshot_id}.{pos}" if pos < st.st_size else None
+        return lines, next_cursor, total
+
+
+class SnapshotWriter:
+    """
+    add(key, line) for each line (in any order), spill() when add()
+    returns True (run_size lines are buffered), then commit() or abort().
+    Lines are sorted by key (stable).  key: JSON serializable
+    (ex. str, int).  spill() and commit() do file I/O.
+    """
+    def __init__(self, userdir: str, run_size: int = 10000):
+        self.userdir = userdir
+        self.run_size = max(1, run_size)
+        self.total = 0
+        self._buf: List[Tuple[Any, str]] = []
+        self._runs: List[str] = []  # temporary files of sorted runs
+
+    def _tmpfile(self):
+        try:
+            return tempfile.NamedTemporaryFile(
+                mode="w", encoding="utf-8", dir=self.userdir,
+                prefix=".tmp-", delete=False)
+        except FileNotFoundError:
+            # removed by cleanup_all() meanwhile
+            os.makedirs(self.userdir, mode=0o700, exist_ok=True)
+            return tempfile.NamedTemporaryFile(
+                mode="w", encoding="utf-8", dir=self.userdir,
+                prefix=".tmp-", delete=False)
+
+    def add(self, key: Any, line: str) -> bool:
+        self._buf.append((key, line))
+        self.total += 1
+        return len(self._buf) >= self.run_size
+
+    def spill(self) -> None:
+        if not self._buf:
+            return
+        self._buf.sort(key=lambda item: item[0])
+        with self._tmpfile() as fp:
+            self._runs.append(fp.name)
+            for item in self._buf:
+                fp.write(json.dumps(item) + "\n")
+        self._buf = []
+
+    @staticmethod
+    def _read_run(path: str):
+        with open(path, encoding="utf-8") as f:
+            for raw in f:
+                key, line = json.loads(raw)
+                yield key, line
+
+    def commit(self) -> str:
+        """
+        Returns the cursor of the first line.
+        """
+        self._buf.sort(key=lambda item: item[0])
+        runs = [self._read_run(path) for path in self._runs]
+        merged = heapq.merge(*runs, iter(self._buf),
+                             key=lambda item: item[0])
+        snapshot_id = secrets.token_urlsafe(16)
+        with self._tmpfile() as fp:
+            fp.write(json.dumps({"total": self.total}) + "\n")
+            for _, line in merged:
+                fp.write(line + "\n")
+        os.replace(fp.name, os.path.join(self.userdir, snapshot_id))
+        self.abort()
+        return f"{snapshot_id}.0"
+
+    def abort(self) -> None:
+        self._buf = []
+        for path in self._runs:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._runs = []
@@ -0,0 +1,270 @@
+# metrics.py
+# Minimal Prometheus metrics (text exposition format 0.0.4)
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Tuple
+import bisect
+import math
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _escape(value: str) -> str:
+    return (str(value).replace("\\", "\\\\")
+            .replace("\n", "\\n").replace('"', '\\"'))
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str],
+                   extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    typename = ""
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Iterable[str] = (),
+                 registry: Optional[Registry] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[n] for n in self.labelnames)
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name}: wrong number of labels")
+        child = self._children.get(key)
+        if child is None:
+            child = self._new_child()
+            self._children[key] = child
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.typename}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._collect_child(key, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    typename = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._default().inc(amount)
+
+    def _collect_child(self, key, child):
+        labels = _format_labels(self.labelnames, key)
+        return [f"{self.name}_total{labels} {_format_value(child.value)}"]
+
+
+class Gauge(_Metric):
+    typename = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._default().dec(amount)
+
+    def set(self, value: float) -> None:
+        self._default().set(value)
+
+    def _collect_child(self, key, child):
+        labels = _format_labels(self.labelnames, key)
+        return [f"{self.name}{labels} {_format_value(child.value)}"]
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    typename = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS,
+                 registry: Optional[Registry] = None):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default().observe(value)
+
+    def _collect_child(self, key, child):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            total += count
+            labels = _format_labels(self.labelnames, key,
+                                    ("le", _format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {total}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"duplicated metric: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware to observe latency of HTTP requests.
+
+    - requests: Histogram(method, route, status)
+      (time until the last byte of the response body)
+    - streams: Gauge of streaming responses in progress
+    Route templates (ex. /dir/{gfarm_path:path}) are used as labels
+    to keep the number of series small.
+    """
+    def __init__(self, app, requests: Histogram, streams: Gauge):
+        self.app = app
+        self.requests = requests
+        self.streams = streams
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.monotonic()
+        state = {"status": 500, "streaming": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                more = message.get("more_body", False)
+                if more and not state["streaming"]:
+                    state["streaming"] = True
+                    self.streams.inc()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if state["streaming"]:
+                self.streams.dec()
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "(unknown)"
+            self.requests.labels(scope.get("method", ""), path,
+                                 state["status"]).observe(
+                                     time.monotonic() - start)
+
+
+class TimedStreamReader:
+    """
+    Wrapper of asyncio.StreamReader (stdout of a process)
+    to call on_first_byte() when the first data is read.
+    """
+    def __init__(self, reader, on_first_byte):
+        self._reader = reader
+        self._on_first_byte = on_first_byte
+
+    def _check(self, data):
+        if data and self._on_first_byte is not None:
+            callback = self._on_first_byte
+            self._on_first_byte = None
+            callback()
+        return data
+
+    async def read(self, n=-1):
+        return self._check(await self._reader.read(n))
+
+    async def readline(self):
+        return self._check(await self._reader.readline())
+
+    async def readexactly(self, n):
+        return self._check(await self._reader.readexactly(n))
+
+    async def readuntil(self, separator=b"\n"):
+        return self._check(await self._reader.readuntil(separator))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self.readline()
+        if line == b"":
+            raise StopAsyncIteration
+        return line
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
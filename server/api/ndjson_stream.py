@@ -0,0 +1,123 @@
+# ndjson_stream.py
+# Coalescing small records (ex. NDJSON lines) of a streaming response
+#
+# StreamingResponse sends each chunk from the generator as one
+# http.response.body message (one write to the socket).  frames()
+# joins the chunks until frame_bytes or frame_delay seconds
+# after the first chunk of the frame, whichever comes first.
+from __future__ import annotations
+from typing import Any, AsyncIterator, Optional
+import asyncio
+import contextlib
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def fast_json_available() -> bool:
+    return orjson is not None
+
+
+def dumps(obj: Any) -> str:
+    """
+    JSON text of obj.  orjson is used if installed (compact: no spaces
+    after separators).  Otherwise same as json.dumps(obj).
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            pass  # ex. int larger than 64-bit
+    return json.dumps(obj)
+
+
+class _Frames:
+    def __init__(self, chunks: AsyncIterator[str],
+                 frame_bytes: int, frame_delay: float):
+        self.chunks = chunks
+        self.frame_bytes = frame_bytes
+        self.frame_delay = frame_delay
+        self.buf: list = []
+        self.size = 0
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.nonempty = asyncio.Event()  # buf or finished
+        self.full = asyncio.Event()  # frame_bytes or finished
+        self.space = asyncio.Event()  # buf was taken
+        self.space.set()
+
+    async def produce(self) -> None:
+        try:
+            async for chunk in self.chunks:
+                self.buf.append(chunk)
+                self.size += len(chunk)
+                self.nonempty.set()
+                if self.size >= self.frame_bytes:
+                    self.full.set()
+                    # wait until the frame is sent (backpressure)
+                    self.space.clear()
+                    await self.space.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self.nonempty.set()
+            self.full.set()
+            aclose = getattr(self.chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def take(self) -> str:
+        frame = "".join(self.buf)
+        self.buf = []
+        self.size = 0
+        if not self.finished:
+            self.nonempty.clear()
+            self.full.clear()
+        self.space.set()
+        return frame
+
+    async def consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.nonempty.wait()
+            if not self.buf:
+                break  # finished
+            if self.size < self.frame_bytes and not self.finished:
+                # the first chunk has been buffered just now
+                deadline = loop.time() + self.frame_delay
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        self.full.wait(),
+                        timeout=max(0.0, deadline - loop.time()))
+            yield self.take()
+        if self.error is not None:
+            raise self.error
+
+
+async def frames(chunks: AsyncIterator[str],
+                 frame_bytes: int = 65536,
+                 frame_delay: float = 0.02):
+    """
+    Chunks (str) joined into frames (str).
+    frame_bytes <= 0: not joined.
+    An exception of chunks is raised after the buffered chunks.
+    """
+    if frame_bytes <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    f = _Frames(chunks, frame_bytes, frame_delay)
+    task = asyncio.create_task(f.produce())
+    try:
+        async for frame in f.consume():
+            yield frame
+    finally:
+        if not task.done():
+            task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
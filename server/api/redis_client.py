@@ -1,9 +1,14 @@
 # redis_client.py
 from __future__ import annotations
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
 import asyncio
+import time
 import uuid
 from redis.asyncio import Redis
+from redis.asyncio.retry import Retry
+from redis.asyncio.sentinel import Sentinel
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
 
 _RELEASE_LUA = b"""
 if redis.call('GET', KEYS[1]) == ARGV[1] then
@@ -25,6 +30,16 @@ class RedisClient:
                  username: Optional[str] = None,
                  password: Optional[str] = None,
                  lock_prefix: str = "LOCK",
+                 notify_prefix: str = "NOTIFY",
+                 max_connections: Optional[int] = None,
+                 socket_timeout: Optional[float] = None,
+                 socket_connect_timeout: Optional[float] = None,
+                 health_check_interval: int = 0,
+                 retry_attempts: int = 0,
+                 sentinels: Optional[List[Tuple[str, int]]] = None,
+                 sentinel_service_name: Optional[str] = None,
+                 client: Optional[Redis] = None,
+                 observe: Optional[Callable[[str, float], None]] = None,
                  logger=None):
         self._host = host
         self._port = port
@@ -36,27 +51,81 @@ class RedisClient:
         self._ssl_ca_certs = ssl_ca_certs
         self._username = username
         self._password = password
-        self._client: Optional[Redis] = None
+        self._max_connections = max_connections
+        self._socket_timeout = socket_timeout
+        self._socket_connect_timeout = socket_connect_timeout
+        self._health_check_interval = health_check_interval
+        self._retry_attempts = retry_attempts
+        self._sentinels = sentinels
+        self._sentinel_service_name = sentinel_service_name
+        # client: connected client (ex. fakeredis for tests)
+        self._client: Optional[Redis] = client
         self.lock_prefix = lock_prefix
+        self.notify_prefix = notify_prefix
+        # channel -> futures waiting for a message
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        # observe(operation name, seconds): latency of each operation
+        self._observe = observe
         self.logger = logger
 
+    async def _timed(self, op: str, coro):
+        if self._observe is None:
+            return await coro
+        start = time.monotonic()
+        try:
+            return await coro
+        finally:
+            self._observe(op, time.monotonic() - start)
+
+    def _connection_kwargs(self) -> dict:
+        kwargs = dict(
+            db=self._db,
+            ssl=self._ssl,
+            ssl_certfile=self._ssl_certfile,
+            ssl_keyfile=self._ssl_keyfile,
+            ssl_ca_certs=self._ssl_ca_certs,
+            username=self._username,
+            password=self._password,
+            decode_responses=self._decode,
+            max_connections=self._max_connections,
+            socket_timeout=self._socket_timeout,
+            socket_connect_timeout=self._socket_connect_timeout,
+            socket_keepalive=True,
+            health_check_interval=self._health_check_interval,
+        )
+        if self._retry_attempts > 0:
+            # reconnect and retry on connection errors and timeouts
+            kwargs["retry"] = Retry(ExponentialBackoff(cap=1.0, base=0.05),
+                                    self._retry_attempts)
+            kwargs["retry_on_error"] = [ConnectionError, TimeoutError]
+        return kwargs
+
     async def connect(self) -> Redis:
         if self._client is None:
-            self._client = Redis(
-                host=self._host,
-                port=self._port,
-                db=self._db,
-                ssl=self._ssl,
-                ssl_certfile=self._ssl_certfile,
-                ssl_keyfile=self._ssl_keyfile,
-                ssl_ca_certs=self._ssl_ca_certs,
-                username=self._username,
-                password=self._password,
-                decode_responses=self._decode
-            )
-            if self.logger:
-                self.logger.debug("RedisClient connect",
-                                  self._host, self._port, self._db)
+            kwargs = self._connection_kwargs()
+            if self._sentinels:
+                sentinel = Sentinel(
+                    self._sentinels,
+                    sentinel_kwargs={
+                        "socket_timeout": self._socket_timeout,
+                        "socket_connect_timeout":
+                        self._socket_connect_timeout,
+                    })
+                # the master is looked up again after failover
+                self._client = sentinel.master_for(
+                    self._sentinel_service_name, **kwargs)
+                if self.logger:
+                    self.logger.debug("RedisClient connect (sentinel)",
+                                      self._sentinels,
+                                      self._sentinel_service_name)
+            else:
+                self._client = Redis(host=self._host, port=self._port,
+                                     **kwargs)
+                if self.logger:
+                    self.logger.debug("RedisClient connect",
+                                      self._host, self._port, self._db)
         return self._client
 
     @property
@@ -67,38 +136,76 @@ class RedisClient:
         return self._client
 
     async def close(self) -> None:
+        await self._stop_listener()
         if self._client is not None:
-            await self._client.close()
+            await self._client.aclose()
             self._client = None
 
     async def get(self, key: str) -> Optional[bytes | str]:
-        return await self.client.get(key)
+        return await self._timed("get", self.client.get(key))
 
     async def set(self, key: str, value: bytes | str) -> bool:
-        return await self.client.set(key, value)
+        return await self._timed("set", self.client.set(key, value))
 
     async def setex(self, key: str, ttl: int, value: bytes | str) -> bool:
         if self.logger:
             self.logger.debug("setex", key)
-        return await self.client.setex(key, ttl, value)
+        return await self._timed("setex",
+                                 self.client.setex(key, ttl, value))
 
     async def delete(self, key: str) -> int:
-        return await self.client.delete(key)
+        return await self._timed("delete", self.client.delete(key))
 
     async def ping(self) -> bool:
-        return await self.client.ping()
+        return await self._timed("ping", self.client.ping())
+
+    async def try_lock(self, key: str, ttl: int = 10):
+        lock_key = f"{self.lock_prefix}{key}"
+        val = uuid.uuid4().hex
+        ok = await self._timed(
+            "lock",
+            self.client.set(lock_key, val, nx=True, ex=max(1, ttl)))
+        if ok:
+            return True, val
+        return False, ""
+
+    async def lock_and_get(self, key: str, ttl: int,
+                           get_keys: Sequence[str]):
+        """
+        try_lock() and GET of get_keys in one round trip (MULTI/EXEC).
+        Returns (locked, lock value, values of get_keys).
+        """
+        lock_key = f"{self.lock_prefix}{key}"
+        val = uuid.uuid4().hex
+        pipe = self.client.pipeline(transaction=True)
+        pipe.set(lock_key, val, nx=True, ex=max(1, ttl))
+        for k in get_keys:
+            pipe.get(k)
+        res = await self._timed("lock_and_get", pipe.execute())
+        if res[0]:
+            return True, val, list(res[1:])
+        return False, "", list(res[1:])
+
+    async def mget(self, keys: Sequence[str]) -> list:
+        return await self._timed("mget", self.client.mget(keys))
+
+    async def setex_and_publish(self, key: str, ttl: int,
+                                value: bytes | str, notify_key: str) -> None:
+        # one round trip
+        pipe = self.client.pipeline(transaction=False)
+        pipe.setex(key, ttl, value)
+        pipe.publish(self._channel(notify_key), value)
+        await self._timed("setex_and_publish", pipe.execute())
 
     async def acquire_lock(self, key: str, ttl: int = 10,
                            retry_count: int = 3,
                            retry_interval: float = 0.05):
         if self.logger:
             self.logger.debug("RedisClient acquire_lock", key)
-        lock_key = f"{self.lock_prefix}{key}"
-        val = uuid.uuid4().hex
         count = 0
         sleep = min(retry_interval, 0.2)
         while True:
-            ok = await self.client.set(lock_key, val, nx=True, ex=max(1, ttl))
+            ok, val = await self.try_lock(key, ttl)
             if self.logger:
                 self.logger.debug("RedisClient acquire_lock", key)
             if ok:
@@ -117,9 +224,229 @@ class RedisClient:
             self.logger.debug("RedisClient release_lock", key)
         lock_key = f"{self.lock_prefix}{key}"
         try:
-            res = await self.client.eval(_RELEASE_LUA, 1, lock_key, val)
+            res = await self._timed(
+                "unlock", self.client.eval(_RELEASE_LUA, 1, lock_key, val))
             return res == 1
         except Exception:
             if self.logger:
                 self.logger.warning("RedisClient release_lock failed", key)
             return False
+
+    # Notification (pub/sub)
+    #
+    # One connection subscribes to "{notify_prefix}*" and wakes up
+    # the local waiters of each channel, so waiting for many keys
+    # does not use many connections.
+
+    def _channel(self, key: str) -> str:
+        return f"{self.notify_prefix}{key}"
+
+    async def _start_listener(self) -> None:
+        if self._listener is not None and not self._listener.done():
+            return
+        await self._stop_listener()  # stopped by error
+        pubsub = self.client.pubsub()
+        await pubsub.psubscribe(f"{self.notify_prefix}*")
+        self._pubsub = pubsub
+        self._listener = asyncio.create_task(self._listen(pubsub))
+
+    async def _stop_listener(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._listener = None
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+
+    async def _listen(self, pubsub) -> None:
+        try:
+            while True:
+                # short timeout instead of blocking forever:
+                # socket_timeout would break an idle connection
+                msg = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0)
+                if msg is None or msg.get("type") != "pmessage":
+                    continue
+                channel = msg["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                for fut in self._waiters.pop(channel, ()):
+                    if not fut.done():
+                        fut.set_result(msg["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if self.logger:
+                self.logger.exception("RedisClient pubsub listener stopped")
+        finally:
+            # waiters fall back to polling
+            for futs in self._waiters.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.cancel()
+            self._waiters.clear()
+
+    async def subscribe(self, key: str) -> asyncio.Future:
+        """
+        Return a future set to the next message published for the key.
+        Call unsubscribe() when it is no longer needed.
+        """
+        await self._start_listener()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(self._channel(key), set()).add(fut)
+        return fut
+
+    def unsubscribe(self, key: str, fut: asyncio.Future) -> None:
+        channel = self._channel(key)
+        futs = self._waiters.get(channel)
+        if futs is not None:
+            futs.discard(fut)
+            if not futs:
+                del self._waiters[channel]
+        if not fut.done():
+            fut.cancel()
+
+    async def publish(self, key: str, message: bytes | str) -> int:
+        return await self._timed(
+            "publish", self.client.publish(self._channel(key), message))
+
+
+class MemoryRedisClient:
+    """
+    In-process replacement of RedisClient for a single-process
+    deployment (no network round trips).
+    Data is lost on restart and not shared with other processes.
+    """
+    def __init__(self, lock_prefix: str = "LOCK",
+                 notify_prefix: str = "NOTIFY",
+                 observe: Optional[Callable[[str, float], None]] = None,
+                 logger=None):
+        self.lock_prefix = lock_prefix
+        self.notify_prefix = notify_prefix
+        # key -> (expire (monotonic) or None, value)
+        self._data: Dict[str, tuple] = {}
+        self._sets = 0
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
+        self._observe = observe
+        self.logger = logger
+
+    def _get(self, key: str):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expire, value = item
+        if expire is not None and expire <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def _set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        expire = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (expire, value)
+        self._sets += 1
+        if self._sets % 1024 == 0:
+            self._expire_all()
+
+    def _expire_all(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, (e, _) in self._data.items()
+                    if e is not None and e <= now]:
+            del self._data[key]
+
+    async def connect(self) -> MemoryRedisClient:
+        return self
+
+    async def close(self) -> None:
+        for futs in self._waiters.values():
+            for fut in futs:
+                fut.cancel()
+        self._waiters.clear()
+
+    async def get(self, key: str) -> Optional[bytes | str]:
+        return self._get(key)
+
+    async def mget(self, keys: Sequence[str]) -> list:
+        return [self._get(k) for k in keys]
+
+    async def set(self, key: str, value: bytes | str) -> bool:
+        self._set(key, value)
+        return True
+
+    async def setex(self, key: str, ttl: int, value: bytes | str) -> bool:
+        self._set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str) -> int:
+        return 1 if self._data.pop(key, None) is not None else 0
+
+    async def ping(self) -> bool:
+        return True
+
+    async def try_lock(self, key: str, ttl: int = 10):
+        lock_key = f"{self.lock_prefix}{key}"
+        if self._get(lock_key) is not None:
+            return False, ""
+        val = uuid.uuid4().hex
+        self._set(lock_key, val, max(1, ttl))
+        return True, val
+
+    async def lock_and_get(self, key: str, ttl: int,
+                           get_keys: Sequence[str]):
+        ok, val = await self.try_lock(key, ttl)
+        return ok, val, [self._get(k) for k in get_keys]
+
+    async def acquire_lock(self, key: str, ttl: int = 10,
+                           retry_count: int = 3,
+                           retry_interval: float = 0.05):
+        count = 0
+        while True:
+            ok, val = await self.try_lock(key, ttl)
+            if ok or count >= retry_count:
+                return ok, val
+            await asyncio.sleep(min(retry_interval, 0.2))
+            count += 1
+
+    async def release_lock(self, key: str, val: str) -> bool:
+        lock_key = f"{self.lock_prefix}{key}"
+        if self._get(lock_key) == val:
+            del self._data[lock_key]
+            return True
+        return False
+
+    def _channel(self, key: str) -> str:
+        return f"{self.notify_prefix}{key}"
+
+    async def subscribe(self, key: str) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(self._channel(key), set()).add(fut)
+        return fut
+
+    def unsubscribe(self, key: str, fut: asyncio.Future) -> None:
+        channel = self._channel(key)
+        futs = self._waiters.get(channel)
+        if futs is not None:
+            futs.discard(fut)
+            if not futs:
+                del self._waiters[channel]
+        if not fut.done():
+            fut.cancel()
+
+    async def publish(self, key: str, message: bytes | str) -> int:
+        count = 0
+        for fut in self._waiters.pop(self._channel(key), ()):
+            if not fut.done():
+                fut.set_result(message)
+                count += 1
+        return count
+
+    async def setex_and_publish(self, key: str, ttl: int,
+                                value: bytes | str, notify_key: str) -> None:
+        await self.setex(key, ttl, value)
+        await self.publish(notify_key, value)
@@ -0,0 +1,160 @@
+# refresher.py
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Optional
+import asyncio
+import random
+import time
+
+
+class Refresher:
+    """
+    Cached value refreshed in the background (stale-while-revalidate).
+
+    - get() returns the cached value without waiting even if it is
+      older than refresh_interval (refreshed in the background).
+      It waits only when no value has been fetched yet.
+    - Concurrent fetches are merged into one (single-flight).
+    - Failures are retried with jittered exponential backoff,
+      and the previous value is kept.
+    """
+    def __init__(self, name: str,
+                 fetch: Callable[[], Awaitable[Any]],
+                 refresh_interval: float = 600.0,
+                 min_refetch_interval: float = 10.0,
+                 backoff_initial: float = 1.0,
+                 backoff_max: float = 300.0,
+                 jitter: float = 0.1,
+                 on_update: Optional[Callable[[Any], None]] = None,
+                 logger=None):
+        self.name = name
+        self._fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self._on_update = on_update
+        self.logger = logger
+        self.value: Any = None
+        self.fetched_at: Optional[float] = None  # monotonic
+        self.last_attempt: Optional[float] = None  # monotonic
+        self.failures = 0
+        self._inflight: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._background: set = set()
+
+    def age(self) -> Optional[float]:
+        if self.fetched_at is None:
+            return None
+        return time.monotonic() - self.fetched_at
+
+    def _jittered(self, seconds: float) -> float:
+        return seconds * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+    def _backoff(self) -> float:
+        delay = self.backoff_initial * (2 ** max(0, self.failures - 1))
+        return self._jittered(min(self.backoff_max, delay))
+
+    async def _do_fetch(self) -> Any:
+        self.last_attempt = time.monotonic()
+        try:
+            value = await self._fetch()
+        except Exception as e:
+            self.failures += 1
+            if self.logger:
+                self.logger.error(f"{self.name}: refresh failed"
+                                  f" (failures={self.failures}): {e}")
+            raise
+        self.value = value
+        self.fetched_at = time.monotonic()
+        self.failures = 0
+        if self._on_update:
+            self._on_update(value)
+        if self.logger:
+            self.logger.debug(f"{self.name}: refreshed")
+        return value
+
+    async def refresh(self) -> Any:
+        # single-flight (in the same event loop)
+        task = self._inflight
+        loop = asyncio.get_running_loop()
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(self._do_fetch())
+            self._inflight = task
+        return await asyncio.shield(task)
+
+    def _refresh_in_background(self) -> None:
+        async def run():
+            try:
+                await self.refresh()
+            except Exception:
+                pass
+        task = asyncio.get_running_loop().create_task(run())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _can_retry(self) -> bool:
+        if self.last_attempt is None:
+            return True
+        elapsed = time.monotonic() - self.last_attempt
+        if self.failures > 0:
+            return elapsed >= self._backoff()
+        return elapsed >= self.min_refetch_interval
+
+    async def get(self) -> Any:
+        if self.value is None:
+            if self.failures > 0 and not self._can_retry():
+                raise RuntimeError(f"{self.name}: unavailable"
+                                   f" (failures={self.failures})")
+            return await self.refresh()
+        age = self.age()
+        if (age is not None and age > self.refresh_interval
+                and not self.running() and self._can_retry()):
+            # stale: use it while revalidating
+            self._refresh_in_background()
+        return self.value
+
+    async def refetch(self) -> Any:
+        """
+        Fetch now unless fetched recently (ex. unknown key ID).
+        Returns the current value.
+        """
+        if self._can_retry():
+            try:
+                return await self.refresh()
+            except Exception:
+                pass
+        return self.value
+
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _loop(self) -> None:
+        while True:
+            if self.failures > 0:
+                delay = self._backoff()
+            elif self.fetched_at is None:
+                delay = 0
+            else:
+                delay = max(0.0, self._jittered(self.refresh_interval)
+                            - self.age())
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+
+    def start(self) -> None:
+        if not self.running():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
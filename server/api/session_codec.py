@@ -0,0 +1,211 @@
+# session_codec.py
+# Compact serializer for session data in cookie
+#
+# format (before encryption):
+#   1 byte: codec (CODEC_RAW or CODEC_DEFLATE)
+#   fields (CODEC_DEFLATE: raw deflate with PRESET_DICT):
+#     key:   1 byte (index of KEYS + 1), or 0 + varint length + name
+#     type:  1 byte (TYPE_*)
+#     value: varint length + bytes
+#            (TYPE_JWT: 3 x (varint length + base64url decoded bytes))
+from __future__ import annotations
+from typing import Any, Dict
+import base64
+import json
+import zlib
+
+KEYS = (
+    "access_token",
+    "refresh_token",
+    "token_id",
+    "key",
+)
+_KEY_INDEX = {k: i + 1 for i, k in enumerate(KEYS)}
+
+TYPE_NONE = 0
+TYPE_STR = 1
+TYPE_JWT = 2
+TYPE_INT = 3
+TYPE_JSON = 4
+TYPE_TRUE = 5
+TYPE_FALSE = 6
+
+CODEC_RAW = 0
+CODEC_DEFLATE = 1
+
+# frequent strings in JWT (JSON) of OpenID providers
+PRESET_DICT = (
+    b'{"alg":"RS256","typ":"JWT","kid":"'
+    b'{"exp":,"iat":,"auth_time":,"jti":"","iss":"https://'
+    b'/realms/","aud":["account"],"sub":"","typ":"Bearer",'
+    b'"typ":"Refresh","typ":"Offline","azp":"","nonce":"'
+    b'"session_state":"","sid":"","acr":"1","allowed-origins":["'
+    b'"realm_access":{"roles":["offline_access","uma_authorization",'
+    b'"default-roles-"]},"resource_access":{"account":{"roles":'
+    b'["manage-account","manage-account-links","view-profile"]}},'
+    b'"scope":"openid email profile","email_verified":false,'
+    b'"name":"","preferred_username":"","given_name":"",'
+    b'"family_name":"","email":"","hpci.id":"'
+)
+
+
+def _b64url_decode(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+
+def _b64url_encode(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode()
+
+
+def _put_varint(out: bytearray, n: int) -> None:
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return
+
+
+def _get_varint(buf: bytes, pos: int):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _put_bytes(out: bytearray, b: bytes) -> None:
+    _put_varint(out, len(b))
+    out += b
+
+
+def _get_bytes(buf: bytes, pos: int):
+    n, pos = _get_varint(buf, pos)
+    end = pos + n
+    if end > len(buf):
+        raise ValueError("truncated")
+    return buf[pos:end], end
+
+
+def _split_jwt(s: str):
+    # JWS compact serialization: base64url segments only
+    parts = s.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        raw = [_b64url_decode(p) for p in parts]
+    except Exception:
+        return None
+    if [_b64url_encode(r) for r in raw] != parts:
+        return None  # not canonical (cannot be restored)
+    return raw
+
+
+def _put_value(out: bytearray, value: Any) -> None:
+    if value is None:
+        out.append(TYPE_NONE)
+    elif value is True:
+        out.append(TYPE_TRUE)
+    elif value is False:
+        out.append(TYPE_FALSE)
+    elif isinstance(value, int) and value >= 0:
+        out.append(TYPE_INT)
+        _put_varint(out, value)
+    elif isinstance(value, str):
+        raw = _split_jwt(value)
+        if raw is not None:
+            out.append(TYPE_JWT)
+            for r in raw:
+                _put_bytes(out, r)
+        else:
+            out.append(TYPE_STR)
+            _put_bytes(out, value.encode())
+    else:
+        out.append(TYPE_JSON)
+        _put_bytes(out, json.dumps(value).encode())
+
+
+def _get_value(buf: bytes, pos: int):
+    t = buf[pos]
+    pos += 1
+    if t == TYPE_NONE:
+        return None, pos
+    if t == TYPE_TRUE:
+        return True, pos
+    if t == TYPE_FALSE:
+        return False, pos
+    if t == TYPE_INT:
+        return _get_varint(buf, pos)
+    if t == TYPE_JWT:
+        parts = []
+        for _ in range(3):
+            r, pos = _get_bytes(buf, pos)
+            parts.append(_b64url_encode(r))
+        return ".".join(parts), pos
+    b, pos = _get_bytes(buf, pos)
+    if t == TYPE_STR:
+        return b.decode(), pos
+    if t == TYPE_JSON:
+        return json.loads(b), pos
+    raise ValueError(f"unknown type: {t}")
+
+
+def serialize(data: Dict[str, Any]) -> bytes:
+    out = bytearray()
+    for key, value in data.items():
+        index = _KEY_INDEX.get(key)
+        if index is not None:
+            out.append(index)
+        else:
+            out.append(0)
+            _put_bytes(out, key.encode())
+        _put_value(out, value)
+    return bytes(out)
+
+
+def deserialize(buf: bytes) -> Dict[str, Any]:
+    data = {}
+    pos = 0
+    while pos < len(buf):
+        index = buf[pos]
+        pos += 1
+        if index == 0:
+            b, pos = _get_bytes(buf, pos)
+            key = b.decode()
+        else:
+            key = KEYS[index - 1]
+        data[key], pos = _get_value(buf, pos)
+    return data
+
+
+def _deflate(b: bytes) -> bytes:
+    c = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=PRESET_DICT)
+    return c.compress(b) + c.flush()
+
+
+def _inflate(b: bytes) -> bytes:
+    d = zlib.decompressobj(-15, zdict=PRESET_DICT)
+    return d.decompress(b) + d.flush()
+
+
+def pack(data: Dict[str, Any]) -> bytes:
+    raw = serialize(data)
+    deflated = _deflate(raw)
+    if len(deflated) < len(raw):
+        return bytes([CODEC_DEFLATE]) + deflated
+    return bytes([CODEC_RAW]) + raw
+
+
+def unpack(b: bytes) -> Dict[str, Any]:
+    codec = b[0]
+    if codec == CODEC_DEFLATE:
+        return deserialize(_inflate(b[1:]))
+    if codec == CODEC_RAW:
+        return deserialize(b[1:])
+    raise ValueError(f"unknown codec: {codec}")
@@ -7,11 +7,32 @@ import pytest_asyncio
 from unittest.mock import patch, Mock, MagicMock, AsyncMock
 
 import zipfile
+import zlib
 import io
 import time
 import json
+import ipaddress
+import os
+import subprocess
+import importlib.util
+import httpx
 
 import gfarm_http_gateway
+from gfarm_worker import GfarmWorkerPool
+from gfarm_scheduler import GfarmScheduler, SchedulerBusy, LANE_BULK
+import metrics
+from refresher import Refresher
+from http_client import SharedTransport
+import session_codec
+from redis_client import RedisClient, MemoryRedisClient
+from gfls_entry import Gfls_Entry
+import dir_filter
+import gfls_walker
+import ndjson_stream
+import content_encoding
+import dir_columnar
+import dir_usage
+from listing_snapshot import ListingSnapshotStore
 
 
 client = TestClient(gfarm_http_gateway.app)
@@ -29,6 +50,21 @@ req_headers_basic_auth = {"Authorization": "Basic " + userpass_b64_str}
 req_headers_anon_auth = {}
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    gfarm_http_gateway.stat_cache.clear()
+    gfarm_http_gateway.identity_cache.clear()
+    gfarm_http_gateway.verified_claims_cache.clear()
+    gfarm_http_gateway.session_decode_cache.clear()
+    gfarm_http_gateway.access_token_cache.clear()
+    yield
+    gfarm_http_gateway.stat_cache.clear()
+    gfarm_http_gateway.identity_cache.clear()
+    gfarm_http_gateway.verified_claims_cache.clear()
+    gfarm_http_gateway.session_decode_cache.clear()
+    gfarm_http_gateway.access_token_cache.clear()
+
+
 @pytest.fixture
 def mock_claims():
     with patch("jose.jwt.get_unverified_claims") as mock:
@@ -66,6 +102,26 @@ def mock_user_passwd():
         yield mock
 
 
+def patch_get_stats(mock_info):
+    # get_stat() and get_stats() consistent with the mocked get_file_info()
+    async def get_stat(env, path, metadata=False):
+        info = await mock_info(env, path)
+        filetype = "regular file" if info.is_file else "directory"
+        return gfarm_http_gateway.Stat(
+            File=path, Filetype=filetype, Size=info.size)
+
+    async def get_stats(env, paths, metadata=False):
+        for path in paths:
+            try:
+                st = await get_stat(env, path, metadata)
+            except Exception as e:
+                yield path, e
+                continue
+            yield path, st
+    return patch.multiple("gfarm_http_gateway",
+                          get_stat=get_stat, get_stats=get_stats)
+
+
 @pytest.fixture
 def mock_get_file_info():
     with patch("gfarm_http_gateway.get_file_info") as mock:
@@ -75,7 +131,8 @@ def mock_get_file_info():
         mtime = 1717232400.0
         mock.return_value = gfarm_http_gateway.FileInfo(
             exists=existing, is_file=is_file, size=size, mtime=mtime)
-        yield mock
+        with patch_get_stats(mock):
+            yield mock
 
 
 def mock_exec_common(mock, stdout, stderr, result):
@@ -136,7 +193,8 @@ async def mock_get_file_info_not_file(request):
         size = 1
         mock.return_value = gfarm_http_gateway.FileInfo(
             exists=existing, is_file=is_file, size=size, mtime=0)
-        yield mock
+        with patch_get_stats(mock):
+            yield mock
 
 
 @pytest_asyncio.fixture(scope="function")
@@ -144,7 +202,8 @@ async def mock_get_file_info_not_found(request):
     with patch("gfarm_http_gateway.get_file_info") as mock:
         err = FileNotFoundError("no such file or directory")
         mock.side_effect = err
-        yield mock
+        with patch_get_stats(mock):
+            yield mock
 
 
 @pytest_asyncio.fixture(scope="function")
@@ -154,6 +213,13 @@ async def mock_gfls(request):
         yield mock_exec_common(mock, stdout, stderr, result)
 
 
+@pytest.fixture
+def recursive_serial():
+    # mock_gfls returns the output of "gfls -R"
+    with patch('gfarm_http_gateway.RECURSIVE_PARALLEL', 1):
+        yield
+
+
 @pytest_asyncio.fixture(scope="function")
 async def mock_gfexport(request):
     stderr, result = request.param
@@ -406,6 +472,938 @@ async def test_whoami_oidc_session(mock_claims, mock_access_token, mock_exec):
     assert response.text == expect_gfwhoami_stdout
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfwhoami], indirect=True)
+async def test_whoami_scheduler_busy(mock_claims, mock_exec):
+    sched = GfarmScheduler(max_procs=1, queue_timeout=0.01, retry_after=7)
+    slot = await sched.acquire("otheruser")
+    with patch("gfarm_http_gateway.gfarm_scheduler", sched):
+        response = client.get("/conf/me", headers=req_headers_oidc_auth)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+    mock_exec.assert_not_called()
+    assert sched.stats()["timeout_total"] == 1
+    sched.release(slot)
+    assert sched.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_gfarm_scheduler_fair_queuing():
+    sched = GfarmScheduler(max_procs=1, queue_timeout=0)
+    order = []
+
+    async def run(user):
+        slot = await sched.acquire(user)
+        order.append(user)
+        await asyncio.sleep(0)
+        sched.release(slot)
+
+    first = await sched.acquire("first")
+    # user1 queues 3 requests before user2
+    tasks = [asyncio.create_task(run(u))
+             for u in ["user1", "user1", "user1", "user2"]]
+    await asyncio.sleep(0)
+    assert sched.stats()["queued"] == 4
+    assert sched.stats()["queued_users"] == 2
+    sched.release(first)
+    await asyncio.gather(*tasks)
+    assert order == ["user1", "user2", "user1", "user1"]
+    stats = sched.stats()
+    assert stats["active"] == 0
+    assert stats["queued"] == 0
+    assert stats["granted_total"] == 5
+
+
+@pytest.mark.asyncio
+async def test_gfarm_scheduler_lanes():
+    sched = GfarmScheduler(max_procs=3, lane_limits={LANE_BULK: 1},
+                           max_queue_per_user=1, queue_timeout=0)
+    bulk = await sched.acquire("user1", LANE_BULK)
+    waiter = asyncio.create_task(sched.acquire("user1", LANE_BULK))
+    await asyncio.sleep(0)
+    # bulk lane is full, but interactive requests can run
+    slot = await sched.acquire("user1")
+    assert sched.stats()["lanes"][LANE_BULK]["queued"] == 1
+    with pytest.raises(SchedulerBusy):
+        await sched.acquire("user1", LANE_BULK)  # per-user queue is full
+    sched.release(bulk)
+    sched.release(await waiter)
+    sched.release(slot)
+    assert sched.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_gfarm_scheduler_nested():
+    from gfarm_scheduler import _request_slots
+    sched = GfarmScheduler(max_procs=3, max_procs_per_request=2,
+                           queue_timeout=1)
+    started = asyncio.Event()
+    step = asyncio.Event()
+
+    async def request():
+        _request_slots.set([])
+        outer = await sched.acquire("user1")
+        started.set()
+        await step.wait()
+        # the slot left for nested processes
+        inner = await sched.acquire("user1", LANE_BULK)
+        assert inner.nested
+        assert sched.stats()["active"] == 3
+        # max_procs_per_request
+        waiter = asyncio.create_task(sched.acquire("user1"))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        assert sched.stats()["nested_queued"] == 1
+        sched.release(inner)
+        # served before the new request
+        third = await waiter
+        assert third.nested
+        sched.release(third)
+        sched.release(outer)
+
+    task = asyncio.create_task(request())
+    await started.wait()
+    other = await sched.acquire("user2")
+    # new requests leave a slot for nested processes
+    new = asyncio.create_task(sched.acquire("user3"))
+    await asyncio.sleep(0)
+    assert not new.done()
+    step.set()
+    await task
+    sched.release(await new)
+    sched.release(other)
+    stats = sched.stats()
+    assert stats["active"] == 0
+    assert stats["nested"] == 0
+    assert stats["nested_queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_dir_list_recursive_max_procs(mock_claims):
+    # /testdir/d{i}/f
+    line = "{} 1 user group 0 Jun 01 09:00:00 2024 {}\n"
+    outputs = {"/testdir": "".join(line.format("drwxr-xr-x", f"d{i}")
+                                   for i in range(8))}
+    for i in range(8):
+        outputs[f"/testdir/d{i}"] = line.format("-rw-r--r--", "f")
+    running = 0
+    max_running = 0
+
+    async def exec_gfls(command, *args, **kwargs):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        exited = asyncio.Event()
+        proc = Mock()
+        proc.stdout = asyncio.StreamReader()
+        proc.stderr = None
+
+        async def output():
+            nonlocal running
+            await asyncio.sleep(0.01)
+            proc.stdout.feed_data(outputs[args[-1]].encode())
+            proc.stdout.feed_eof()
+            running -= 1
+            exited.set()
+
+        async def wait():
+            await exited.wait()
+            return 0
+
+        proc.wait = wait
+        proc.task = asyncio.create_task(output())
+        return proc
+
+    sched = GfarmScheduler(max_procs=3)
+    with patch("gfarm_http_gateway.gfarm_scheduler", sched), \
+         patch("gfarm_http_gateway.RECURSIVE_PARALLEL", 8), \
+         patch("asyncio.create_subprocess_exec", side_effect=exec_gfls):
+        response = client.get("/dir/testdir?recursive=1&long_format=1"
+                              "&output_format=plain",
+                              headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    assert response.text.count(" f\n") == 8
+    # not exceeded by the parallel gfls of the walk (RECURSIVE_PARALLEL)
+    assert max_running == 3
+    assert sched.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_gfarm_scheduler_release_on_popen_exit():
+    sched = GfarmScheduler(max_procs=1)
+    with patch("gfarm_http_gateway.gfarm_scheduler", sched), \
+         patch("gfarm_http_gateway.command_exited") as mock_exited:
+        slot = await sched.acquire("user1")
+        p = subprocess.Popen(["sleep", "0.1"])
+        gfarm_http_gateway.gfarm_scheduler_release_on_popen_exit(
+            p, slot, "sleep", time.monotonic())
+        assert sched.stats()["active"] == 1
+        for _ in range(100):
+            if slot.released:
+                break
+            await asyncio.sleep(0.05)
+        assert sched.stats()["active"] == 0
+        mock_exited.assert_called_once()
+        assert mock_exited.call_args.args[2] == 0
+
+
+def test_scheduler_status_auth():
+    response = client.get("/status/scheduler")
+    assert response.status_code == 401
+    with patch("gfarm_http_gateway.ALLOW_ANONYMOUS", True):
+        response = client.get("/status/scheduler")
+    assert response.status_code == 401
+    response = client.get("/status/scheduler",
+                          headers={"Authorization": "Basic "
+                                   + base64.b64encode(b"user1:pw").decode()})
+    assert response.status_code == 200
+    assert response.json()["nested"] == 0
+
+
+@pytest.mark.asyncio
+async def test_verify_token_cache():
+    valid = {"sub": user_claim, "exp": int(time.time()) + 3600}
+    expiring = {"sub": user_claim, "exp": int(time.time()) + 10}
+    with patch("gfarm_http_gateway.oidc_jwks", new_callable=AsyncMock), \
+         patch("jose.jwt.get_unverified_header") as mock_header, \
+         patch("jose.jwt.decode") as mock_decode:
+        mock_header.return_value = {"alg": "RS256"}
+        mock_decode.return_value = valid
+        for _ in range(3):
+            claims = await gfarm_http_gateway.verify_token("token1")
+            assert claims == valid
+        assert mock_decode.call_count == 1
+        # shorter than TOKEN_MIN_VALID_TIME_REMAINING: not cached
+        mock_decode.return_value = expiring
+        await gfarm_http_gateway.verify_token("token2")
+        await gfarm_http_gateway.verify_token("token2")
+        assert mock_decode.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_refresher():
+    calls = []
+    gate = asyncio.Event()
+
+    async def fetch():
+        calls.append(1)
+        await gate.wait()
+        return len(calls)
+
+    r = Refresher("test", fetch, refresh_interval=60,
+                  min_refetch_interval=0)
+    # single-flight
+    tasks = [asyncio.create_task(r.get()) for _ in range(5)]
+    await asyncio.sleep(0)
+    gate.set()
+    assert await asyncio.gather(*tasks) == [1] * 5
+    assert len(calls) == 1
+    # stale-while-revalidate
+    r.fetched_at -= 120
+    assert await r.get() == 1
+    await asyncio.sleep(0.01)
+    assert len(calls) == 2
+    assert await r.get() == 2
+
+
+@pytest.mark.asyncio
+async def test_refresher_backoff():
+    fetch = AsyncMock(side_effect=RuntimeError("down"))
+    r = Refresher("test", fetch, backoff_initial=60)
+    with pytest.raises(RuntimeError):
+        await r.get()
+    # not retried until backoff
+    with pytest.raises(RuntimeError, match="unavailable"):
+        await r.get()
+    assert fetch.call_count == 1
+    assert r.failures == 1
+
+
+@pytest.mark.asyncio
+async def test_oidc_jwk_unknown_kid():
+    key1 = {"kid": "k1", "kty": "RSA"}
+    key2 = {"kid": "k2", "kty": "RSA"}
+    fetch = AsyncMock(side_effect=[{"keys": [key1]},
+                                   {"keys": [key1, key2]}])
+    r = Refresher("oidc_jwks", fetch, min_refetch_interval=0,
+                  on_update=gfarm_http_gateway.update_oidc_jwks)
+    with patch("gfarm_http_gateway.oidc_jwks_refresher", r):
+        assert await gfarm_http_gateway.oidc_jwk("k1") == key1
+        assert await gfarm_http_gateway.oidc_jwk("k1") == key1
+        assert fetch.call_count == 1
+        # rotated
+        assert await gfarm_http_gateway.oidc_jwk("k2") == key2
+        assert fetch.call_count == 2
+        r.min_refetch_interval = 60
+        with pytest.raises(Exception, match="Unknown key ID"):
+            await gfarm_http_gateway.oidc_jwk("k3")
+        assert fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_http_request_retry():
+    statuses = [503, 200]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0), json={"ok": True})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    retries = gfarm_http_gateway.METRIC_OIDC_RETRIES.labels("GET", 503)
+    before = retries.value
+    with patch("gfarm_http_gateway.http_client", client), \
+         patch("gfarm_http_gateway.HTTP_RETRY_INTERVAL", 0):
+        response = await gfarm_http_gateway.http_get("http://idp/")
+    assert response.status_code == 200
+    assert retries.value == before + 1
+
+
+@pytest.mark.asyncio
+async def test_shared_transport():
+    transport = SharedTransport()
+    pool = transport.open()
+    async with httpx.AsyncClient(transport=transport):
+        pass
+    # not closed by the client
+    assert transport.open() is pool
+    await transport.close()
+    assert transport.open() is not pool
+    await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_use_refresh_token_coalesced():
+    new_token = {"access_token": "AT2", "refresh_token": "RT2"}
+
+    async def refresh(refresh_token):
+        await asyncio.sleep(0.01)
+        return new_token
+
+    reqs = [MagicMock(session={}) for _ in range(5)]
+    token = {"access_token": "AT1", "refresh_token": "RT1"}
+    with patch("gfarm_http_gateway.TOKEN_STORE", "session"), \
+         patch("gfarm_http_gateway.refresh_token_request",
+               side_effect=refresh) as mock_refresh:
+        results = await asyncio.gather(
+            *[gfarm_http_gateway.use_refresh_token(r, token)
+              for r in reqs])
+    assert results == [new_token] * 5
+    assert mock_refresh.call_count == 1
+    for r in reqs:
+        assert r.session["token"]
+    assert gfarm_http_gateway.refresh_inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_use_refresh_token_notified():
+    from cryptography.fernet import Fernet
+    store = MemoryRedisClient()
+    # held by another process
+    ok, _ = await store.try_lock("TID")
+    assert ok
+    session_ref = {"token_id": "TID", "access_token": "AT1",
+                   "key": Fernet.generate_key().decode()}
+    request = MagicMock(session={})
+    request.app.state.redis = store
+    new_token = {"access_token": "AT2", "refresh_token": "RT2"}
+    with patch("gfarm_http_gateway.TOKEN_STORE", "database"), \
+         patch("gfarm_http_gateway.encrypt_token",
+               new_callable=AsyncMock) as mock_encrypt, \
+         patch("gfarm_http_gateway.refresh_token_request",
+               new_callable=AsyncMock) as mock_refresh:
+        task = asyncio.create_task(
+            gfarm_http_gateway.use_refresh_token(request, session_ref))
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        # the lock holder publishes the new token
+        eb = gfarm_http_gateway.encrypt_refreshed_token(session_ref,
+                                                        new_token)
+        await store.setex_and_publish("TID:refreshed", 5, eb, "TID")
+        assert await asyncio.wait_for(task, 1) == new_token
+    mock_refresh.assert_not_called()
+    # the refresh token in Redis is not overwritten
+    assert mock_encrypt.call_args.kwargs["store"] is False
+
+
+@pytest.mark.asyncio
+async def test_credential_keeper(tmp_path):
+    from jose import jwt
+    now = int(time.time())
+    token1 = jwt.encode({"sub": "user1", "exp": now}, "secret")
+    token2 = jwt.encode({"sub": "user1", "exp": now + 3600}, "secret")
+    env = {"GFARM_SASL_PASSWORD": token1}
+    with patch("gfarm_http_gateway.TMPDIR_TOKENS", str(tmp_path)), \
+         patch("gfarm_http_gateway.TOKEN_MIN_VALID_TIME_REMAINING", 1), \
+         patch("gfarm_http_gateway.get_access_token",
+               side_effect=[token1, token2]):
+        keeper = gfarm_http_gateway.CredentialKeeper(MagicMock(), env)
+        env = await keeper.start()
+        path = env["JWT_USER_PATH"]
+        assert "GFARM_SASL_PASSWORD" not in env
+        # refreshed in background before exp
+        for _ in range(100):
+            if keeper.expire == now + 3600:
+                break
+            await asyncio.sleep(0.01)
+        with open(path) as f:
+            assert f.read() == token2
+        await keeper.stop()
+        await keeper.stop()
+    assert not os.path.exists(path)
+
+    # stopped when the response ends, even if the body is never iterated
+    keeper = MagicMock(stop=AsyncMock())
+    started = False
+
+    async def body():
+        nonlocal started
+        started = True
+        yield b"x"
+
+    async def send(message):
+        raise OSError("disconnected")
+
+    response = gfarm_http_gateway.CredentialStreamingResponse(
+        body(), keeper=keeper)
+    with pytest.raises(Exception):
+        await response({"type": "http", "asgi": {"spec_version": "2.4"}},
+                       AsyncMock(), send)
+    assert not started
+    keeper.stop.assert_awaited_once()
+
+
+def test_conf_check_session_store():
+    with patch("gfarm_http_gateway.SESSION_STORE", "server"):
+        gfarm_http_gateway.conf_check_invalid()
+        with patch("gfarm_http_gateway.TOKEN_STORE", "session"), \
+             pytest.raises(SystemExit):
+            gfarm_http_gateway.conf_check_invalid()
+    with patch("gfarm_http_gateway.SESSION_STORE", "sever"), \
+         pytest.raises(SystemExit):
+        gfarm_http_gateway.conf_check_invalid()
+
+
+def test_session_codec():
+    jwt_str = "eyJhbGciOiJSUzI1NiJ9.eyJleHAiOjF9.c2lnbmF0dXJl"
+    data = {"access_token": jwt_str,
+            "refresh_token": "not.a.jwt!",
+            "token_id": "abc",
+            "unknown_key": "x" * 300,
+            "n": 123456789, "neg": -1, "none": None, "flag": True,
+            "nested": {"a": [1, 2]}}
+    assert session_codec.unpack(session_codec.pack(data)) == data
+    # JWT segments are stored as binary
+    packed = session_codec.serialize({"access_token": jwt_str})
+    assert len(packed) < len(jwt_str)
+
+
+def test_session_cookie_compatibility():
+    data = {"access_token": "AT", "refresh_token": "RT"}
+    v2 = gfarm_http_gateway.encrypt_json(data)
+    assert v2.startswith("v2.")
+    with patch("gfarm_http_gateway.SESSION_COOKIE_FORMAT", "v1"):
+        v1 = gfarm_http_gateway.encrypt_json(data)
+    assert not v1.startswith("v2.")
+    assert gfarm_http_gateway.decrypt_json(v1) == data
+    decoded = gfarm_http_gateway.decrypt_json(v2)
+    assert decoded == data
+    # cached, but not shared with the caller
+    decoded["access_token"] = "modified"
+    assert gfarm_http_gateway.decrypt_json(v2) == data
+    assert len(gfarm_http_gateway.session_decode_cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_server_session_store():
+    from jose import jwt
+    access_token = jwt.encode({"sub": "user1", "groups": ["g"] * 300,
+                               "exp": int(time.time()) + 3600}, "secret")
+    store = MemoryRedisClient()
+    request = MagicMock(session={})
+    request.app.state.redis = store
+    with patch("gfarm_http_gateway.SESSION_STORE", "server"):
+        await gfarm_http_gateway.set_token(
+            request, {"access_token": access_token, "refresh_token": "RT"})
+        cookie = request.session["token"]
+        # the cookie has only the reference
+        assert len(cookie) < len(access_token)
+        ref = gfarm_http_gateway.decrypt_json(cookie)
+        assert "access_token" not in ref
+        assert await store.get(ref["token_id"] + ":at")
+        token = await gfarm_http_gateway.get_token(request)
+        assert token["access_token"] == access_token
+        # from the in-process cache
+        await store.delete(ref["token_id"] + ":at")
+        token = await gfarm_http_gateway.get_token(request)
+        assert token["access_token"] == access_token
+        gfarm_http_gateway.access_token_cache.clear()
+        assert await gfarm_http_gateway.get_token(request) is None
+
+
+@pytest.mark.asyncio
+async def test_server_session_store_logout():
+    from jose import jwt
+    access_token = jwt.encode({"sub": "user1",
+                               "exp": int(time.time()) + 3600}, "secret")
+    store = MemoryRedisClient()
+    request = MagicMock(session={})
+    request.app.state.redis = store
+    with patch("gfarm_http_gateway.SESSION_STORE", "server"):
+        await gfarm_http_gateway.set_token(
+            request, {"access_token": access_token, "refresh_token": "RT"})
+        cookie = request.session["token"]
+        ref = gfarm_http_gateway.decrypt_json(cookie)
+        await gfarm_http_gateway.revoke_token(request)
+        assert "token" not in request.session
+        assert await store.get(ref["token_id"]) is None
+        assert await store.get(ref["token_id"] + ":at") is None
+        # the copied cookie is rejected (not from the cache)
+        replayed = MagicMock(session={"token": cookie})
+        replayed.app.state.redis = store
+        assert await gfarm_http_gateway.get_token(replayed) is None
+
+
+@pytest.mark.asyncio
+async def test_redis_client():
+    fakeredis = pytest.importorskip("fakeredis")
+    store = RedisClient(host=None, port=None, db=0,
+                        client=fakeredis.FakeAsyncRedis())
+    await store.set("RT", b"rt1")
+    ok, val, values = await store.lock_and_get("TID", 5, ["X", "RT"])
+    assert ok and values == [None, b"rt1"]
+    ok, _, values = await store.lock_and_get("TID", 5, ["RT"])
+    assert not ok and values == [b"rt1"]
+    waiter = await store.subscribe("TID")
+    await store.setex_and_publish("X", 5, b"new", "TID")
+    assert await asyncio.wait_for(waiter, 5) == b"new"
+    assert await store.get("X") == b"new"
+    store.unsubscribe("TID", waiter)
+    if importlib.util.find_spec("lupa"):  # Lua for fakeredis
+        assert await store.release_lock("TID", val)
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_memory_redis_client():
+    store = MemoryRedisClient()
+    await store.setex("A", 0.05, b"a")
+    assert await store.mget(["A", "B"]) == [b"a", None]
+    ok, val, values = await store.lock_and_get("L", 5, ["A"])
+    assert ok and values == [b"a"]
+    assert (await store.try_lock("L"))[0] is False
+    assert await store.release_lock("L", val)
+    await asyncio.sleep(0.06)
+    assert await store.get("A") is None
+
+
+def test_gfls_entry_parse():
+    for mtime_str in ("Jun 01 09:00:00 2024", "Feb 29 23:59:59 2024",
+                      "Dec 31 00:00:00 1999", "Jan 1 01:02:03 2025"):
+        entry = Gfls_Entry.parse(
+            f"rw- -rwsr-x--T 1 user group 5 {mtime_str} a b",
+            False, True, True, True, dirname="/d")
+        assert entry.mtime == time.mktime(
+            time.strptime(mtime_str, '%b %d %H:%M:%S %Y'))
+        assert entry.mtime_str == mtime_str
+        assert entry.mode == 0o5750
+        assert entry.path == "/d/a b"
+        assert entry.perms == "rw-"
+    entry = Gfls_Entry.parse(
+        "lrwxrwxrwx 1 user group 5 Jun 01 09:00:00 2024 x -> /y",
+        True, True, True, False)
+    assert (entry.name, entry.linkname, entry.is_sym) == ("x", "/y", True)
+    assert not hasattr(entry, "__dict__")
+    for line in ("-rw-r--r-- 1 user group 5 Feb 30 00:00:00 2024 a",
+                 "-rw-r--r-- 1 user group 5 Jun 01 24:00:00 2024 a"):
+        with pytest.raises(ValueError):
+            Gfls_Entry.parse(line, False, True, True, False)
+    line = "/testdir/sub:"
+    assert Gfls_Entry.parse(line, False, True, True, False) == line
+
+
+@pytest.mark.asyncio
+async def test_dir_filter_top_k():
+    import random
+    rnd = random.Random(0)
+    entries = []
+    for i in range(300):
+        entry = Gfls_Entry(f"f{rnd.randint(0, 50)}", 1, "u", "g",
+                           rnd.randint(0, 20), "/d",
+                           None, "-rw-r--r--")
+        entry.mtime = float(rnd.randint(0, 5))
+        entries.append(entry)
+
+    async def gen():
+        for entry in entries:
+            yield entry
+
+    for key in dir_filter.SORT_KEYS:
+        keyfunc = dir_filter.sort_key_func(key)
+        for reverse in (False, True):
+            expect = sorted(entries, key=keyfunc, reverse=reverse)
+            for top in (1, 10, 300, 1000):
+                result = await dir_filter.sort_entries(
+                    gen(), key, reverse, top)
+                assert result == expect[:top]
+    # the whole listing is never buffered
+    for top in (None, 0):
+        with pytest.raises(ValueError):
+            await dir_filter.sort_entries(gen(), "name", False, top)
+
+    f = dir_filter.DirFilter(pattern="f1*", min_size=5, max_mtime=3)
+    result = [e async for e in dir_filter.filter_entries(gen(), f)]
+    assert result == [e for e in entries
+                      if e.name.startswith("f1") and e.size >= 5
+                      and e.mtime <= 3]
+    with pytest.raises(ValueError):
+        dir_filter.DirFilter(regex="[")
+    # may take a long time
+    for regex in ("(a+)+$", "(a|aa)*$", r"(a)\1", "a*a*a*a*b",
+                  "a" * (dir_filter.REGEX_MAX_LENGTH + 1)):
+        with pytest.raises(ValueError):
+            dir_filter.DirFilter(regex=regex)
+    for regex in (r"^f1.*\.txt$", r"\d{4}-\d{2}", "(?:ab|cd)x"):
+        dir_filter.DirFilter(regex=regex)
+
+
+@pytest.mark.asyncio
+async def test_recursive_walker():
+    # /r/d{i}/d{j}/f (i, j < 3)
+    tree = {"/r": ["d0", "d1", "d2", "f"]}
+    for i in range(3):
+        tree[f"/r/d{i}"] = [f"d{j}" for j in range(3)] + ["f"]
+        for j in range(3):
+            tree[f"/r/d{i}/d{j}"] = ["f"]
+    running = []
+    max_running = 0
+
+    async def list_dir(path, is_file):
+        nonlocal max_running
+        running.append(path)
+        max_running = max(max_running, len(running))
+        try:
+            for name in tree[path]:
+                await asyncio.sleep(0.001)
+                mode = "-rw-r--r--" if name == "f" else "drwxr-xr-x"
+                yield Gfls_Entry(name, 1, "u", "g", 0, path,
+                                 "Jun 01 09:00:00 2024", mode)
+        finally:
+            running.remove(path)
+
+    def expect(path, depth, max_depth, skip=()):
+        if path in skip:
+            return []
+        paths = [f"{path}/{name}" for name in tree[path]]
+        if max_depth is None or depth < max_depth:
+            for name in tree[path]:
+                if name != "f":
+                    paths += expect(f"{path}/{name}", depth + 1, max_depth,
+                                    skip)
+        return paths
+
+    for max_depth in (0, 1, None):
+        for max_buffered in (1, 10000):
+            walker = gfls_walker.RecursiveWalker(
+                list_dir, workers=3, max_depth=max_depth, ordered=True,
+                max_buffered=max_buffered)
+            result = [e.path async for e in walker.walk("/r", False)]
+            assert result == expect("/r", 0, max_depth)
+            walker = gfls_walker.RecursiveWalker(
+                list_dir, workers=3, max_depth=max_depth, ordered=False,
+                max_buffered=max_buffered)
+            result = [e.path async for e in walker.walk("/r", False)]
+            assert sorted(result) == sorted(expect("/r", 0, max_depth))
+    assert max_running == 3
+    assert running == []
+
+    errors = ("/r/d1", "/r/d2/d0")
+
+    async def list_dir_error(path, is_file):
+        if path in errors:
+            raise RuntimeError(f"{path}: error")
+        async for entry in list_dir(path, is_file):
+            yield entry
+
+    # the other directories are walked, the errors are raised at the end
+    for ordered in (True, False):
+        walker = gfls_walker.RecursiveWalker(list_dir_error, ordered=ordered)
+        result = []
+        with pytest.raises(RuntimeError) as e:
+            async for entry in walker.walk("/r", False):
+                result.append(entry.path)
+        assert sorted(result) == sorted(expect("/r", 0, None, errors))
+        assert sorted(str(e.value).splitlines()) == \
+            ["/r/d1: error", "/r/d2/d0: error"]
+    assert running == []
+
+
+@pytest.mark.asyncio
+async def test_ndjson_stream_frames():
+    obj = {"name": "\u3042 b", "size": 1 << 62, "mtime": 1.5, "x": None}
+    assert json.loads(ndjson_stream.dumps(obj)) == obj
+    assert json.loads(ndjson_stream.dumps({"big": 1 << 70})) == {
+        "big": 1 << 70}
+
+    async def lines(n, delay=0, error=None):
+        for i in range(n):
+            if delay:
+                await asyncio.sleep(delay)
+            yield f"{i:03d}\n"
+        if error:
+            raise error
+
+    expect = "".join(f"{i:03d}\n" for i in range(100))
+    # by size
+    result = [f async for f in ndjson_stream.frames(lines(100), 40, 10)]
+    assert "".join(result) == expect
+    assert [len(f) for f in result] == [40] * 10
+    # by time
+    result = [f async for f in ndjson_stream.frames(
+        lines(3, delay=0.05), 65536, 0.01)]
+    assert result == ["000\n", "001\n", "002\n"]
+    # not joined
+    result = [f async for f in ndjson_stream.frames(lines(100), 0)]
+    assert len(result) == 100
+    # buffered lines before the error
+    result = []
+    with pytest.raises(RuntimeError):
+        async for f in ndjson_stream.frames(
+                lines(5, error=RuntimeError("error")), 65536, 10):
+            result.append(f)
+    assert "".join(result) == expect[:20]
+
+
+@pytest.mark.asyncio
+async def test_content_encoding():
+    choose = content_encoding.choose_encoding
+    assert choose("gzip, deflate", ["zstd", "br", "gzip"]) == "gzip"
+    assert choose("gzip;q=0.5, br", ["zstd", "br", "gzip"]) == "br"
+    assert choose("br;q=0.5, gzip;q=0.5", ["br", "gzip"]) == "br"
+    assert choose("*;q=0.1, gzip;q=0", ["gzip", "br"]) == "br"
+    assert choose("gzip;q=0", ["gzip"]) is None
+    assert choose(None, ["gzip"]) is None
+    assert content_encoding.is_compressible("text/csv")
+    assert content_encoding.is_compressible("application/x-ndjson")
+    assert not content_encoding.is_compressible("image/png")
+    assert not content_encoding.is_compressible("application/zip")
+    assert content_encoding.encoded_etag('W/"a"', "br") == 'W/"a-br"'
+
+    async def frames():
+        for i in range(3):
+            yield f"line {i}\n" * 100
+
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    async for chunk in content_encoding.compress_stream(
+            frames(), "gzip", 6, flush_each=True):
+        # each frame can be decompressed without the next chunk
+        assert d.decompress(chunk).startswith(b"line ") or d.eof
+    assert d.eof
+
+
+@pytest.mark.asyncio
+async def test_dir_columnar():
+    def entry(name, path, mode_str="-rw-r--r--", perms=None, uname="user"):
+        return {"mode_str": mode_str, "is_file": mode_str[0] == "-",
+                "is_dir": mode_str[0] == "d", "is_sym": mode_str[0] == "l",
+                "linkname": None, "nlink": 1, "uname": uname,
+                "gname": "group", "size": 10, "mtime": 1717200000,
+                "name": name, "path": path, "perms": perms}
+
+    entries = [entry(".", "/", "drwxr-xr-x"),
+               entry("a", "/a", perms="rw"),
+               entry("b", "/d/b", uname="user2"),
+               entry("c", "/d/x/c"),  # path is not dir + name
+               entry("e", None)]
+    encoder = dir_columnar.ColumnarEncoder(block_size=2)
+    lines = [encoder.header()]
+    for e in entries:
+        lines.append(encoder.add(e))
+    lines.append(encoder.add_line({"line": "gfls: error"}))
+    lines.append(encoder.flush())
+    text = "".join(lines)
+    assert len(text.splitlines()) == 5  # header, 3 blocks, line
+    decoded = list(dir_columnar.decode(text.splitlines()))
+    assert decoded == entries + [{"line": "gfls: error"}]
+    assert [list(d) for d in decoded[:-1]] == [list(e) for e in entries]
+
+    accepted = dir_columnar.accepted
+    assert accepted(dir_columnar.MEDIA_TYPE)
+    assert accepted(f"{dir_columnar.MEDIA_TYPE}, application/x-ndjson;q=0.9")
+    assert not accepted(f"{dir_columnar.MEDIA_TYPE};q=0.5, */*")
+    assert not accepted("application/x-ndjson")
+    assert not accepted(None)
+
+    # a slow listing is sent after flush_delay (before block_size)
+    slept = False
+
+    async def slow():
+        nonlocal slept
+        yield entries[1]
+        yield entries[2]
+        await asyncio.sleep(0.2)
+        slept = True
+        yield entries[3]
+        raise RuntimeError("gfls: error")
+
+    encoder = dir_columnar.ColumnarEncoder()
+    lines = []
+    with pytest.raises(RuntimeError):
+        async for line in dir_columnar.encode_stream(slow(), encoder, 0.01):
+            lines.append(line)
+            if len(lines) == 2:
+                assert not slept
+    assert list(dir_columnar.decode(lines)) == entries[1:3]
+    # left for the error line
+    assert encoder.pending == 1
+
+
+@pytest.mark.asyncio
+async def test_dir_usage():
+    def entry(dirname, name, size, mode_str="-rw-r--r--"):
+        return Gfls_Entry(name, 1, "user", "group", size, dirname,
+                          "Jun 01 09:00:00 2024", mode_str, None)
+
+    d = "drwxr-xr-x"
+    # order of "gfls -R -a"
+    entries = [entry("/r", ".", 0, d), entry("/r", "a", 1),
+               entry("/r", "d1", 0, d), entry("/r", "d2", 0, d),
+               entry("/r/d1", "b", 10), entry("/r/d1", "e", 0, d),
+               entry("/r/d1/e", "c", 100),
+               entry("/r/d2", "f", 1000), entry("/r/d2", "g", 0, d)]
+    closed = []
+
+    async def source():
+        try:
+            for e in entries:
+                yield e
+        finally:
+            closed.append(True)
+
+    records = [r async for r in dir_usage.disk_usage(
+        source(), "/r", max_depth=1, progress_interval=0)]
+    assert records == [
+        {"path": "/r/d1", "depth": 1, "size": 110, "files": 2, "dirs": 1},
+        {"path": "/r/d2", "depth": 1, "size": 1000, "files": 1,
+         "dirs": 1},
+        {"path": "/r", "depth": 0, "size": 1111, "files": 4, "dirs": 4}]
+    assert closed == [True]
+
+    ticks = iter(range(100))
+    records = [r async for r in dir_usage.disk_usage(
+        source(), "/r", max_depth=2, progress_interval=3,
+        clock=lambda: next(ticks))]
+    assert [r["path"] for r in records if "progress" not in r] == [
+        "/r/d1/e", "/r/d1", "/r/d2/g", "/r/d2", "/r"]
+    progress = [r for r in records if "progress" in r]
+    # after 3 entries
+    assert progress[0] == {"progress": True, "path": "/r", "size": 1,
+                           "files": 1, "dirs": 1}
+    assert records[-1]["dirs"] == 4
+
+    # a file
+    usage = dir_usage.DiskUsage("/r/a", 1)
+    assert usage.add(entry("/r", "a", 1)) == []
+    assert usage.finish() == [
+        {"path": "/r/a", "depth": 0, "size": 1, "files": 1, "dirs": 0}]
+
+    # stopped (ex. disconnected): the source is closed
+    closed.clear()
+    usage = dir_usage.disk_usage(source(), "/r", max_depth=1,
+                                 progress_interval=0)
+    assert (await usage.__anext__())["path"] == "/r/d1"
+    await usage.aclose()
+    assert closed == [True]
+
+
+def test_listing_snapshot_writer(tmp_path):
+    store = ListingSnapshotStore(str(tmp_path))
+    writer = store.writer("user1", run_size=3)
+    keys = ["e", "b", "d", "a", "c", "b", "f"]
+    for i, key in enumerate(keys):
+        if writer.add(key, f"{key}{i}"):
+            writer.spill()
+    assert len(writer._runs) == 2
+    cursor = writer.commit()
+    lines, next_cursor, total = store.read("user1", cursor, 10)
+    # stable: b1 before b5
+    assert lines == ["a3", "b1", "b5", "c4", "d2", "e0", "f6"]
+    assert next_cursor is None and total == 7
+    # only the snapshot remains
+    assert len(os.listdir(tmp_path / "user1")) == 1
+
+
+def test_listing_snapshot_cleanup_all(tmp_path):
+    store = ListingSnapshotStore(str(tmp_path), ttl=60)
+    for user in ("user1", "user2", "user3"):
+        store.create(user, ["a", "b"])
+    old = time.time() - 120
+    # user1 never comes back
+    for name in os.listdir(tmp_path / "user1"):
+        os.utime(tmp_path / "user1" / name, (old, old))
+    os.utime(tmp_path / "user1", (old, old))
+    # user2: expired, but the directory is in use
+    for name in os.listdir(tmp_path / "user2"):
+        os.utime(tmp_path / "user2" / name, (old, old))
+    assert store.cleanup_all() == 1
+    assert sorted(os.listdir(tmp_path)) == ["user2", "user3"]
+    assert os.listdir(tmp_path / "user2") == []
+    assert len(os.listdir(tmp_path / "user3")) == 1
+    os.utime(tmp_path / "user2", (old, old))
+    assert store.cleanup_all() == 1
+    assert os.listdir(tmp_path) == ["user3"]
+
+
+def test_metrics_render():
+    registry = metrics.Registry()
+    c = metrics.Counter("test_requests", "help", ["code"], registry=registry)
+    h = metrics.Histogram("test_seconds", "help", buckets=[0.1, 1],
+                          registry=registry)
+    c.labels("200").inc()
+    c.labels(code="200").inc(2)
+    h.observe(0.05)
+    h.observe(0.5)
+    text = registry.render()
+    assert 'test_requests_total{code="200"} 3' in text
+    assert 'test_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_seconds_bucket{le="1"} 2' in text
+    assert 'test_seconds_bucket{le="+Inf"} 2' in text
+    assert "test_seconds_count 2" in text
+    assert "# TYPE test_seconds histogram" in text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfwhoami], indirect=True)
+async def test_metrics_endpoint(mock_claims, mock_exec):
+    response = client.get("/conf/me", headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    # disabled by default
+    response = client.get("/metrics")
+    assert response.status_code == 404
+    with patch("gfarm_http_gateway.METRICS", True), \
+         patch("gfarm_http_gateway.METRICS_TOKEN", "secret"):
+        response = client.get("/metrics")
+        assert response.status_code == 403
+        response = client.get("/metrics",
+                              headers={"Authorization": "Bearer wrong"})
+        assert response.status_code == 403
+        response = client.get("/metrics",
+                              headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert 'gfarm_http_command_exit_total{command="gfwhoami",code="0"}' \
+        in text
+    assert 'gfarm_http_command_first_byte_seconds_count{command="gfwhoami"}' \
+        in text
+    assert ('gfarm_http_request_duration_seconds_count'
+            '{method="GET",route="/conf/me",status="200"}') in text
+    # TestClient: "testclient"
+    with patch("gfarm_http_gateway.METRICS", True), \
+         patch("gfarm_http_gateway.METRICS_ALLOW",
+               [ipaddress.ip_network("127.0.0.0/8")]):
+        response = client.get("/metrics")
+    assert response.status_code == 403
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("mock_exec", [expect_gfwhoami], indirect=True)
 async def test_whoami_basic_session(mock_claims, mock_access_token_none,
@@ -522,6 +1520,38 @@ async def test_dir_list_json(mock_claims, mock_get_file_info_not_file,
     assert expect_gfls_json_stdout in lines
 
 
+expect_gfls_file = (
+    b"-rw-r--r-- 1 user group 5678 Jun 01 09:00:00 2024"
+    b" /testdir/testfile1.txt\n", b"", 0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfls_file], indirect=True)
+async def test_dir_list_file(mock_claims, mock_get_file_info, mock_exec):
+    # gfls does not wait for gfstat (for ETag)
+    response = client.get("/dir/testdir/testfile1.txt",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    assert mock_exec.call_count == 1
+    args, kwargs = mock_exec.call_args
+    assert args == ('gfls', '-l', '-T', '/testdir/testfile1.txt')
+    lines = [json.loads(line) async for line in response.aiter_lines()]
+    assert lines == [expect_gfls_json_stdout]
+
+
+expect_gfls_not_found = (
+    b"", b"gfls: /nofile: no such file or directory", 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfls_not_found], indirect=True)
+async def test_dir_list_not_found(mock_claims, mock_get_file_info_not_found,
+                                  mock_exec):
+    response = client.get("/dir/nofile", headers=req_headers_oidc_auth)
+    assert response.status_code == 404
+    assert mock_exec.call_count == 1
+
+
 expect_gfls_err_msg = "test gfls (error)"
 expect_gfls_err = ((expect_gfls_err_msg + "\n").encode(), b"error", 1)
 
@@ -554,6 +1584,233 @@ async def test_dir_list_ign_err(mock_claims, mock_get_file_info_not_file,
     assert any(expect_gfls_err_msg in line for line in lines)
 
 
+gfls_many_param = (
+    b"-rw-r--r-- 1 user group 3 Jun 01 09:00:00 2024 c.txt\n"
+    b"-rw-r--r-- 1 user group 1 Jun 01 09:00:00 2024 a.txt\n"
+    b"drwxr-xr-x 2 user group 0 Jun 01 09:00:00 2024 d\n"
+    b"-rw-r--r-- 1 user group 2 Jun 01 09:00:00 2024 b.txt\n"
+    b"-rw-r--r-- 1 user group 5 Jun 01 09:00:00 2024 e.txt\n",
+    b"", 0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [gfls_many_param], indirect=True)
+async def test_dir_list_paginated(mock_claims, mock_get_file_info_not_file,
+                                  mock_exec):
+    names = []
+    cursor = None
+    for _ in range(3):
+        url = "/dir/testdir?limit=2"
+        if cursor is not None:
+            url += f"&cursor={cursor}"
+        response = client.get(url, headers=req_headers_oidc_auth)
+        assert response.status_code == 200
+        assert response.headers["X-Total-Count"] == "5"
+        names += [json.loads(line)["name"]
+                  for line in response.text.splitlines()]
+        cursor = response.headers.get("X-Next-Cursor")
+    assert names == ["a.txt", "b.txt", "c.txt", "d", "e.txt"]
+    assert cursor is None
+    # the next pages are read from the snapshot
+    assert mock_exec.call_count == 1
+
+    response = client.get("/dir/testdir?cursor=" + "x" * 22 + ".0",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 410
+    response = client.get("/dir/testdir?cursor=invalid",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [gfls_many_param], indirect=True)
+async def test_dir_list_filter_sort(mock_claims, mock_get_file_info_not_file,
+                                    mock_exec):
+    def names(response):
+        assert response.status_code == 200
+        return [json.loads(line)["name"]
+                for line in response.text.splitlines()]
+
+    response = client.get("/dir/testdir?type=file&sort=size&order=desc"
+                          "&top=2", headers=req_headers_oidc_auth)
+    assert names(response) == ["e.txt", "c.txt"]
+
+    mock_exec_common(mock_exec, *gfls_many_param)
+    response = client.get("/dir/testdir?pattern=*.txt&max_size=2",
+                          headers=req_headers_oidc_auth)
+    assert names(response) == ["a.txt", "b.txt"]
+
+    mock_exec_common(mock_exec, *gfls_many_param)
+    response = client.get("/dir/testdir?regex=^[cd]&top=1",
+                          headers=req_headers_oidc_auth)
+    assert names(response) == ["c.txt"]
+
+    # sort keeps up to top (<= DIR_PAGE_MAX) entries in memory
+    max_top = gfarm_http_gateway.DIR_PAGE_MAX
+    for query in ("sort=size", f"sort=size&top={max_top + 1}",
+                  f"top={max_top + 1}", "top=0"):
+        response = client.get(f"/dir/testdir?{query}",
+                              headers=req_headers_oidc_auth)
+        assert response.status_code == 422
+    mock_exec_common(mock_exec, *gfls_many_param)
+    response = client.get(f"/dir/testdir?sort=name&top={max_top}",
+                          headers=req_headers_oidc_auth)
+    assert names(response) == ["a.txt", "b.txt", "c.txt", "d", "e.txt"]
+
+    response = client.get("/dir/testdir?regex=(",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 422
+    response = client.get("/dir/testdir?regex=(a%2B)%2B$",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [gfls_many_param], indirect=True)
+async def test_dir_list_columnar(mock_claims, mock_get_file_info_not_file,
+                                 mock_exec):
+    response = client.get("/dir/testdir?output_format=json",
+                          headers=req_headers_oidc_auth)
+    expect = [json.loads(line) for line in response.text.splitlines()]
+
+    mock_exec_common(mock_exec, *gfls_many_param)
+    headers = dict(req_headers_oidc_auth)
+    headers["Accept"] = (f"{dir_columnar.MEDIA_TYPE}, "
+                         "application/x-ndjson;q=0.9")
+    response = client.get("/dir/testdir", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == dir_columnar.MEDIA_TYPE
+    assert "Accept" in response.headers["vary"]
+    assert list(dir_columnar.decode(response.text.splitlines())) == expect
+
+    # pages from the snapshot
+    mock_exec_common(mock_exec, *gfls_many_param)
+    response = client.get("/dir/testdir?limit=3", headers=headers)
+    assert response.headers["content-type"] == dir_columnar.MEDIA_TYPE
+    page = list(dir_columnar.decode(response.text.splitlines()))
+    assert page == sorted(expect, key=lambda e: e["name"])[:3]
+
+    # short format: negotiated to json
+    mock_exec_common(mock_exec, *gfls_many_param)
+    response = client.get("/dir/testdir?long_format=0", headers=headers)
+    assert response.headers["content-type"] == "application/x-ndjson"
+    response = client.get("/dir/testdir?long_format=0&output_format=columnar",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_dir_list_recursive_parallel(mock_claims,
+                                           mock_get_file_info_not_file):
+    line = "{} 1 user group 0 Jun 01 09:00:00 2024 {}\n"
+    outputs = {
+        "/testdir": line.format("drwxr-xr-x", "a")
+        + line.format("drwxr-xr-x", "b") + line.format("-rw-r--r--", "c"),
+        "/testdir/a": line.format("-rw-r--r--", "x"),
+        "/testdir/b": line.format("drwxr-xr-x", "y"),
+        "/testdir/b/y": line.format("-rw-r--r--", "z"),
+    }
+
+    def gfls(env, path, *args, **kwargs):
+        assert args[1] is False  # not -R
+        return mock_exec_common(Mock(), outputs[path].encode(), b"", 0)()
+
+    with patch('gfarm_http_gateway.gfls', side_effect=gfls):
+        response = client.get("/dir/testdir?recursive=1",
+                              headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    paths = [json.loads(line)["path"]
+             for line in response.text.splitlines()]
+    assert paths == ["/testdir/a", "/testdir/b", "/testdir/c",
+                     "/testdir/a/x", "/testdir/b/y", "/testdir/b/y/z"]
+
+
+@pytest.mark.asyncio
+async def test_dir_usage_list(mock_claims):
+    line = "{} 1 user group {} Jun 01 09:00:00 2024 {}\n"
+    outputs = {
+        "/testdir": line.format("drwxr-xr-x", 0, "a")
+        + line.format("-rw-r--r--", 5, "b"),
+        "/testdir/a": line.format("-rw-r--r--", 7, "x")
+        + line.format("drwxr-xr-x", 0, "y"),
+        "/testdir/a/y": line.format("-rw-r--r--", 9, "z"),
+    }
+
+    def gfls(env, path, *args, lane=None):
+        assert lane == LANE_BULK
+        return mock_exec_common(Mock(), outputs[path].encode(), b"", 0)()
+
+    with patch('gfarm_http_gateway.gfls', side_effect=gfls):
+        response = client.get("/du/testdir?depth=1",
+                              headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in response.text.splitlines()]
+    records = [r for r in records if "progress" not in r]
+    assert records == [
+        {"path": "/testdir/a", "depth": 1, "size": 16, "files": 2,
+         "dirs": 1},
+        {"path": "/testdir", "depth": 0, "size": 21, "files": 3,
+         "dirs": 2}]
+
+    response = client.get("/du/testdir?depth=-1",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfls_not_found], indirect=True)
+async def test_dir_usage_not_found(mock_claims, mock_exec):
+    response = client.get("/du/nofile", headers=req_headers_oidc_auth)
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_find(mock_claims, recursive_serial):
+    line = "{} 1 {} group {} Jun 01 09:00:00 2024 {}\n"
+    stdout = (line.format("drwxr-xr-x", "user", 0, "d")
+              + line.format("-rw-r--r--", "user", 5, "a.txt")
+              + line.format("-rw-r--r--", "user2", 50, "b.txt")
+              + "\n/testdir/d:\n"
+              + line.format("-rw-r--r--", "user", 500, "c.txt")
+              + line.format("-rw-r--r--", "user", 7, "e.dat")).encode()
+    procs = []
+
+    def gfls(env, path, *args, lane=None):
+        assert args[1] is True  # -R
+        assert lane == LANE_BULK
+        proc = mock_exec_common(Mock(), stdout, b"", 0)()
+        proc.returncode = None  # running
+        procs.append(proc)
+        return proc
+
+    def paths(response):
+        assert response.status_code == 200
+        return [json.loads(line)["path"]
+                for line in response.text.splitlines()]
+
+    with patch('gfarm_http_gateway.gfls', side_effect=gfls):
+        response = client.get("/find/testdir?pattern=*.txt&uname=user",
+                              headers=req_headers_oidc_auth)
+        assert paths(response) == ["/testdir/a.txt", "/testdir/d/c.txt"]
+
+        response = client.get("/find/testdir?type=file&min_size=10"
+                              "&max_results=1",
+                              headers=req_headers_oidc_auth)
+        assert paths(response) == ["/testdir/b.txt"]
+        # stopped after the first match
+        assert procs[-1].kill.called
+        assert not procs[-1].stdout.at_eof()
+
+        response = client.get("/find/testdir?pattern=nomatch",
+                              headers=req_headers_oidc_auth)
+        assert paths(response) == []
+
+        response = client.get("/find/testdir?max_results=0",
+                              headers=req_headers_oidc_auth)
+        assert response.status_code == 422
+
+
 no_stdout = ""
 expect_no_stdout = (no_stdout.encode(), b"", 0)
 
@@ -595,6 +1852,125 @@ async def test_file_export(mock_claims, mock_gfstat, mock_exec):
     assert response.content == gfexport_stdout
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_gfstat", [expect_gfstat], indirect=True)
+@pytest.mark.parametrize("mock_exec", [expect_gfexport], indirect=True)
+async def test_file_export_not_modified(mock_claims, mock_gfstat, mock_exec):
+    response = client.get("/file/a/testfile.txt",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+    assert etag.startswith('"')
+    assert last_modified == "Mon, 10 Feb 2025 18:27:31 GMT"
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    assert mock_exec.call_count == 1
+
+    # 304 without gfexport
+    for headers in ({"If-None-Match": f'"x", {etag}'},
+                    {"If-None-Match": "W/" + etag},
+                    {"If-Modified-Since": last_modified}):
+        response = client.get("/file/a/testfile.txt",
+                              headers={**req_headers_oidc_auth, **headers})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.content == b""
+    assert mock_exec.call_count == 1
+
+    mock_exec_common(mock_exec, *expect_gfexport)
+    response = client.get("/file/a/testfile.txt",
+                          headers={**req_headers_oidc_auth,
+                                   "If-None-Match": '"other"',
+                                   "If-Modified-Since": last_modified})
+    assert response.status_code == 200
+    assert mock_exec.call_count == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_gfstat", [expect_gfstat], indirect=True)
+@pytest.mark.parametrize("mock_exec", [expect_gfexport], indirect=True)
+async def test_file_export_gzip(mock_claims, mock_gfstat, mock_exec):
+    with patch('gfarm_http_gateway.COMPRESS_MIN_SIZE', 0), \
+         patch('gfarm_http_gateway.COMPRESS_ENCODINGS', ["gzip"]):
+        response = client.get("/file/a/testfile.txt",
+                              headers={**req_headers_oidc_auth,
+                                       "Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert "Content-Length" not in response.headers
+        assert response.content == gfexport_stdout  # decoded by httpx
+        etag = response.headers["ETag"]
+        assert etag.endswith('-gzip"')
+
+        response = client.get("/file/a/testfile.txt",
+                              headers={**req_headers_oidc_auth,
+                                       "Accept-Encoding": "gzip",
+                                       "If-None-Match": etag})
+        assert response.status_code == 304
+
+        mock_exec_common(mock_exec, *expect_gfexport)
+        response = client.get("/file/a/testfile.txt",
+                              headers={**req_headers_oidc_auth,
+                                       "Accept-Encoding": "identity",
+                                       "If-None-Match": etag})
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["ETag"] != etag
+        assert response.content == gfexport_stdout
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_gfstat", [expect_gfstat], indirect=True)
+async def test_get_attr_not_modified(mock_claims, mock_gfstat):
+    response = client.get("/attr/a/testfile.txt",
+                          headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    response = client.get("/attr/a/testfile.txt",
+                          headers={**req_headers_oidc_auth,
+                                   "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [gfls_success_param], indirect=True)
+async def test_dir_list_not_modified(mock_claims, mock_exec):
+    st = gfarm_http_gateway.parse_gfstat(gfstat_dir_stdout)
+    with patch("gfarm_http_gateway.get_stat", return_value=st), \
+            patch("gfarm_http_gateway.DIR_ETAG", True):
+        response = client.get("/dir/testdir?long_format=0",
+                              headers=req_headers_oidc_auth)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert etag.startswith('W/"')
+        assert mock_exec.call_count == 1
+
+        # 304 without gfls
+        response = client.get("/dir/testdir?long_format=0",
+                              headers={**req_headers_oidc_auth,
+                                       "If-None-Match": etag})
+        assert response.status_code == 304
+        assert mock_exec.call_count == 1
+
+        # other options
+        response = client.get("/dir/testdir?long_format=0&show_hidden=1",
+                              headers={**req_headers_oidc_auth,
+                                       "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert mock_exec.call_count == 2
+
+        # long format: sizes and mtimes are not covered by gfstat
+        # of the directory
+        response = client.get("/dir/testdir",
+                              headers={**req_headers_oidc_auth,
+                                       "If-None-Match": etag})
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("mock_gfmv", [expect_no_stdout], indirect=True)
 @pytest.mark.parametrize("mock_exec", [expect_no_stdout], indirect=True)
@@ -706,6 +2082,166 @@ async def test_get_attr(mock_claims, mock_exec):
     assert response.json() == parsed_stat
 
 
+expect_gfstat_multi = ((gfstat_file_stdout + gfstat_dir_stdout).encode(),
+                       b"", 0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfstat_multi], indirect=True)
+async def test_gfstat_batch(mock_exec):
+    env = {"GFARM_SASL_USER": "user1"}
+    res = await gfarm_http_gateway.gfstat_batch(
+        env, ["/tmp/test.pdf", "/tmp"])
+    args, kwargs = mock_exec.call_args
+    assert args == ('gfstat', '/tmp/test.pdf', '/tmp')
+    assert res["/tmp/test.pdf"].Filetype == "regular file"
+    assert res["/tmp/test.pdf"].Size == 54321
+    assert res["/tmp"].model_dump() == parsed_stat
+
+
+expect_gfstat_partial = (gfstat_dir_stdout.encode(),
+                         b"/nofile: no such file or directory\n", 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfstat_partial], indirect=True)
+async def test_gfstat_batch_error(mock_exec):
+    env = {"GFARM_SASL_USER": "user1"}
+    res = await gfarm_http_gateway.gfstat_batch(env, ["/nofile", "/tmp"])
+    assert isinstance(res["/nofile"], FileNotFoundError)
+    assert res["/tmp"].model_dump() == parsed_stat
+
+
+expect_gfstat_prefix_error = (
+    gfstat_dir_stdout.encode(),
+    b"/no: permission denied\n"
+    b"gfstat: /nofile: no such file or directory\n", 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_gfstat_prefix_error],
+                         indirect=True)
+async def test_gfstat_batch_error_path(mock_exec):
+    env = {"GFARM_SASL_USER": "user1"}
+    # "/no" is a prefix of "/nofile"
+    res = await gfarm_http_gateway.gfstat_batch(
+        env, ["/nofile", "/no", "/tmp"])
+    assert isinstance(res["/no"], PermissionError)
+    assert isinstance(res["/nofile"], FileNotFoundError)
+    assert res["/tmp"].model_dump() == parsed_stat
+    paths = ["/a", "/a: b"]
+    assert gfarm_http_gateway.gfstat_error_path("/a: b: x", paths) == "/a: b"
+    assert gfarm_http_gateway.gfstat_error_path("/a: x", paths) == "/a"
+    assert gfarm_http_gateway.gfstat_error_path("/ab: x", paths) is None
+
+
+@pytest.mark.asyncio
+async def test_stat_cache():
+    st = gfarm_http_gateway.parse_gfstat(gfstat_file_stdout)
+
+    async def stat_batch(env, paths, metadata=False, check_symlink=False):
+        return {path: st for path in paths}
+
+    with patch("gfarm_http_gateway.gfstat_batch",
+               side_effect=stat_batch) as mock:
+        env = {"GFARM_SASL_USER": "user1"}
+        st1 = await gfarm_http_gateway.get_stat(env, "/tmp/test.pdf")
+        st2 = await gfarm_http_gateway.get_stat(env, "/tmp/test.pdf")
+        assert st1 == st2
+        assert mock.call_count == 1
+        # another user
+        await gfarm_http_gateway.get_stat({"GFARM_SASL_USER": "user2"},
+                                          "/tmp/test.pdf")
+        assert mock.call_count == 2
+        # invalidated for all users
+        gfarm_http_gateway.invalidate_stat_cache("/tmp", recursive=True)
+        assert len(gfarm_http_gateway.stat_cache) == 0
+        await gfarm_http_gateway.get_stat(env, "/tmp/test.pdf")
+        assert mock.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_get_attrs(mock_claims):
+    calls = []
+
+    async def stat_batch(env, paths, metadata=False, check_symlink=False):
+        calls.append(list(paths))
+        return {path: (FileNotFoundError(f"{path}: no such file or directory")
+                       if path == "/nofile"
+                       else gfarm_http_gateway.Stat(File=path,
+                                                    Filetype="directory"))
+                for path in paths}
+
+    paths = ["/a", "/b", "/nofile", "/c", "/a", "/d"]
+    with patch("gfarm_http_gateway.gfstat_batch", side_effect=stat_batch), \
+         patch("gfarm_http_gateway.GFARM_WORKER_MAX_BATCH", 2):
+        response = client.post("/attr", json={"paths": paths},
+                               headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    by_path = {line["File"]: line for line in lines}
+    assert sorted(by_path) == ["/a", "/b", "/c", "/d", "/nofile"]
+    assert by_path["/a"]["Filetype"] == "directory"
+    assert by_path["/nofile"]["err_code"] == 404
+    # duplicates are removed, 2 paths per gfstat
+    assert calls == [["/a", "/b"], ["/nofile", "/c"], ["/d"]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_exec", [expect_no_stdout], indirect=True)
+async def test_file_remove_invalidates_stat_cache(mock_claims, mock_exec):
+    cache = gfarm_http_gateway.stat_cache
+    cache.set(("key", "/dir/file1", False), "st1")
+    cache.set(("key", "/dir", False), "st2")
+    cache.set(("key", "/other", False), "st3")
+    response = client.delete("/file/dir/file1", headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    assert cache.get(("key", "/dir/file1", False)) is None
+    assert cache.get(("key", "/dir", False)) is None
+    assert cache.get(("key", "/other", False)) == "st3"
+
+
+@pytest.mark.asyncio
+async def test_gfarm_worker_pool():
+    calls = []
+
+    async def run_batch(env, items):
+        calls.append(list(items))
+        await asyncio.sleep(0.01)
+        return {item: item.upper() for item in items}
+
+    pool = GfarmWorkerPool(run_batch, idle_timeout=0.05, max_inflight=1)
+    names = ["a", "b", "c", "d", "a"]
+    res = await asyncio.gather(*[pool.submit("key1", {}, n) for n in names])
+    assert res == ["A", "B", "C", "D", "A"]
+    # concurrent requests share one batch (duplicates are merged)
+    assert calls == [["a", "b", "c", "d"]]
+    assert len(pool) == 1
+    await asyncio.sleep(0.2)
+    assert len(pool) == 0  # evicted
+
+    # batches do not run in the context of a request
+    from gfarm_scheduler import _request_slots
+    contexts = []
+    started = asyncio.Event()
+
+    async def run_slow(env, items):
+        contexts.append(_request_slots.get())
+        started.set()
+        await asyncio.sleep(10)
+
+    pool = GfarmWorkerPool(run_slow)
+    _request_slots.set([])
+    task = asyncio.create_task(pool.submit("key1", {}, "a"))
+    await started.wait()
+    assert contexts == [None]
+    # running batches are cancelled
+    await pool.close()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("mock_exec", [expect_no_stdout], indirect=True)
 async def test_change_attr(mock_claims, mock_exec):
@@ -759,6 +2295,36 @@ async def test_user_info_None(mock_claims, mock_gfwhoami):
     assert response.status_code == 401
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_gfwhoami", [expect_gfwhoami], indirect=True)
+@pytest.mark.parametrize("mock_exec", [expect_gfuser], indirect=True)
+async def test_user_info_cached(mock_exec, mock_gfwhoami, mock_access_token):
+    with patch("jose.jwt.get_unverified_claims") as mock_claims:
+        mock_claims.return_value = {
+            "sub": user_claim,
+            "exp": int(time.time()) + 3600,
+        }
+        for _ in range(3):
+            response = client.get("/user_info",
+                                  headers=req_headers_oidc_auth)
+            assert response.status_code == 200
+            assert response.json()["home_directory"] == "/home"
+    assert mock_gfwhoami.call_count == 1
+    assert mock_exec.call_count == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mock_gfwhoami", [expect_gfwhoami], indirect=True)
+@pytest.mark.parametrize("mock_exec", [expect_gfuser], indirect=True)
+async def test_user_info_expired_token_not_cached(mock_claims, mock_exec,
+                                                  mock_gfwhoami,
+                                                  mock_access_token):
+    # mock_claims has no "exp" claim
+    response = client.get("/user_info", headers=req_headers_oidc_auth)
+    assert response.status_code == 200
+    assert len(gfarm_http_gateway.identity_cache) == 0
+
+
 expect_gfls_stdout_data1 = (
     b'drwxr-xr-x 4 user group 0 Jul 25 04:13:58 2025 .\n'
     b'drwxrwxr-x 5 user group 4 Jul 25 04:14:43 2025 ..\n'
@@ -818,6 +2384,7 @@ async def zip_export_check(paths, expect_names, expect_contents):
 async def test_zip_export_file_and_directory(
         mock_claims,
         mock_get_file_info_not_file,
+        recursive_serial,
         mock_gfls,
         mock_gfexport):
     expected_zip_paths = [
@@ -861,6 +2428,7 @@ gfls_success_param2 = (expect_gfls_stdout_data2, b"", 0)
 async def test_zip_export_nest_directory(
         mock_claims,
         mock_get_file_info_not_file,
+        recursive_serial,
         mock_gfls,
         mock_gfexport):
     expected_zip_paths = [
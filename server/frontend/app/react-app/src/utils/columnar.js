@@ -0,0 +1,76 @@
+// Decoder of the columnar listing of GET /dir
+// (application/x-gfarm-columnar-ndjson, see server/api/dir_columnar.py)
+export const COLUMNAR_MEDIA_TYPE = "application/x-gfarm-columnar-ndjson";
+
+const DEFAULT_COLUMNS = [
+    "name",
+    "dir",
+    "path",
+    "mode_str",
+    "linkname",
+    "nlink",
+    "uname",
+    "gname",
+    "size",
+    "mtime",
+    "perms",
+];
+
+export const isColumnar = (response) =>
+    (response.headers.get("Content-Type") || "").startsWith(COLUMNAR_MEDIA_TYPE);
+
+const joinPath = (dir, name) => {
+    if (name === ".") return dir;
+    if (dir.endsWith("/")) return dir + name;
+    return dir + "/" + name;
+};
+
+// returns decode(obj): array of entries (same as output_format=json)
+// or [obj] for other lines ({"line": ...}, {"error": ...})
+export const createColumnarDecoder = () => {
+    let columns = DEFAULT_COLUMNS;
+    let dicts = {};
+
+    return (obj) => {
+        if (obj?.columns) {
+            columns = obj.columns;
+            dicts = {};
+            for (const key of obj.dictionary || []) dicts[key] = [];
+            return [];
+        }
+        if (obj?.n === undefined) return [obj];
+
+        for (const [key, values] of Object.entries(obj.dict || {})) {
+            (dicts[key] ||= []).push(...values);
+        }
+        const entries = new Array(obj.n);
+        for (let i = 0; i < obj.n; i++) {
+            const row = {};
+            columns.forEach((key, c) => {
+                const value = obj.data[c][i];
+                row[key] = dicts[key] && value !== null ? dicts[key][value] : value;
+            });
+            const mode = row.mode_str || "";
+            const isDir = mode.startsWith("d");
+            const isSym = mode.startsWith("l");
+            let path = row.path;
+            if (path == null && row.dir != null) path = joinPath(row.dir, row.name);
+            entries[i] = {
+                mode_str: row.mode_str,
+                is_file: !isDir && !isSym,
+                is_dir: isDir,
+                is_sym: isSym,
+                linkname: row.linkname,
+                nlink: row.nlink,
+                uname: row.uname,
+                gname: row.gname,
+                size: row.size,
+                mtime: row.mtime,
+                name: row.name,
+                path: path ?? null,
+                perms: row.perms,
+            };
+        }
+        return entries;
+    };
+};
@@ -2,23 +2,36 @@ import { encodePath, createLineSplitter } from "@utils/func";
 import { apiFetch } from "@utils/apiFetch";
 import { API_URL } from "@utils/config";
 import get_error_message from "@utils/error";
+import { COLUMNAR_MEDIA_TYPE, createColumnarDecoder, isColumnar } from "@utils/columnar";
 
-export default async function getList(dirPath, showHidden, setData, signal, batchSize = 200) {
+// pageSize > 0: read the listing page by page (sorted by path on the server)
+// pageSize = 0 (default): one streaming listing (the first entries are
+// shown while gfls is running)
+export default async function getList(dirPath, showHidden, setData, signal, batchSize = 200, pageSize = 0) {
     const epath = encodePath(dirPath);
-    const url =
+    const baseUrl =
         `${API_URL}/dir${epath}` +
-        `?show_hidden=${showHidden ? "on" : "off"}&long_format=on&time_format=full&output_format=json`;
+        `?show_hidden=${showHidden ? "on" : "off"}&long_format=on&time_format=full`;
 
-    const response = await apiFetch(url, {
-        credentials: "include",
-        signal,
-    });
-
-    if (!response.ok) {
-        const error = await response.json();
-        const message = get_error_message(response.status, error?.detail);
-        throw new Error(message);
-    }
+    const fetchList = async (cursor) => {
+        let url = baseUrl;
+        if (pageSize > 0) {
+            url += `&limit=${pageSize}`;
+            if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+        }
+        // the columnar format is smaller; NDJSON if not supported
+        const response = await apiFetch(url, {
+            credentials: "include",
+            headers: { Accept: `${COLUMNAR_MEDIA_TYPE}, application/x-ndjson;q=0.9` },
+            signal,
+        });
+        if (!response.ok) {
+            const error = await response.json();
+            const message = get_error_message(response.status, error?.detail);
+            throw new Error(message);
+        }
+        return response;
+    };
 
     const batch = [];
     let lastYield = 0;
@@ -33,7 +46,7 @@ export default async function getList(dirPath, showHidden, setData, signal, batc
         setData(batch.splice(0, batch.length));
     };
 
-    const handleLine = async (line) => {
+    const handleLine = async (line, decode) => {
         if (!line) return;
         let json;
         try {
@@ -42,28 +55,41 @@ export default async function getList(dirPath, showHidden, setData, signal, batc
             console.warn("Failed to parse line", e);
             return;
         }
-        if (json?.error) {
-            const message = get_error_message(json?.err_code || 500, json.error);
-            throw new Error(message);
-        }
-        batch.push(json);
-        if (batch.length >= batchSize) {
-            await flushBatch();
+        for (const entry of decode ? decode(json) : [json]) {
+            if (entry?.error) {
+                const message = get_error_message(entry?.err_code || 500, entry.error);
+                throw new Error(message);
+            }
+            if (entry?.line !== undefined) continue;
+            batch.push(entry);
+            if (batch.length >= batchSize) {
+                await flushBatch();
+            }
         }
     };
 
-    const lineSplitter = createLineSplitter();
-    const textStream = response.body.pipeThrough(new TextDecoderStream()).pipeThrough(lineSplitter);
+    const readLines = async (response) => {
+        const decode = isColumnar(response) ? createColumnarDecoder() : null;
+        const lineSplitter = createLineSplitter();
+        const textStream = response.body.pipeThrough(new TextDecoderStream()).pipeThrough(lineSplitter);
 
-    const reader = textStream.getReader();
-    try {
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-            await handleLine(value);
+        const reader = textStream.getReader();
+        try {
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                await handleLine(value, decode);
+            }
+            await flushBatch();
+        } finally {
+            reader.releaseLock();
         }
-        await flushBatch();
-    } finally {
-        reader.releaseLock();
-    }
+    };
+
+    let cursor = null;
+    do {
+        const response = await fetchList(cursor);
+        await readLines(response);
+        cursor = pageSize > 0 ? response.headers.get("X-Next-Cursor") : null;
+    } while (cursor);
 }